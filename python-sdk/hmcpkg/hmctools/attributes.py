@@ -0,0 +1,238 @@
+"""
+Columnar representation of segment attributes (functional class, speed limit, travel direction, ...)
+
+Every attribute of a RIB attribute layer is compiled, once per partition, into NumPy interval arrays
+sorted by (segment id, orientation, start offset):
+    sid, orientation, start, end
+    code    integer code of the value ; values[code] is the value itself (the decode table)
+Enums are decoded once per distinct value instead of once per lookup, and other values (numbers, or protobuf
+messages such as the applies_to of accessible_by) are de-duplicated into the same table.
+
+Point lookups use binary search on the sorted rows, and batch lookups do the same for whole arrays of
+segments/offsets at once. Where several rows cover an offset (overlapping anchors, or two anchors that share a
+boundary), the lookup returns the one that comes first in the partition, like the per-segment scan of
+get_road_attribute did ; IntervalIndex does this for traffic patterns as well:
+
+    from hmctools.segment import RoadAttributes
+    fc = RoadAttributes().get_intervals('functional_class', 23602975)
+    fc.values_at(sids, 'ignore', offsets)   # object array of values, None where there is none
+    fc.codes_at(sids, 'ignore', offsets)    # the same as integer codes (-1 for none), without decoding
+    fc.ranges(sid)                          # [(start, end, value), ...] of one segment
+
+The layer classes in segment.py only compile the attributes listed in their eager_attributes ; the others are
+compiled the first time they are asked for.
+"""
+
+import numpy as np
+
+
+IGNORE = 'ignore'  # orientation that matches any orientation, as in get_road_attribute
+NONE = -1  # code of "no value"
+
+
+class IntervalIndex:
+    """
+    Lookup of (segment, orientation, offset) in interval rows sorted by (segment id, orientation, start offset)
+
+    rank is the order of the rows in the partition (default: the sorted order). Of the rows of the segment and
+    orientation that cover the offset (start <= offset <= end), find() returns the one with the lowest rank.
+    With half_open, a row covers start <= offset < end, or offset == end == 1 (as travel_direction does).
+    """
+
+    def __init__(self, sid, orientation, start, end, rank=None):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+        self.rank = np.arange(len(self.start)) if rank is None else np.asarray(rank)
+        # segment and orientation as an exact integer key, numbered densely so that the float search key
+        # (group number + offset / 2) keeps the full offset resolution
+        group_keys = np.asarray(sid, dtype=np.int64) * 8 + np.asarray(orientation, dtype=np.int64)
+        self.groups, group, counts = np.unique(group_keys, return_inverse=True, return_counts=True)
+        self.group_start = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        self._keys = group + 0.5 * self.start
+        # the largest end of the rows of the group up to and including each row (ends are at most 1)
+        self._reach = np.maximum.accumulate(self.end + 2.0 * group) - 2.0 * group
+
+    @property
+    def nbytes(self) -> int:
+        return self.groups.nbytes + self.group_start.nbytes + self._keys.nbytes + self._reach.nbytes
+
+    def find(self, sids, codes, offsets, half_open=False) -> np.ndarray:
+        """Row for each (segment, orientation code, offset) ; -1 where no row covers the offset"""
+        sids = np.asarray(sids, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.float64)
+        found = np.full(sids.shape, -1, dtype=np.int64)
+        if len(self.groups) == 0:
+            return found
+        codes = np.asarray(codes, dtype=np.int64)
+        keys = np.where(codes >= 0, sids * 8 + codes, -1)  # unknown orientations (code -1) match nothing
+        group = np.minimum(np.searchsorted(self.groups, keys), len(self.groups) - 1)
+        todo = np.flatnonzero(self.groups[group] == keys)
+        rows = np.searchsorted(self._keys, group[todo] + 0.5 * offsets[todo], side='right') - 1
+        first = self.group_start[group[todo]]
+        offsets = offsets[todo]
+        best = np.full(len(todo), np.iinfo(np.int64).max)
+        # walk back from the last row that starts at or before the offset, for as long as an earlier row of
+        # the group can still reach the offset ; usually that is one or two steps
+        active = np.flatnonzero(rows >= first)
+        while len(active):
+            r = rows[active]
+            o = offsets[active]
+            end = self.end[r]
+            covers = (o < end) | ((o == end) & (end == 1)) if half_open else (o <= end)
+            better = active[covers & (self.rank[r] < best[active])]
+            best[better] = self.rank[rows[better]]
+            found[todo[better]] = rows[better]
+            rows[active] -= 1
+            active = active[(rows[active] >= first[active]) & (self._reach[np.maximum(rows[active], 0)] >= o)]
+        return found
+
+    def find_any(self, sids, codes, offsets, half_open=False) -> np.ndarray:
+        """find() over several orientation codes (e.g. all of them) ; the row with the lowest rank wins"""
+        found = np.full(np.shape(sids), -1, dtype=np.int64)
+        for code in codes:
+            rows = self.find(sids, code, offsets, half_open)
+            better = (rows >= 0) & ((found < 0) | (self.rank[np.maximum(rows, 0)] < self.rank[np.maximum(found, 0)]))
+            found[better] = rows[better]
+        return found
+
+
+class AttributeIntervals:
+    """
+    One attribute of one partition as sorted interval arrays (see module docstring)
+    """
+
+    ARRAYS = ['sid', 'orientation', 'start', 'end', 'code']
+
+    def __init__(self, sid, orientation, start, end, code, values, orientation_names, rank=None):
+        self.sid = sid
+        self.orientation = orientation
+        self.start = start
+        self.end = end
+        self.code = code
+        # index = value code ; an extra None at the end so that code -1 decodes to None
+        self.values = list(values)
+        self._decode = np.empty(len(self.values) + 1, dtype=object)
+        self._decode[:len(self.values)] = self.values
+        # index = orientation code, e.g. ['BOTH', 'FORWARD', 'BACKWARD', ...]
+        self.orientation_names = list(orientation_names)
+        self._orientation_codes = {name: code for code, name in enumerate(self.orientation_names)}
+        self._index = IntervalIndex(self.sid, self.orientation, self.start, self.end, rank)
+
+    @classmethod
+    def from_parsed(cls, parsed, attribute, value_field, id2int, get_start_end):
+        """
+        Compile one attribute of a decoded partition (None gives empty arrays)
+        attribute is the repeated field of the partition (e.g. 'functional_class'), value_field the field of its
+        items that holds the value, or None for attributes without a value (travel_direction)
+        (id2int and get_start_end are passed in from segment.py to avoid a circular import)
+        """
+        orientation_names = []
+        rows = []
+        values = [None] if value_field is None else []
+        codes = {}
+        enum_type = None
+        for item in getattr(parsed, attribute) if parsed is not None else []:
+            if value_field is None:
+                code = 0
+            else:
+                raw = getattr(item, value_field)
+                if not values:
+                    enum_type = item.DESCRIPTOR.fields_by_name[value_field].enum_type
+                key = raw.SerializeToString() if hasattr(raw, 'SerializeToString') else raw
+                code = codes.get(key)
+                if code is None:
+                    code = codes[key] = len(values)
+                    values.append(enum_type.values_by_number[raw].name if enum_type is not None else raw)
+            for sai in item.segment_anchor_index:
+                anchor = parsed.segment_anchor[sai]
+                assert len(anchor.oriented_segment_ref) == 1, 'AttributeIntervals wrong length of osr list'
+                if not orientation_names:
+                    orientation_type = anchor.DESCRIPTOR.fields_by_name['attribute_orientation'].enum_type
+                    orientation_names = [q.name for q in sorted(orientation_type.values, key=lambda v: v.number)]
+                start, end = get_start_end(anchor)
+                rows.append((id2int(anchor.oriented_segment_ref[0].segment_ref.identifier),
+                             anchor.attribute_orientation, start, end, code))
+
+        # the position in the partition is the rank: the first matching anchor wins (see IntervalIndex)
+        order = sorted(range(len(rows)), key=lambda i: (rows[i][0], rows[i][1], rows[i][2]))
+        rows = [rows[i] for i in order]
+        return cls(np.array([q[0] for q in rows], dtype=np.int64),
+                   np.array([q[1] for q in rows], dtype=np.int8),
+                   np.array([q[2] for q in rows], dtype=np.float64),
+                   np.array([q[3] for q in rows], dtype=np.float64),
+                   np.array([q[4] for q in rows], dtype=np.min_scalar_type(-max(len(values), 1))),
+                   values, orientation_names, np.array(order, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.sid)
+
+    @property
+    def nbytes(self) -> int:
+        # the decode table is small: distinct values only
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS) + self._index.rank.nbytes + \
+            self._index.nbytes + 64 * len(self.values)
+
+    def orientation_code(self, orientation) -> int:
+        """Integer code of an orientation name ; -1 (which matches nothing) for unknown names such as None"""
+        return self._orientation_codes.get(orientation, -1)
+
+    def find_rows(self, sids, orientations, offsets, half_open=False) -> np.ndarray:
+        """
+        Vectorized lookup of the row for each (segment, orientation, offset) ; -1 where there is no value
+        orientations can be a single string ('ignore' matches any orientation) or an array of strings/codes
+        Of several rows that cover the offset, the first one in the partition wins (see IntervalIndex).
+        """
+        sids = np.atleast_1d(np.asarray(sids, dtype=np.int64))
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=np.float64), sids.shape)
+        if len(self.sid) == 0:
+            return np.full(sids.shape, -1, dtype=np.int64)
+        if isinstance(orientations, str) and orientations == IGNORE:
+            return self._index.find_any(sids, np.unique(self.orientation).tolist(), offsets, half_open)
+        if isinstance(orientations, str):
+            codes = np.full(sids.shape, self.orientation_code(orientations), dtype=np.int8)
+        else:
+            codes = np.array([q if isinstance(q, (int, np.integer)) else self.orientation_code(q) for q in
+                              np.broadcast_to(np.asarray(orientations, dtype=object), sids.shape)], dtype=np.int8)
+        return self._index.find(sids, codes, offsets, half_open)
+
+    def codes_at(self, sids, orientations, offsets) -> np.ndarray:
+        """Vectorized value codes (see values) ; -1 where there is no value"""
+        rows = self.find_rows(sids, orientations, offsets)
+        if len(self.sid) == 0:
+            return rows
+        return np.where(rows >= 0, self.code[np.maximum(rows, 0)], NONE)
+
+    def values_at(self, sids, orientations, offsets) -> np.ndarray:
+        """Vectorized (decoded) values as an object array ; None where there is no value"""
+        return self._decode[self.codes_at(sids, orientations, offsets)]
+
+    def orientations_at(self, sids, offsets) -> np.ndarray:
+        """
+        Vectorized orientation name of the first row (any orientation) at each position ; None where there is none
+        Rows cover start <= offset < end here (or offset == end == 1), as in travel_direction
+        """
+        rows = self.find_rows(sids, IGNORE, offsets, half_open=True)
+        names = np.array(self.orientation_names + [None], dtype=object)
+        if len(self.sid) == 0:
+            return names[rows]
+        return names[np.where(rows >= 0, self.orientation[np.maximum(rows, 0)], -1)]
+
+    def value(self, sid, orientation, offset):
+        """Point lookup: the value at this position, or None"""
+        row = self.find_rows([sid], orientation, [offset])[0]
+        return self.values[self.code[row]] if row >= 0 else None
+
+    def segment_rows(self, sid, orientation=IGNORE):
+        """Return the row indices for the segment (and orientation), in order of orientation and start offset"""
+        if len(self.sid) == 0:
+            return []
+        lo, hi = np.searchsorted(self.sid, [sid, sid + 1])
+        if orientation == IGNORE:
+            return list(range(lo, hi))
+        code = self.orientation_code(orientation)
+        return [i for i in range(lo, hi) if self.orientation[i] == code]
+
+    def ranges(self, sid, orientation=IGNORE):
+        """[(start offset, end offset, value), ...] of one segment, sorted by offset"""
+        return sorted([(float(self.start[row]), float(self.end[row]), self.values[self.code[row]])
+                       for row in self.segment_rows(sid, orientation)], key=lambda q: (q[0], q[1]))
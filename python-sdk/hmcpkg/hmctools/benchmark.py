@@ -0,0 +1,620 @@
+"""
+Reproducible benchmarks of hmctools against a local catalog instead of OLP
+
+A LocalCatalog serves the partitions of the RIB-2 layers, traffic-flow, traffic-patterns and the weather
+archive from memory, through fakecatalog.FakeLayers with a configurable latency per request. The partitions
+are either synthetic (see synthetic.py) or recorded once from OLP with record():
+
+    from hmctools import benchmark
+    catalog = benchmark.LocalCatalog.synthetic([23602974, 23602975], latency=0.05)
+    # or: benchmark.record('bench-catalog', [23602974, 23602975], weather_start=..., weather_end=...)
+    #     catalog = benchmark.LocalCatalog.load('bench-catalog', latency=0.05)
+    report = benchmark.run(catalog)
+    print(benchmark.format_report(report, benchmark.load_report('baseline.json')))
+    benchmark.save_report(report, 'baseline.json')
+
+or from the command line, which exits with status 1 if a scenario got slower (or bigger) than the baseline:
+
+    python -m hmctools.benchmark --latency 0.05 --baseline baseline.json
+
+The scenarios (SCENARIOS) are the standard jobs: cold load of all layers of the tiles (from the catalog, or
+from a warm partition store), warm load, the full-partition attribute dump (per segment and in batch),
+the live vs historical sweep, offset interpolation (per segment and in batch) and a weather join.
+Every scenario reports
+    seconds     the fastest of `repeat` runs (cold scenarios start from empty caches every run,
+                warm scenarios get one untimed run first)
+    throughput  units (tiles, segments, rows or points) per second
+    peak_bytes  the peak of the memory allocated during one more run, measured with tracemalloc
+                (separately, because tracing slows everything down)
+    stages      seconds per metrics stage (fetch, decode, flatten, accessor) of the last timed run
+"""
+
+import argparse
+import collections
+import datetime
+import gc
+import json
+import os
+import pickle
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import cache
+from . import fakecatalog
+from . import fetch
+from . import metrics
+from . import partitionstore
+from . import synthetic
+from . import tiling
+from .segment import LAYER_CLASSES, HmcAccess, HmcPartition, TopologyGeometry, TopologySegment, \
+    neighbour_tiles, prefetch_partitions
+from .weather import WeatherAccess, WeatherReader, WeatherTimestampReader
+
+
+DEFAULT_PIDS = [23602974, 23602975]  # two tiles of Amsterdam
+TZ = 'Europe/Amsterdam'
+TOLERANCE = 0.25  # a scenario regresses if its throughput drops (or peak memory grows) by more than this
+POINTS = 20000  # points per tile for offset_interpolation_batch, and in total for weather_join
+
+_MISSING = object()
+
+
+class LocalCatalog:
+    """
+    Partitions of the HMC layers and the weather archive, served from memory instead of OLP (see module docstring)
+
+    blobs is a dict of layer id -> dict of partition id (str) -> blob, schemas a dict of layer id -> schema
+    weather is a dict of region -> (timestamp index blob, dict of (tile8 (str), version) -> blob, schema)
+    Every read_partitions call takes latency seconds (plus up to jitter).
+    """
+
+    def __init__(self, pids, blobs, schemas, weather=None, latency=0.0, jitter=0.0, description=None):
+        self.pids = [int(q) for q in pids]
+        self.description = dict(description or {}, pids=self.pids, latency=latency, jitter=jitter)
+        self.layers = {layer_id: fakecatalog.FakeLayer(layer_blobs, latency, jitter, schema=schemas[layer_id])
+                       for layer_id, layer_blobs in blobs.items()}
+        self.weather = {}
+        self.weather_range = None  # (first, last) timestamp of the weather archive
+        for region, (index, tiles, schema) in (weather or {}).items():
+            self.weather[region] = fakecatalog.FakeCatalog(WeatherAccess._CATALOG[region], {
+                'timestamp-index': fakecatalog.FakeLayer({'index': index}, latency, jitter),
+                'archived-data': fakecatalog.FakeLayer(tiles, latency, jitter, schema=schema)})
+            pairs = [WeatherTimestampReader().parse_pairs(q) for q in index.decode().splitlines()]
+            if pairs:
+                first, last = min(pairs)[0], max(pairs)[0]
+                if self.weather_range is not None:
+                    first, last = min(first, self.weather_range[0]), max(last, self.weather_range[1])
+                self.weather_range = (first, last)
+        self._saved = None
+        self._store_dir = None
+
+    @classmethod
+    def synthetic(cls, pids=DEFAULT_PIDS, grid=synthetic.GRID, seed=0, weather_versions=8, latency=0.0,
+                  jitter=0.0):
+        """
+        Synthetic partitions of the tiles (and the topology-geometry of the tiles around them, which the
+        traffic-flow of border tiles needs), plus weather_versions versions of the weather of their level 8 tiles
+        """
+        pids = [int(q) for q in pids]
+        topo_pids = list(pids)
+        for pid in pids:
+            topo_pids.extend(q for q in neighbour_tiles(pid) if q not in topo_pids)
+
+        blobs = {layer_id: {} for layer_id in synthetic.LAYERS}
+        for pid in topo_pids:
+            for layer_id, message in synthetic.partitions(pid, grid, seed).items():
+                if pid in pids or layer_id == TopologyGeometry._layer_id:
+                    blobs[layer_id][str(pid)] = synthetic.encode(message)
+
+        weather = {}
+        tiles8 = sorted(set(tiling.parent_tile_ids(pids, 8).tolist()))
+        _, lons = tiling.tile_centers(tiles8)
+        versions = synthetic.weather_versions(weather_versions)
+        for tile8, lon in zip(tiles8, lons.tolist()):
+            region = WeatherReader.region_of(lon)
+            if region not in weather:
+                weather[region] = (synthetic.weather_index(weather_versions), {}, synthetic.SCHEMA)
+            for _, version in versions:
+                weather[region][1][(str(tile8), version)] = synthetic.encode(
+                    synthetic.weather_partition(tile8, version, seed))
+
+        description = {'source': 'synthetic', 'grid': grid, 'seed': seed, 'weather_versions': weather_versions}
+        return cls(pids, blobs, {layer_id: synthetic.SCHEMA for layer_id in blobs}, weather, latency, jitter,
+                   description)
+
+    @classmethod
+    def load(cls, root, latency=0.0, jitter=0.0):
+        """
+        A catalog written by record()
+        Schemas that could not be pickled when recording are read from OLP (or the schema cache, see
+        segment.SCHEMA_CACHE_DIR) here.
+        """
+        with open(os.path.join(root, 'manifest.json')) as fh:
+            manifest = json.load(fh)
+
+        blobs = {}
+        schemas = {}
+        for layer_id, pids in manifest['layers'].items():
+            directory = os.path.join(root, layer_id)
+            blobs[layer_id] = {str(pid): _read(os.path.join(directory, '%d.blob' % pid)) for pid in pids}
+            schemas[layer_id] = _load_schema(directory, lambda: LAYER_CLASSES[layer_id]._schema)
+
+        weather = {}
+        for region, recorded in manifest.get('weather', {}).items():
+            directory = os.path.join(root, 'weather-' + region)
+            tiles = {(str(tile8), version): _read(os.path.join(directory, '%d-%d.blob' % (tile8, version)))
+                     for tile8 in recorded['tiles8'] for version in recorded['versions']}
+            weather[region] = (_read(os.path.join(directory, 'index')), tiles,
+                               _load_schema(directory, lambda: WeatherReader._schema[region]))
+
+        description = {'source': 'recorded', 'recorded': manifest.get('recorded')}
+        return cls(manifest['pids'], blobs, schemas, weather, latency, jitter, description)
+
+    def install(self):
+        """Serve every layer from this catalog instead of OLP, with empty caches and no partition store"""
+        if self._saved is not None:
+            return
+        saved = {'classes': [], 'weather': [], 'ttl': {},
+                 'store': (partitionstore._default_store, partitionstore._default_store_configured)}
+        for layer_id, layer in self.layers.items():
+            accessor = LAYER_CLASSES[layer_id]
+            for name, value in [('_layer', layer), ('_schema', layer.schema)]:
+                saved['classes'].append((accessor, name, accessor.__dict__.get(name, _MISSING)))
+                setattr(accessor, name, value)
+        for region, catalog in self.weather.items():
+            for per_region, value in [(WeatherAccess._catalog, catalog),
+                                      (WeatherReader._layer, catalog.layer_by_id('archived-data')),
+                                      (WeatherReader._schema, catalog.layer_by_id('archived-data').schema)]:
+                saved['weather'].append((per_region, region, per_region.get(region, _MISSING)))
+                per_region[region] = value
+        # the recorded traffic-flow does not change, so it should not expire in the middle of a run
+        for name in ['traffic-flow', 'traffic-flow-arrays']:
+            saved['ttl'][name] = cache.get_cache(name).ttl
+            cache.configure(name, ttl=None)
+        partitionstore.set_default_store(None)
+        self._saved = saved
+        reset_state()
+
+    def uninstall(self):
+        """Undo install() (and empty the caches, which hold partitions of this catalog)"""
+        if self._saved is None:
+            return
+        saved, self._saved = self._saved, None
+        for accessor, name, value in reversed(saved['classes']):
+            if value is _MISSING:
+                delattr(accessor, name)
+            else:
+                setattr(accessor, name, value)
+        for per_region, region, value in reversed(saved['weather']):
+            if value is _MISSING:
+                del per_region[region]
+            else:
+                per_region[region] = value
+        for name, ttl in saved['ttl'].items():
+            cache.configure(name, ttl=ttl)
+        partitionstore._default_store, partitionstore._default_store_configured = saved['store']
+        self.drop_store()
+        reset_state()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+        return False
+
+    def use_store(self):
+        """Use a partition store in a temporary directory (filled by the first load) ; see drop_store"""
+        if self._store_dir is None:
+            self._store_dir = tempfile.mkdtemp(prefix='hmctools-benchmark-')
+        partitionstore.set_default_store(partitionstore.PartitionStore(self._store_dir))
+
+    def drop_store(self):
+        """Stop using the partition store of use_store and delete it"""
+        if self._store_dir is not None:
+            if self._saved is not None:
+                partitionstore.set_default_store(None)
+            shutil.rmtree(self._store_dir, ignore_errors=True)
+            self._store_dir = None
+
+
+def _read(path) -> bytes:
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def _write(path, blob):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(blob)
+
+
+def _load_schema(directory, fallback):
+    path = os.path.join(directory, 'schema.pickle')
+    if os.path.exists(path):
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+    return fallback()
+
+
+def _save_schema(directory, schema):
+    try:
+        _write(os.path.join(directory, 'schema.pickle'), pickle.dumps(schema))
+    except Exception:
+        pass  # not picklable ; LocalCatalog.load reads it from OLP instead
+
+
+def record(root, pids=DEFAULT_PIDS, layers=None, neighbours=True, weather_start=None, weather_end=None):
+    """
+    Download the partitions of the tiles from OLP into root, for LocalCatalog.load
+    layers default to all of LAYER_CLASSES ; with neighbours=True the topology-geometry of the surrounding tiles
+    is included. If weather_start and weather_end (datetimes) are given, the weather versions between them are
+    recorded for the level 8 tiles of the tiles, with a timestamp index of just those versions.
+    """
+    pids = [int(q) for q in pids]
+    topo_pids = list(pids)
+    if neighbours:
+        for pid in pids:
+            topo_pids.extend(q for q in neighbour_tiles(pid) if q not in topo_pids)
+
+    fetcher = fetch.get_fetcher()
+    manifest = {'pids': pids, 'layers': {}, 'weather': {}, 'recorded': datetime.datetime.now().isoformat()}
+    for layer_id in (layers if layers is not None else list(LAYER_CLASSES)):
+        accessor = LAYER_CLASSES[layer_id]
+        version = accessor._hmc_version if issubclass(accessor, HmcAccess) else None
+        layer_pids = topo_pids if layer_id == TopologyGeometry._layer_id else pids
+        directory = os.path.join(root, layer_id)
+        manifest['layers'][layer_id] = []
+        for pid, blob in fetcher.fetch_many(accessor._layer, layer_pids, version, layer_id).items():
+            if isinstance(blob, fetch.FetchError):
+                continue  # e.g. open sea
+            _write(os.path.join(directory, '%d.blob' % pid), blob)
+            manifest['layers'][layer_id].append(pid)
+        _save_schema(directory, accessor._schema)
+
+    if weather_start is not None and weather_end is not None:
+        _, lons = tiling.tile_centers(pids)
+        tiles8 = tiling.parent_tile_ids(pids, 8).tolist()
+        for region in sorted(set(WeatherReader.region_of(q) for q in lons.tolist())):
+            region_tiles = sorted(set(t for t, lon in zip(tiles8, lons.tolist())
+                                      if WeatherReader.region_of(lon) == region))
+            pairs = WeatherTimestampReader().versions_between(weather_start, weather_end, region)
+            directory = os.path.join(root, 'weather-' + region)
+            for tile8 in region_tiles:
+                for _, version in pairs:
+                    for blob in WeatherReader._layer[region].read_partitions([tile8], version):
+                        _write(os.path.join(directory, '%d-%d.blob' % (tile8, version)), blob)
+            _write(os.path.join(directory, 'index'), '\n'.join(
+                '%s,%d' % (ts.strftime('%m/%d/%Y %H:%M:%S'), version) for ts, version in pairs).encode())
+            _save_schema(directory, WeatherReader._schema[region])
+            manifest['weather'][region] = {'tiles8': region_tiles, 'versions': [q[1] for q in pairs]}
+
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    return manifest
+
+
+def reset_state():
+    """Empty all in-memory caches (including the weather timestamp index), for a cold start"""
+    cache.invalidate()
+    TopologyGeometry._pidlookup.clear()
+    for table in [WeatherTimestampReader.timestamps, WeatherTimestampReader.versions,
+                  WeatherTimestampReader.timestamp_version_list]:
+        table.clear()
+
+
+"""
+The scenarios: run(catalog, rng) does the work and returns the number of units it handled.
+Cold scenarios have a setup that is called (untimed) before every run ; the others are warm.
+"""
+
+Scenario = collections.namedtuple('Scenario', 'name run setup teardown unit doc')
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(name, unit, setup=None, teardown=None):
+    """Decorator that adds a function to SCENARIOS"""
+    def decorator(func):
+        SCENARIOS[name] = Scenario(name, func, setup, teardown, unit, (func.__doc__ or '').strip())
+        return func
+    return decorator
+
+
+def _cold(catalog):
+    reset_state()
+
+
+def _cold_with_store(catalog):
+    reset_state()
+    if catalog._store_dir is None:
+        catalog.use_store()
+        prefetch_partitions(catalog.pids, neighbours=True)  # fill the store
+        reset_state()
+
+
+def _without_store(catalog):
+    catalog.drop_store()
+
+
+@scenario('cold_load', 'tiles', setup=_cold)
+def cold_load(catalog, rng):
+    """Fetch, decode and flatten every layer of the tiles (and the neighbouring topology) into empty caches"""
+    prefetch_partitions(catalog.pids, neighbours=True)
+    return len(catalog.pids)
+
+
+@scenario('store_load', 'tiles', setup=_cold_with_store, teardown=_without_store)
+def store_load(catalog, rng):
+    """cold_load with the blobs in the partition store, like the workers of a city-wide run"""
+    prefetch_partitions(catalog.pids, neighbours=True)
+    return len(catalog.pids)
+
+
+@scenario('warm_load', 'tiles')
+def warm_load(catalog, rng):
+    """cold_load when everything is cached already"""
+    prefetch_partitions(catalog.pids, neighbours=True)
+    return len(catalog.pids)
+
+
+@scenario('attribute_dump', 'segments')
+def attribute_dump(catalog, rng):
+    """segment.dump_attributes for every tile: the TopologySegment accessors, one segment at a time"""
+    offset = 0.5
+    count = 0
+    for pid in catalog.pids:
+        for sid in HmcPartition(pid).get_all_segment_ids():
+            s = TopologySegment(pid, sid)
+            count += 1
+            if not s.accessible_by(offset):
+                continue
+            td = s.travel_direction(offset)
+            s.speed_category(offset)
+            s.speed_limit(offset, 'FORWARD' if td == 'BOTH' else td)
+            s.functional_class(offset)
+    return count
+
+
+@scenario('attribute_dump_batch', 'segments')
+def attribute_dump_batch(catalog, rng):
+    """attribute_dump with the HmcPartition batch lookups"""
+    offset = 0.5
+    count = 0
+    for pid in catalog.pids:
+        p = HmcPartition(pid)
+        sids = np.array(p.get_all_segment_ids(), dtype=np.int64)
+        p.attribute_values(LAYER_CLASSES['road-attributes'], 'accessible_by', sids, offset)
+        p.attribute_values(LAYER_CLASSES['navigation-attributes'], 'travel_direction', sids, offset)
+        p.speed_category(sids, offset)
+        p.speed_limit(sids, offset, 'FORWARD')
+        p.functional_class(sids, offset)
+        count += len(sids)
+    return count
+
+
+@scenario('live_vs_historical', 'rows')
+def live_vs_historical(catalog, rng):
+    """comparison.live_vs_historical of every tile"""
+    from . import comparison  # needs pandas
+    return sum(len(comparison.live_vs_historical(pid, TZ)[0]) for pid in catalog.pids)
+
+
+@scenario('offset_interpolation', 'points')
+def offset_interpolation(catalog, rng):
+    """TopologySegment.point_from_offset at three offsets of every segment, like segment.interp"""
+    count = 0
+    for pid in catalog.pids:
+        for sid in HmcPartition(pid).get_all_segment_ids():
+            s = TopologySegment(pid, sid)
+            for offset in [0.1, 0.5, 0.9]:
+                s.point_from_offset(offset)
+            count += 3
+    return count
+
+
+@scenario('offset_interpolation_batch', 'points')
+def offset_interpolation_batch(catalog, rng):
+    """TopologyGeometry.points_from_offsets for POINTS random positions per tile"""
+    tg = TopologyGeometry()
+    for pid in catalog.pids:
+        sids = np.array(tg.get_all_segment_ids(pid), dtype=np.int64)
+        tg.points_from_offsets(pid, rng.choice(sids, POINTS), rng.random(POINTS))
+    return POINTS * len(catalog.pids)
+
+
+@scenario('weather_join', 'points', setup=_cold)
+def weather_join(catalog, rng):
+    """WeatherReader.get_weather_many for POINTS random points in the tiles at random times, from empty caches"""
+    if catalog.weather_range is None:
+        return 0
+    tiles = rng.choice(np.array(catalog.pids, dtype=np.int64), POINTS)
+    lats, lons = tiling.tile_centers(tiles)
+    size = 360.0 / 2 ** tiling.tile_level(catalog.pids[0])
+    first, last = catalog.weather_range
+    seconds = rng.random(POINTS) * (last - first).total_seconds()
+    timestamps = np.datetime64(first, 'ns') + (seconds * 1e9).astype('timedelta64[ns]')
+    WeatherReader().get_weather_many(lats + (rng.random(POINTS) - 0.5) * size,
+                                     lons + (rng.random(POINTS) - 0.5) * size, timestamps)
+    return POINTS
+
+
+def _stage_seconds(snapshot):
+    return {stage: sum(q['seconds'] for q in names.values()) for stage, names in snapshot['stages'].items()}
+
+
+def run_scenario(catalog, name, repeat=3, memory=True, seed=0) -> dict:
+    """Run one scenario on an installed catalog (see module docstring for what is measured)"""
+    s = SCENARIOS[name]
+
+    def once():
+        if s.setup is not None:
+            s.setup(catalog)
+        metrics.reset()
+        start = time.perf_counter()
+        units = s.run(catalog, np.random.default_rng(seed))
+        return units, time.perf_counter() - start
+
+    try:
+        if s.setup is None:
+            once()  # warm up
+        times = []
+        for _ in range(repeat):
+            units, seconds = once()
+            times.append(seconds)
+        stages = _stage_seconds(metrics.snapshot())
+
+        peak = None
+        if memory:
+            if s.setup is not None:
+                s.setup(catalog)
+            gc.collect()
+            tracemalloc.start()
+            try:
+                s.run(catalog, np.random.default_rng(seed))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        if s.teardown is not None:
+            s.teardown(catalog)
+
+    best = min(times)
+    return {'unit': s.unit, 'units': units, 'seconds': best, 'mean_seconds': sum(times) / len(times),
+            'throughput': units / best if best > 0 else float('inf'), 'peak_bytes': peak, 'stages': stages}
+
+
+def run(catalog, scenarios=None, repeat=3, memory=True, seed=0, verbose=True) -> dict:
+    """
+    Run the scenarios (default: all of SCENARIOS) on the catalog ; returns the report, a dict with
+        meta        the catalog description, versions and settings
+        scenarios   scenario name -> {unit, units, seconds, mean_seconds, throughput, peak_bytes, stages}
+    """
+    names = list(scenarios) if scenarios is not None else list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            raise ValueError('benchmark.run: unknown scenario ' + name)
+
+    results = collections.OrderedDict()
+    with catalog:
+        for name in names:
+            results[name] = run_scenario(catalog, name, repeat, memory, seed)
+            if verbose:
+                print(_format_row(name, results[name]))
+    meta = {'catalog': catalog.description, 'repeat': repeat, 'seed': seed,
+            'time': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform()}
+    return {'meta': meta, 'scenarios': results}
+
+
+def save_report(report, path):
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=1)
+
+
+def load_report(path) -> dict:
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def compare(report, baseline, tolerance=TOLERANCE) -> list:
+    """
+    Return the regressions of report against baseline: a list of (scenario, metric, baseline value, value)
+    for every scenario whose throughput dropped, or whose peak memory grew, by more than tolerance (a fraction)
+    Only scenarios that are in both are compared ; baselines should come from the same catalog.
+    """
+    output = []
+    for name, result in report['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            output.append((name, 'throughput', base['throughput'], result['throughput']))
+        if result['peak_bytes'] is not None and base.get('peak_bytes') is not None and \
+                result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance):
+            output.append((name, 'peak_bytes', base['peak_bytes'], result['peak_bytes']))
+    return output
+
+
+def _format_row(name, result, base=None):
+    peak = '%9.1f' % (result['peak_bytes'] / 1024 ** 2) if result['peak_bytes'] is not None else '%9s' % '-'
+    row = '%-28s %9.3f %12.1f %-11s %s' % (name, result['seconds'], result['throughput'], result['unit'] + '/s', peak)
+    if base is not None:
+        row += ' %+8.1f%%' % (100.0 * (result['throughput'] / base['throughput'] - 1))
+        if result['peak_bytes'] is not None and base.get('peak_bytes'):
+            row += ' %+8.1f%%' % (100.0 * (result['peak_bytes'] / base['peak_bytes'] - 1))
+    return row
+
+
+def format_report(report, baseline=None) -> str:
+    """The report as a table, with the change of throughput and peak memory against the baseline if given"""
+    header = '%-28s %9s %12s %-11s %9s' % ('scenario', 'seconds', 'throughput', '', 'peak MB')
+    if baseline is not None:
+        header += ' %9s %9s' % ('speed', 'memory')
+    lines = [header]
+    for name, result in report['scenarios'].items():
+        base = baseline['scenarios'].get(name) if baseline is not None else None
+        lines.append(_format_row(name, result, base))
+    if baseline is not None and baseline['meta']['catalog'] != report['meta']['catalog']:
+        lines.append('note: the baseline was measured on a different catalog')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark hmctools against a local (synthetic or recorded) '
+                                                 'catalog')
+    parser.add_argument('--pids', default=','.join(str(q) for q in DEFAULT_PIDS), help='comma separated tiles')
+    parser.add_argument('--catalog', help='directory of a recorded catalog (default: synthetic)')
+    parser.add_argument('--record', help='record the tiles from OLP into this directory and stop')
+    parser.add_argument('--weather-start', help='with --record: first weather timestamp, e.g. 2019-08-27T00:00')
+    parser.add_argument('--weather-end', help='with --record: last weather timestamp')
+    parser.add_argument('--grid', type=int, default=synthetic.GRID, help='nodes per row/column of synthetic tiles')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per read_partitions call')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--scenarios', help='comma separated, default all: ' + ','.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the (slow) peak memory run')
+    parser.add_argument('--baseline', help='report to compare with ; exit status 1 on a regression (it must '
+                                           'exist, unless --save writes the first one)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--save', help='write the report (e.g. as the new baseline) to this file')
+    args = parser.parse_args(argv)
+    if args.baseline and not args.record and not args.save and not os.path.exists(args.baseline):
+        parser.error('baseline %s not found ; use --save to write a first one' % args.baseline)
+
+    pids = [int(q) for q in args.pids.split(',')]
+    if args.record:
+        start = datetime.datetime.fromisoformat(args.weather_start) if args.weather_start else None
+        end = datetime.datetime.fromisoformat(args.weather_end) if args.weather_end else None
+        record(args.record, pids, weather_start=start, weather_end=end)
+        return 0
+
+    if args.catalog:
+        catalog = LocalCatalog.load(args.catalog, args.latency, args.jitter)
+    else:
+        catalog = LocalCatalog.synthetic(pids, args.grid, args.seed, latency=args.latency, jitter=args.jitter)
+    scenarios = args.scenarios.split(',') if args.scenarios else None
+    report = run(catalog, scenarios, args.repeat, not args.no_memory, args.seed, verbose=False)
+
+    baseline = load_report(args.baseline) if args.baseline and os.path.exists(args.baseline) else None
+    print(format_report(report, baseline))
+    if args.save:
+        save_report(report, args.save)
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        for name, metric, before, after in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g' % (name, metric, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
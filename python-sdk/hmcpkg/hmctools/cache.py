@@ -0,0 +1,195 @@
+"""
+In-memory caches for decoded partitions
+
+Every layer class in segment.py (and the weather reader) keeps its decoded partitions in a LayerCache
+obtained from get_cache(). Each cache has
+    - a memory budget in bytes ; least recently used partitions are evicted when it is exceeded
+    - an optional time-to-live in seconds, used for volatile layers such as traffic-flow
+    - explicit invalidation of one partition or of the whole layer
+
+The size of a decoded partition is not known exactly (it is a graph of protobuf objects, or dicts
+built from it), so callers pass an estimate when they put something in the cache.
+estimate_size() gives a rough estimate from the serialized size of the protobuf message.
+
+Budgets and TTLs can be changed at any time with configure(), e.g.
+
+    from hmctools import cache
+    cache.configure('topology-geometry', max_bytes=2 * 1024 ** 3)
+    cache.configure('traffic-flow', ttl=30)
+"""
+
+import collections
+import threading
+import time
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+# layers that get something other than the default budget / no ttl
+DEFAULT_SETTINGS = {
+    'topology-geometry': {'max_bytes': 512 * 1024 ** 2},
+    # volatile ; the source itself is refreshed about once a minute
+    'traffic-flow': {'ttl': 60},
+    'traffic-flow-arrays': {'ttl': 60},
+}
+
+# decoded python protobuf objects take a lot more memory than their serialized form
+DECODED_SIZE_FACTOR = 8
+
+# returned by get() on a miss when the caller needs to tell a miss apart from a cached None
+MISSING = object()
+
+
+def estimate_size(parsed) -> int:
+    """Rough estimate of the in-memory size of a decoded protobuf message (and what is flattened from it)"""
+    if parsed is None:
+        return 0
+    return parsed.ByteSize() * DECODED_SIZE_FACTOR
+
+
+class LayerCache:
+    """
+    Thread-safe LRU cache of partitions for one layer, bounded by an (estimated) memory budget
+    """
+
+    def __init__(self, name, max_bytes=DEFAULT_MAX_BYTES, ttl=None, on_evict=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # called as on_evict(key, value) whenever an entry leaves the cache (not when it is replaced) ;
+        # it is called after the lock is released, so it may use other caches
+        self.on_evict = on_evict
+
+        self._entries = collections.OrderedDict()  # key -> (value, size, time stored)
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expired(self, stored):
+        return (self.ttl is not None) and (time.time() - stored > self.ttl)
+
+    def _drop(self, key, dropped):
+        # the caller passes the (key, value) pairs on to _notify once it has released the lock
+        value, size, _ = self._entries.pop(key)
+        self._nbytes -= size
+        dropped.append((key, value))
+
+    def _notify(self, dropped):
+        if self.on_evict is not None:
+            for key, value in dropped:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it is not cached (or has expired)"""
+        dropped = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[2]):
+                self._drop(key, dropped)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        self._notify(dropped)
+        return default if entry is None else entry[0]
+
+    def peek(self, key, default=None):
+        """Same as get, but it counts neither a hit nor a miss and does not make the entry more recently used"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[2]):
+                return default
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        """Store value under key, evicting least recently used entries to stay within the budget"""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]  # replaced, not evicted
+            self._entries[key] = (value, size, time.time())
+            self._nbytes += size
+            dropped = self._shrink()
+        self._notify(dropped)
+
+    def _shrink(self):
+        # never evict the entry that was just added, even if it is larger than the budget on its own
+        dropped = []
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)), dropped)
+            self.evictions += 1
+        return dropped
+
+    def invalidate(self, key=None):
+        """Drop one entry, or everything if key is None"""
+        dropped = []
+        with self._lock:
+            if key is None:
+                for k in list(self._entries):
+                    self._drop(k, dropped)
+            elif key in self._entries:
+                self._drop(key, dropped)
+        self._notify(dropped)
+
+    def __contains__(self, key):
+        return self.peek(key, MISSING) is not MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'nbytes': self._nbytes, 'max_bytes': self.max_bytes,
+                'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, on_evict=None) -> LayerCache:
+    """Return the (shared) cache for the named layer, creating it with the default settings if needed"""
+    with _caches_lock:
+        if name not in _caches:
+            settings = DEFAULT_SETTINGS.get(name, {})
+            _caches[name] = LayerCache(name, settings.get('max_bytes', DEFAULT_MAX_BYTES),
+                                       settings.get('ttl'), on_evict)
+        return _caches[name]
+
+
+def configure(name, max_bytes=None, ttl=MISSING):
+    """Change the memory budget and/or the ttl (None means no expiry) of the named cache"""
+    c = get_cache(name)
+    with c._lock:
+        if max_bytes is not None:
+            c.max_bytes = max_bytes
+        if ttl is not MISSING:
+            c.ttl = ttl
+        dropped = c._shrink()
+    c._notify(dropped)
+
+
+def invalidate(name=None, key=None):
+    """Drop one partition (key) or all partitions from the named cache, or from every cache if name is None"""
+    with _caches_lock:
+        caches = list(_caches.values()) if name is None else [_caches[name]] if name in _caches else []
+    for c in caches:
+        c.invalidate(key)
+
+
+def stats() -> dict:
+    """Return hit/miss/size statistics for every cache"""
+    with _caches_lock:
+        return {name: c.stats() for name, c in _caches.items()}
@@ -0,0 +1,346 @@
+"""
+Define utilities for dealing with chains of segments
+
+    offset_on_chain: return offset on a chain, given a point on a segment in the chain
+    shape_points: return the shape points of the chain in physical order
+    is_inverted: given a segment, find out if the segment is inverted w.r.t. the chain direction
+
+ChainModel does the work: it is built once per chain (a traffic item, a route) from the nodes and lengths of its
+segments, and keeps cumulative lengths, the orientation of every segment and the merged polyline, so offsets
+convert with a dict lookup (segment -> chain) or a binary search (chain -> segment) instead of a walk over
+the segments. item_segment_offsets() does the conversion for every traffic item of a traffic-flow partition:
+
+    from hmctools import chain
+    table = chain.item_segment_offsets(23602975)
+    # item offset of RIB offset r on the segment of row k:
+    #     table['item_start'][k] + r * (table['item_end'][k] - table['item_start'][k])
+"""
+import math
+
+import numpy as np
+
+from . import cache
+from .segment import LiveTrafficFlow, TopologyGeometry, TopologySegment
+
+
+# convenience function for comparing coordinates (i.e. pairs in a tuple) with a tolerance
+def cequals(a,b):
+    TOL = 0.0000001
+
+    e1 = math.isclose(a[0], b[0], abs_tol=TOL)
+    e2 = math.isclose(a[1], b[1], abs_tol=TOL)
+
+    return (e1 and e2)
+
+
+# key is (segment ids, start offset, end offset, first segment in driving direction) of a traffic item ;
+# value is its ChainModel
+_trafitem_chains = cache.get_cache('traffic-item-chains')
+
+
+class ChainModel:
+    """
+    A chain of segments, built once:
+        pids, sids      the segments, in chain order
+        lengths         segment lengths in meters ; cumulative[k] is the length of the chain before segment k
+        inverted        True where the chain runs from the end node to the start node of the segment
+        start_offset, end_offset
+                        the part of the first / last segment (in chain direction) that is not on the chain, as
+                        for a traffic item ; 0 for a chain of whole segments
+    Offsets on the chain run from 0 to 1 over its (trimmed) length. "offset in dot" is an offset on a segment
+    in the direction of the chain, a RIB offset is one from the start node of the segment.
+    """
+
+    def __init__(self, pids, sids, lengths, inverted, start_offset=0.0, end_offset=0.0):
+        self.pids = np.asarray(pids, dtype=np.int64)
+        self.sids = np.asarray(sids, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.inverted = np.asarray(inverted, dtype=np.bool_)
+        self.cumulative = np.concatenate([[0.0], np.cumsum(self.lengths)])
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+        # meters of the chain before offset 0, and the length between offsets 0 and 1
+        self.start = start_offset * self.lengths[0] if len(self.lengths) else 0.0
+        self.total = self.cumulative[-1] - self.start - (end_offset * self.lengths[-1] if len(self.lengths) else 0.0)
+        # first position of every segment (a chain with a U-turn has a segment twice)
+        self._rows = {}
+        for k, key in enumerate(zip(self.pids.tolist(), self.sids.tolist())):
+            self._rows.setdefault(key, k)
+        self._points = None
+        self._point_ptr = None
+
+    @classmethod
+    def from_segments(cls, segments, start_offset=0.0, end_offset=0.0, first_inverted=None, tg=None):
+        """
+        Build the chain of a list of (pid, sid) from the nodes and lengths of the segments
+        The orientation of the first segment comes from the node it shares with the second one, unless
+        first_inverted is given (a traffic item says it).
+        """
+        tg = tg or TopologyGeometry()
+        nodes = [(tg.get_node(pid, sid, 0), tg.get_node(pid, sid, 1)) for pid, sid in segments]
+        inverted = []
+        for k, (start, end) in enumerate(nodes):
+            if k == 0:
+                if first_inverted is not None:
+                    inverted.append(bool(first_inverted))
+                    continue
+                if len(nodes) == 1:
+                    inverted.append(False)
+                    continue
+                # the node shared with the next segment is the end of this one --> not inverted
+                shared, other = end in nodes[1], start in nodes[1]
+            else:
+                # the node shared with the previous segment is the start of this one --> not inverted
+                shared, other = start in nodes[k - 1], end in nodes[k - 1]
+            if not (shared or other):
+                raise ValueError('ChainModel: segments %s and %s are not connected' %
+                                 (segments[max(k - 1, 0)], segments[max(k, 1)]))
+            inverted.append(not shared)
+        lengths = [tg.get_segment_length(pid, sid) for pid, sid in segments]
+        return cls([q[0] for q in segments], [q[1] for q in segments], lengths, inverted, start_offset, end_offset)
+
+    @classmethod
+    def from_trafitem(cls, pid, sid, trafitem_segment_info, tg=None):
+        """
+        The chain of a traffic item (its topology_segment), given the partition of one of its segments
+        Chains are cached, so this is cheap for every other segment of the same item.
+        """
+        seglist = list(trafitem_segment_info.topology_segment_id)
+        key = (tuple(seglist), trafitem_segment_info.start_offset, trafitem_segment_info.end_offset,
+               trafitem_segment_info.is_first_segment_in_driving_direction)
+        model = _trafitem_chains.get(key)
+        if model is None:
+            tg = tg or TopologyGeometry()
+            model = cls.from_segments(tg.translate_segments(pid, sid, seglist), trafitem_segment_info.start_offset,
+                                      trafitem_segment_info.end_offset,
+                                      not trafitem_segment_info.is_first_segment_in_driving_direction, tg)
+            _trafitem_chains.put(key, model, model.nbytes)
+        return model
+
+    def __len__(self):
+        return len(self.sids)
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.pids.nbytes + self.sids.nbytes + self.lengths.nbytes + self.inverted.nbytes + \
+            self.cumulative.nbytes + 64 * len(self._rows)
+        if self._points is not None:
+            nbytes += self._points.nbytes + self._point_ptr.nbytes
+        return nbytes
+
+    def row(self, pid, sid):
+        """Position of a segment in the chain, or None"""
+        return self._rows.get((pid, sid))
+
+    def is_inverted(self, pid, sid):
+        row = self.row(pid, sid)
+        return bool(self.inverted[row]) if row is not None else None
+
+    def offsets_on_chain(self, rows, offsets_in_dot) -> np.ndarray:
+        """Vectorized offset on the chain of offsets in dot on the segments at positions rows"""
+        rows = np.asarray(rows, dtype=np.int64)
+        meters = self.cumulative[rows] + np.asarray(offsets_in_dot, dtype=np.float64) * self.lengths[rows]
+        return (meters - self.start) / self.total
+
+    def offset_on_chain(self, pid, sid, offset_in_dot):
+        """Offset on the chain of an offset in dot on one of its segments, or None if it is not on the chain"""
+        row = self.row(pid, sid)
+        if row is None:
+            return None
+        return float(self.offsets_on_chain(row, offset_in_dot))
+
+    def offset_from_rib(self, pid, sid, rib_offset):
+        """Offset on the chain of a RIB offset on one of its segments, or None if it is not on the chain"""
+        row = self.row(pid, sid)
+        if row is None:
+            return None
+        return float(self.offsets_on_chain(row, 1.0 - rib_offset if self.inverted[row] else rib_offset))
+
+    def segments_at(self, chain_offsets, rib=False):
+        """
+        Vectorized inverse of offsets_on_chain: (rows, offsets) of the segments at the chain offsets
+        The offsets are offsets in dot, or RIB offsets if rib is True.
+        """
+        meters = np.asarray(chain_offsets, dtype=np.float64) * self.total + self.start
+        rows = np.clip(np.searchsorted(self.cumulative, meters, side='right') - 1, 0, len(self.lengths) - 1)
+        offsets = (meters - self.cumulative[rows]) / self.lengths[rows]
+        if rib:
+            offsets = np.where(self.inverted[rows], 1.0 - offsets, offsets)
+        return rows, offsets
+
+    def segment_at(self, chain_offset, rib=False):
+        """(TopologySegment, offset) at an offset on the chain ; see segments_at"""
+        rows, offsets = self.segments_at([chain_offset], rib)
+        row = int(rows[0])
+        return TopologySegment(int(self.pids[row]), int(self.sids[row])), float(offsets[0])
+
+    def _build_polyline(self, tg=None):
+        tg = tg or TopologyGeometry()
+        parts = []
+        for pid, sid, inverted in zip(self.pids.tolist(), self.sids.tolist(), self.inverted.tolist()):
+            points = np.asarray(tg.get_shape_points(pid, sid), dtype=np.float64).reshape(-1, 2)
+            if inverted:
+                points = points[::-1]
+            # the node at the start of this segment is already the last point of the previous one
+            if parts and len(parts[-1]) and len(points) and cequals(parts[-1][-1], points[0]):
+                points = points[1:]
+            parts.append(points)
+        counts = [len(q) for q in parts]
+        self._point_ptr = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).astype(np.int64)
+        self._points = np.concatenate(parts) if parts else np.zeros((0, 2))
+
+    @property
+    def points(self) -> np.ndarray:
+        """(n, 2) lat/lon polyline of the whole chain, in chain order (built on first use)"""
+        if self._points is None:
+            self._build_polyline()
+        return self._points
+
+    @property
+    def point_ptr(self) -> np.ndarray:
+        """the points of segment k start at points[point_ptr[k]] (its first node is shared with segment k - 1)"""
+        if self._point_ptr is None:
+            self._build_polyline()
+        return self._point_ptr
+
+    def shape_points(self, return_nodes=False):
+        """The polyline as a list of (lat, lon), and optionally the coordinates of the internal nodes"""
+        points = [tuple(q) for q in self.points.tolist()]
+        if return_nodes:
+            # the first point of every segment after the first one is dropped: the node is the point before it
+            return points, [points[k - 1] for k in self._point_ptr[1:-1].tolist()]
+        return points
+
+
+class SegmentChain:
+    def __init__(self, segment_list):
+        # segment_list should be a list of TopologySegment
+        self.segment_list = segment_list
+        self._model = None
+
+    @property
+    def model(self) -> ChainModel:
+        """The ChainModel of this chain, built on first use"""
+        if self._model is None:
+            self._model = ChainModel.from_segments([(q.pid, q.sid) for q in self.segment_list])
+        return self._model
+
+    def offset_on_chain(self, segment, offset_in_dot):
+        """
+        Input: TopologySegment segment, float offset_in_dot
+        offset_in_dot is the offset on segment in the direction of travel; this is what comes from the map-matcher
+
+        Return the offset of with respect to the start of this SegmentChain of the position defined by the above
+        """
+
+        if len(self.segment_list) == 1:
+            if self.segment_list[0]!=segment:
+                raise ValueError('offset_on_chain: input segment is not on chain!')
+            # in this simple case, the map-matcher has already calculated the offset for us
+            return offset_in_dot
+
+        return self.model.offset_on_chain(segment.pid, segment.sid, offset_in_dot)
+
+    def shape_points(self, return_nodes=False):
+        """
+        Return a list of shape points for this chain, in the correct physical order
+        """
+        for lastlink, link in zip(self.segment_list[:-1], self.segment_list[1:]):
+            if lastlink == link:
+                print('WARNING -- output of SegmentChain::shape_points() is not reliable when there is a U-turn')
+                return None
+        # we used to have logic to compute a "reverseme" condition
+        # in this way we made the link chain use the same convention as normal links, where
+        # the "start" of the link is always the SW coordinate.
+        # however with RIB we no longer use that convention, so i guess i will not do it
+        return self.model.shape_points(return_nodes)
+
+    def is_inverted(self, segment):
+        """
+        Determine if the input segment is inverted w.r.t. the chain direction
+        """
+        return self.model.is_inverted(segment.pid, segment.sid)
+
+
+ITEM_SEGMENT_DTYPE = np.dtype([('item', np.int32), ('pid', np.int64), ('sid', np.int64), ('inverted', np.bool_),
+                               ('item_start', np.float64), ('item_end', np.float64)])
+
+
+def item_segment_offsets(pid, arrays=None) -> np.ndarray:
+    """
+    For every segment of every traffic item of a traffic-flow partition, the offsets on the item of the start
+    (RIB offset 0) and end (RIB offset 1) of the segment ; the offset on the item of RIB offset r is
+    item_start + r * (item_end - item_start), for all rows at once.
+    arrays is the trafficflow.TrafficFlowArrays of the partition (by default the live one). The rows line up
+    with arrays.segment_ids ; items that cannot be placed on the topology get pid -1 and NaN offsets.
+    """
+    if arrays is None:
+        arrays = LiveTrafficFlow().get_arrays(pid)
+    tg = TopologyGeometry()
+    known = set(tg.get_all_segment_ids(pid) or [])
+    output = np.zeros(len(arrays.segment_ids), dtype=ITEM_SEGMENT_DTYPE)
+    output['item'], output['sid'] = arrays.segment_items()
+    output['pid'] = -1
+    output['item_start'] = np.nan
+    output['item_end'] = np.nan
+    for item in range(len(arrays)):
+        sids = arrays.item_segments(item).tolist()
+        anchor = next((q for q in sids if q in known), None)
+        if anchor is None:
+            continue
+        info = arrays.items[item]
+        try:
+            segments = tg.translate_segments(pid, anchor, sids)
+            model = ChainModel.from_segments(segments, float(info['start_offset']), float(info['end_offset']),
+                                             not info['in_driving_direction'], tg)
+        except (ValueError, TypeError):
+            continue  # a segment in a partition that could not be read, or a broken chain
+        rows = np.arange(len(model))
+        at_start = model.offsets_on_chain(rows, np.where(model.inverted, 1.0, 0.0))
+        at_end = model.offsets_on_chain(rows, np.where(model.inverted, 0.0, 1.0))
+        lo, hi = arrays.segment_ptr[item], arrays.segment_ptr[item + 1]
+        output['pid'][lo:hi] = model.pids
+        output['inverted'][lo:hi] = model.inverted
+        output['item_start'][lo:hi] = at_start
+        output['item_end'][lo:hi] = at_end
+    return output
+
+
+def test1():
+    sl = [TopologySegment(20095974,463602083), TopologySegment(20095974,401451358)]
+    sc = SegmentChain(sl)
+
+    print([q.length() for q in sl])
+
+    print( sc.offset_on_chain(TopologySegment(20095974,401451358), 0.01))
+    print( sc.offset_on_chain(TopologySegment(20095974,401451358), 0.99))
+
+def test2():
+    sl = [TopologySegment(20095974,463602083), TopologySegment(20095974,401451358)]
+    sc = SegmentChain(sl)
+    p = sc.shape_points()
+
+    s = ','.join( [str(q[0])+','+str(q[1]) for q in p] )
+    print(s)
+
+
+def test4():
+    s1 = TopologySegment(20095974,495758115)
+    s2 = TopologySegment(20095974,465574224)
+    s3 = TopologySegment(20095974,478099748)
+
+    sl = [s1,s2,s3]
+
+    #invert the order (optional)
+    #sl = sl[::-1]
+
+    sc = SegmentChain(sl)
+
+    p = sc.shape_points()
+    print( ','.join([str(q[0]) + ',' + str(q[1]) for q in p]) )
+
+    for seg in sl:
+        print(str(seg), sc.is_inverted(seg))
+
+if __name__=='__main__':
+    test4()
@@ -0,0 +1,196 @@
+"""
+Run a per-partition analysis over a whole city (a bounding box or a list of tiles) on all cores
+
+    from functools import partial
+    from hmctools import citywide, comparison
+    df, failures = citywide.run(partial(comparison.live_vs_historical, tz='Europe/Amsterdam'),
+                                bbox=(52.33673, 4.65416, 52.5, 5.08022))
+    df, failures = citywide.run(citywide.jam_summary, pids=[23602974, 23602975], layers=[])
+
+func is called as func(pid) in a worker process, and returns a DataFrame (or a (results, failures) pair of
+DataFrames, like live_vs_historical) ; it must be picklable, i.e. a module level function or a partial of one.
+
+How the work is split:
+    - first the raw blobs of every tile and of the tiles around them (which translate_segments needs for
+      traffic items that cross a border) are downloaded once, in the parent, into the persistent partition
+      store (see partitionstore.py). The workers read them from there, memory-mapped, so they share the disk
+      store and the page cache instead of each downloading the border tiles again.
+    - the tiles are sorted by tile id (a Morton code, so neighbours end up close together) and handed out in
+      small chunks of adjacent tiles, so a worker decodes a border tile once for all of its tiles that need it.
+    - every worker has its own in-memory caches ; nothing is shared or locked between the workers, which
+      is what lets a run scale with the number of cores.
+
+iter_results() streams (pid, results, failures or exception) back as chunks finish ; run() merges them into
+one table with a pid column, plus a table of failures (pid, reason) per tile.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+from . import fetch
+from . import partitionstore
+from . import spatial
+from .segment import LAYER_CLASSES, DEFAULT_PREFETCH_LAYERS, HmcAccess, LiveTrafficFlow, TopologyGeometry, \
+    neighbour_tiles, prefetch_partitions
+
+
+CHUNK_SIZE = 4  # tiles per task
+
+
+def city_tiles(bbox=None, pids=None):
+    """The sorted HMC tiles of a (south, west, north, east) box, or the given list of tiles"""
+    if pids is None:
+        if bbox is None:
+            raise ValueError('city_tiles: give a bbox or a list of pids')
+        pids = spatial.partitions_in_bbox(*bbox)
+    return sorted(set(int(q) for q in pids))
+
+
+def warm_store(pids, layers=DEFAULT_PREFETCH_LAYERS, neighbours=True, verbose=True):
+    """
+    Download the raw blobs of the (versioned) layers into the persistent partition store, without decoding
+    With neighbours=True the topology-geometry of the surrounding tiles is included.
+    Returns the number of blobs downloaded ; does nothing if the store is disabled.
+    """
+    store = partitionstore.get_default_store()
+    if store is None:
+        return 0
+    topo_pids = list(pids)
+    if neighbours:
+        for pid in pids:
+            topo_pids.extend(q for q in neighbour_tiles(pid) if q not in topo_pids)
+
+    fetcher = fetch.get_fetcher()
+    count = 0
+    for layer_id in layers:
+        accessor = LAYER_CLASSES[layer_id]
+        if not issubclass(accessor, HmcAccess):
+            continue  # volatile layers are not stored ; the workers read them themselves
+        layer_pids = topo_pids if layer_id == TopologyGeometry._layer_id else pids
+        version = accessor._hmc_version
+        todo = [q for q in layer_pids if store.get(accessor._catalog_hrn, layer_id, version, q) is None]
+        for pid, blob in fetcher.fetch_many(accessor._layer, todo, version, layer_id).items():
+            if isinstance(blob, fetch.FetchError):
+                continue  # e.g. open sea ; the worker reports it if it actually needs the tile
+            store.put(accessor._catalog_hrn, layer_id, version, pid, blob)
+            count += 1
+    if verbose:
+        print('%d tiles, %d blobs downloaded into the partition store' % (len(pids), count))
+    return count
+
+
+def _init_worker(store_root, store_max_bytes):
+    # a forked worker inherits the fetcher of the parent, but not its event loop thread
+    fetch.set_fetcher(None)
+    if store_root is not None:
+        partitionstore.set_default_store(partitionstore.PartitionStore(store_root, store_max_bytes))
+
+
+def _run_chunk(func, pids, layers):
+    """Work done in the worker processes: prefetch and analyse a chunk of adjacent tiles"""
+    if layers:
+        try:
+            prefetch_partitions(pids, layers, neighbours=True)
+        except Exception:
+            pass  # func will run into the same problem for the tile that has it, and report it there
+    output = []
+    for pid in pids:
+        try:
+            result = func(pid)
+        except Exception as e:
+            output.append((pid, None, '%s: %s' % (type(e).__name__, e)))
+            continue
+        if isinstance(result, tuple):
+            output.append((pid, result[0], result[1]))
+        else:
+            output.append((pid, result, None))
+    return output
+
+
+def iter_results(func, bbox=None, pids=None, processes=None, layers=DEFAULT_PREFETCH_LAYERS,
+                 chunk_size=CHUNK_SIZE, warm=True, verbose=True):
+    """
+    Run func(pid) for every tile on a process pool ; yields (pid, results, failures) in the order tiles finish
+    failures is None, a DataFrame returned by func, or the exception (as a string) if func raised.
+    layers are prefetched for every chunk of tiles (and warmed in the store first, unless warm is False).
+    """
+    pids = city_tiles(bbox, pids)
+    processes = processes or os.cpu_count() or 1
+    if warm:
+        warm_store(pids, layers, verbose=verbose)
+    store = partitionstore.get_default_store()
+    initargs = (store.root, store.max_bytes) if store is not None else (None, None)
+
+    chunks = [pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size)]
+    done_tiles = 0
+    failed_tiles = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=initargs) as pool:
+        pending = {pool.submit(_run_chunk, func, chunk, list(layers)): chunk for chunk in chunks}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:  # e.g. a worker that died
+                    results = [(pid, None, '%s: %s' % (type(e).__name__, e)) for pid in chunk]
+                for pid, df, failures in results:
+                    done_tiles += 1
+                    failed_tiles += df is None
+                    yield pid, df, failures
+                if verbose:
+                    print('%d/%d tiles, %d failed' % (done_tiles, len(pids), failed_tiles))
+
+
+def run(func, bbox=None, pids=None, processes=None, layers=DEFAULT_PREFETCH_LAYERS, chunk_size=CHUNK_SIZE,
+        warm=True, verbose=True):
+    """
+    Run func over all tiles (see iter_results) and merge the output
+    Returns (results, failures): the results of all tiles in one DataFrame with a pid column, and the
+    failures with columns pid, reason (plus whatever other columns func reported its failures with)
+    """
+    results = []
+    failures = []
+    for pid, df, failed in iter_results(func, bbox, pids, processes, layers, chunk_size, warm, verbose):
+        if df is not None and len(df) > 0:
+            results.append(_with_pid(df, pid))
+        if isinstance(failed, str):
+            failures.append(pd.DataFrame({'pid': [pid], 'reason': [failed]}))
+        elif failed is not None and len(failed) > 0:
+            failures.append(_with_pid(failed, pid))
+    df = pd.concat(results, ignore_index=True) if results else pd.DataFrame({'pid': []})
+    failures = pd.concat(failures, ignore_index=True) if failures else pd.DataFrame({'pid': [], 'reason': []})
+    return df, failures
+
+
+def _with_pid(df, pid):
+    if 'pid' not in df.columns:
+        df = df.copy()
+        df.insert(0, 'pid', pid)
+    return df
+
+
+JAM_EDGES = [0, 4, 6, 8, 10]
+
+
+def jam_summary(pid) -> pd.DataFrame:
+    """
+    Jam factor summary of one tile from the live traffic-flow: one row with the number of traffic items and flow
+    segments, mean and max jam factor, and the number of flow segments per jam band (see JAM_EDGES)
+    Only needs the traffic-flow, so run it with layers=[] to skip prefetching the RIB layers.
+    """
+    arrays = LiveTrafficFlow().get_arrays(pid)
+    jam = arrays.flows['jam_factor']
+    jam = jam[~np.isnan(jam)]
+    # same bands as TrafficFlowArrays.segments_by_jam_band: low < jam factor <= high
+    band = np.searchsorted(JAM_EDGES, jam, side='left') - 1
+    counts = np.bincount(band[(band >= 0) & (band < len(JAM_EDGES) - 1)], minlength=len(JAM_EDGES) - 1)
+    row = {'items': len(arrays), 'flows': len(arrays.flows),
+           'mean_jam_factor': float(jam.mean()) if len(jam) else np.nan,
+           'max_jam_factor': float(jam.max()) if len(jam) else np.nan}
+    for low, high, count in zip(JAM_EDGES[:-1], JAM_EDGES[1:], counts):
+        row['jam_%d_%d' % (low, high)] = int(count)
+    return pd.DataFrame([row])
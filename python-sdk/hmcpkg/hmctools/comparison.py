@@ -0,0 +1,201 @@
+"""
+Partition-wide comparison of live traffic speeds with the historical traffic patterns
+
+This is the report from the TrafficLiveHistoricalComp notebook, done as array operations over the whole partition
+instead of one TopologySegment round trip (and one pytz conversion) per segment:
+    - the attributes (accessible_by, travel_direction, functional_class) come from the batch lookups of HmcPartition
+    - the live speeds from the TrafficFlowArrays of the snapshot and chain.item_segment_offsets, with the same
+      matching rules as TopologySegment.live_traffic_info / get_live_traffic_speed
+    - the historical speeds from one lookup in the TrafficPatternMatrix
+
+    from hmctools.segment import HmcPartition
+    df, failures = HmcPartition(23602975).live_vs_historical('Europe/Amsterdam')
+
+Normally this is used through HmcPartition.live_vs_historical().
+"""
+
+import numpy as np
+import pandas as pd
+
+from . import chain
+from .segment import HmcPartition, LiveTrafficFlow, RoadAttributes, TopologyGeometry, TrafficPatterns, \
+    prefetch_partitions
+
+
+COLUMNS = ['segment', 'direction', 'FC', 'length', 'historical', 'live', 'residual']
+
+
+def _first_of_groups(*keys):
+    """Indices of the first element of every distinct combination of keys, in their original order"""
+    order = np.lexsort(tuple(reversed(keys)))  # stable, so the first of a group is its first in the input
+    same = np.ones(max(len(order) - 1, 0), dtype=bool)
+    for key in keys:
+        same &= key[order][1:] == key[order][:-1]
+    return np.sort(order[np.concatenate([[True], ~same])[:len(order)]])
+
+
+def live_speeds(pid, sids, directions, offset):
+    """
+    Live (timestamp, speed) at the offset of every (segment, direction) of the partition, as
+    TopologySegment.get_live_traffic_speed gives them one at a time
+    Returns arrays (timestamps, speeds, errors): NaN where there is no (matching) traffic item or no speed,
+    and the reason where get_live_traffic_speed would have raised (None elsewhere).
+    """
+    sids = np.asarray(sids, dtype=np.int64)
+    timestamps = np.full(len(sids), np.nan)
+    speeds = np.full(len(sids), np.nan)
+    errors = np.full(len(sids), None, dtype=object)
+
+    arrays = LiveTrafficFlow().get_arrays(pid)
+    table = chain.item_segment_offsets(pid, arrays)
+
+    # the first position of each of our segments in every traffic item, in item order (as the segment index
+    # of LiveTrafficFlow has them)
+    rows = np.flatnonzero(np.isin(table['sid'], sids))
+    rows = rows[_first_of_groups(table['item'][rows], table['sid'][rows])]
+    if len(rows) == 0:
+        return timestamps, speeds, errors
+    item = table['item'][rows].astype(np.int64)
+    sid = table['sid'][rows]
+    ptr = arrays.segment_ptr
+    count = ptr[item + 1] - ptr[item]
+    last_row = ptr[item + 1] - 1
+    info = arrays.items[item]
+    dd = info['in_driving_direction']
+    start_offset = info['start_offset'].astype(np.float64)
+    end_offset = info['end_offset'].astype(np.float64)
+    is_first = sid == arrays.segment_ids[ptr[item]]
+    is_last = sid == arrays.segment_ids[last_row]
+
+    # the cases of live_traffic_info ; forward is the orientation the item matches, covers whether it covers
+    # the offset, and broken where the (non-vectorized) code would have raised
+    single = count == 1
+    middle = (count > 2) & ~is_first & ~is_last
+    first = (count >= 2) & is_first
+    last = (count >= 2) & ~is_first & is_last
+    forward = np.zeros(len(rows), dtype=bool)
+    covers = np.zeros(len(rows), dtype=bool)
+    broken = np.full(len(rows), None, dtype=object)
+
+    rib_dd = HmcPartition(pid).travel_direction(sid, offset)
+    rib_forward = (rib_dd == 'BOTH') | (rib_dd == 'FORWARD')
+    aligned = dd == rib_forward
+    forward[single] = dd[single]
+    covers[single] = np.where(aligned, (offset >= start_offset) & (offset <= 1.0 - end_offset),
+                              (offset >= end_offset) & (offset <= 1.0 - start_offset))[single]
+    broken[single & pd.isnull(rib_dd)] = \
+        'AssertionError: ERROR in 1-segment TrafficItem logic. This should not happen'
+
+    # the segment is in the driving direction of the item if it is not inverted on its chain
+    forward[middle] = ~table['inverted'][rows[middle]]
+    covers[middle] = True
+    forward[first] = dd[first]
+    covers[first] = np.where(dd, offset >= start_offset, 1.0 - offset >= start_offset)[first]
+    last_forward = ~table['inverted'][last_row]
+    forward[last] = last_forward[last]
+    covers[last] = np.where(last_forward, offset <= 1.0 - end_offset, offset >= end_offset)[last]
+    unplaced = (middle & (table['pid'][rows] < 0)) | (last & (table['pid'][last_row] < 0))
+    broken[unplaced] = 'ValueError: traffic item could not be placed on the topology'
+
+    # an error in any of the items of a segment fails all of its directions
+    reasons = {}
+    for s, reason in zip(sid[pd.notnull(broken)].tolist(), broken[pd.notnull(broken)].tolist()):
+        reasons.setdefault(s, reason)
+    failed = np.isin(sids, list(reasons))
+    errors[failed] = [reasons[q] for q in sids[failed].tolist()]
+
+    # the first matching item of every (segment, orientation)
+    match = np.flatnonzero(covers & pd.isnull(broken))
+    match = match[_first_of_groups(sid[match], forward[match])]
+    keys = sid[match] * 2 + forward[match]
+    order = np.argsort(keys)
+    wanted = sids * 2 + (np.asarray(directions) == 'FORWARD')
+    at = np.clip(np.searchsorted(keys[order], wanted), 0, max(len(keys) - 1, 0))
+    found = np.flatnonzero((len(keys) > 0) & (keys[order][at] == wanted) & ~failed &
+                           np.isin(np.asarray(directions), ['FORWARD', 'BACKWARD']))
+    if len(found) == 0:
+        return timestamps, speeds, errors
+    chosen = match[order][at[found]]
+    chosen_item = item[chosen]
+    timestamps[found] = arrays.items['created'][chosen_item]
+
+    # the speed: of the only flow segment, or of the first flow segment (with a speed) at the offset on the item
+    flow_ptr = arrays.flow_ptr()
+    nflows = flow_ptr[chosen_item + 1] - flow_ptr[chosen_item]
+    one = nflows == 1
+    speeds[found[one]] = arrays.flows['speed'][flow_ptr[chosen_item[one]]]
+    several = np.flatnonzero(nflows > 1)
+    position = table['item_start'][rows[chosen[several]]] + offset * \
+        (table['item_end'][rows[chosen[several]]] - table['item_start'][rows[chosen[several]]])
+    errors[found[several[np.isnan(position)]]] = 'ValueError: traffic item could not be placed on the topology'
+    counts = nflows[several]
+    pair = np.repeat(np.arange(len(several)), counts)
+    flow_rows = np.repeat(flow_ptr[chosen_item[several]], counts) + np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    flows = arrays.flows[flow_rows]
+    ok = ~np.isnan(flows['speed']) & (flows['start_offset'] <= position[pair]) & (position[pair] <= flows['end_offset'])
+    pairs, first_ok = np.unique(pair[ok], return_index=True)
+    speeds[found[several[pairs]]] = flows['speed'][np.flatnonzero(ok)[first_ok]]
+    timestamps[pd.notnull(errors)] = np.nan
+    speeds[pd.notnull(errors)] = np.nan
+    return timestamps, speeds, errors
+
+
+def live_vs_historical(pid, tz, offset=0.5):
+    """
+    Compare live and historical speed at the given offset of every drivable segment (and direction) in the partition
+
+    Returns a pair of DataFrames:
+        results  -- one row per (segment, direction) with columns
+                    segment, direction, FC, length, historical, live, residual, live_time
+                    (historical/live/residual are NaN where there is no data)
+        failures -- one row per (segment, direction) that raised an exception, with columns
+                    segment, direction, reason
+    tz is the name of the local timezone of the partition, e.g. 'Europe/Amsterdam'
+    """
+    # one round trip for every layer we are going to touch, plus the neighbouring topology for
+    # traffic items that cross the partition border
+    prefetch_partitions([pid], neighbours=True)
+
+    partition = HmcPartition(pid)
+    segment_data = TopologyGeometry()._load_data(pid)
+    sids = np.fromiter(segment_data.keys(), dtype=np.int64, count=len(segment_data))
+    lengths = np.fromiter((q.length for q in segment_data.values()), dtype=np.float64, count=len(segment_data))
+
+    drivable = partition.accessible_by(sids, offset).astype(bool)
+    sids, lengths = sids[drivable], lengths[drivable]
+    dot = partition.travel_direction(sids, offset)
+    # functional class names end with the class number, e.g. FUNCTIONAL_CLASS_3 ; 0 where there is none
+    fc_names = RoadAttributes().get_intervals('functional_class', pid).values
+    fc_table = np.array([int(q[-1]) for q in fc_names] + [0], dtype=np.int64)
+    fc = fc_table[partition.attribute_values(RoadAttributes, 'functional_class', sids, offset, decode=False)]
+
+    # one row per direction: FORWARD and BACKWARD for segments open in both directions
+    both = dot == 'BOTH'
+    segment = np.repeat(np.arange(len(sids)), np.where(both, 2, 1))
+    second = np.concatenate([[False], segment[1:] == segment[:-1]])
+    direction = np.where(both[segment], np.where(second, 'BACKWARD', 'FORWARD').astype(object), dot[segment])
+
+    timestamps, live, errors = live_speeds(pid, sids[segment], direction, offset)
+    failed = pd.notnull(errors)
+    failures = pd.DataFrame({'segment': sids[segment][failed], 'direction': direction[failed],
+                             'reason': errors[failed]}, columns=['segment', 'direction', 'reason'])
+
+    ok = ~failed
+    df = pd.DataFrame({'segment': sids[segment][ok], 'direction': direction[ok], 'FC': fc[segment][ok],
+                       'length': lengths[segment][ok], 'live': live[ok]})
+    # convert all of the timestamps to local time at once
+    df['live_time'] = pd.to_datetime(timestamps[ok], unit='s', utc=True).tz_convert(tz)
+
+    # the historical speed is looked up at the local time of the live observation, for all rows at once
+    matrix = TrafficPatterns()._load_data(pid)
+    local_time = df['live_time']
+    epochs = ((local_time.dt.hour * 60 + local_time.dt.minute + local_time.dt.second / 60.0) // 5).fillna(0)
+    days = ((local_time.dt.dayofweek + 1) % 7).fillna(0)  # 0 = Sunday
+    historical = matrix.speeds(df['segment'].values, df['direction'].values, offset,
+                               epochs.values.astype(np.int64), days.values.astype(np.int64))
+    historical[local_time.isnull().values] = np.nan
+    df['historical'] = historical
+    df['residual'] = df['live'] - df['historical']
+
+    return df[COLUMNS + ['live_time']], failures
@@ -0,0 +1,91 @@
+"""
+A local stand-in for nagini catalogs and layers
+
+Useful for exercising the fetch engine and the caches without access to OLP:
+
+    layer = FakeLayer({'23602975': b'...'}, latency=0.2, failure_rate=0.3)
+    fetcher = PartitionFetcher(base_delay=0.01)
+    fetcher.fetch(layer, 23602975)
+    print(layer.calls)
+
+Only the parts of the nagini interface that hmctools uses are implemented.
+"""
+
+import random
+import threading
+import time
+
+
+class FakeSchema:
+    """
+    Stand-in for a nagini schema ; decode_blob applies the given decoder (default: return the raw bytes)
+    Like protobuf's ParseFromString it only accepts bytes (not memory maps or other buffers).
+    """
+
+    def __init__(self, decoder=None):
+        self.decoder = decoder
+
+    def decode_blob(self, blob):
+        if not isinstance(blob, bytes):
+            raise TypeError('expected bytes, %s found' % type(blob).__name__)
+        if self.decoder is None:
+            return blob
+        return self.decoder(blob)
+
+
+class FakeLayer:
+    """
+    Stand-in for a nagini layer serving blobs from memory
+
+    blobs is a dict of partition id (str) -> bytes, or of (partition id, version) -> bytes for versioned layers.
+    Every read_partitions call sleeps for latency seconds (plus up to jitter seconds) and then fails with
+    an IOError with probability failure_rate.
+    """
+
+    def __init__(self, blobs, latency=0.0, jitter=0.0, failure_rate=0.0, schema=None, seed=None):
+        self.blobs = blobs
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.schema = schema if schema is not None else FakeSchema()
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.requested = []  # every partition id that was asked for, in order
+
+    def _lookup(self, pid, version):
+        if (pid, version) in self.blobs:
+            return self.blobs[(pid, version)]
+        return self.blobs.get(pid)
+
+    def read_partitions(self, partition_ids, version=None):
+        with self._lock:
+            self.calls += 1
+            self.requested.extend(partition_ids)
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+
+        time.sleep(delay)
+        if fail:
+            raise IOError('FakeLayer: injected failure')
+
+        # nagini returns a generator ; partitions that do not exist are simply missing
+        return (self._lookup(str(q), version) for q in partition_ids if self._lookup(str(q), version) is not None)
+
+    def read_schema(self):
+        return self.schema
+
+
+class FakeCatalog:
+    """Stand-in for a nagini catalog: a dict of layer id -> FakeLayer"""
+
+    def __init__(self, hrn, layers):
+        self.hrn = hrn
+        self.layers = layers
+
+    def layer_by_id(self, layer_id):
+        return self.layers[layer_id]
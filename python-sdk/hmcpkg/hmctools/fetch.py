@@ -0,0 +1,199 @@
+"""
+Asyncio engine for fetching raw partition blobs from OLP
+
+nagini's read_partitions is blocking, so the actual calls run on a thread pool, but they are driven from
+an asyncio event loop (running in its own background thread) which gives us
+    - a bound on the number of requests in flight at the same time
+    - retries with exponential backoff and jitter (instead of a fixed sleep)
+    - an optional timeout per attempt, so one slow OLP response does not stall the caller forever
+      (the blocking call cannot be interrupted: it keeps its slot until it returns, so timed out attempts
+      never push the number of calls in flight over the bound)
+    - no retries for partitions that do not exist: those raise PartitionNotFound (a FetchError) right away
+    - single-flight de-duplication: concurrent requests for the same (layer, version, pid), from any
+      thread or coroutine, share one download
+
+There are sync and async entry points:
+
+    fetcher = get_fetcher()
+    blob = fetcher.fetch(layer, pid, version, layer_key='topology-geometry')            # from any thread
+    blob = await fetcher.afetch(layer, pid, version, layer_key='topology-geometry')     # from any event loop
+
+layer is anything with a nagini-style read_partitions(partition_ids, version) method, so the engine can be
+exercised against a FakeLayer from fakecatalog.py that injects latency and failures.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+class FetchError(Exception):
+    """Raised when a partition could not be fetched after all retries"""
+    pass
+
+
+class PartitionNotFound(FetchError):
+    """Raised (without retrying) when the layer has no data for the partition in that version"""
+    pass
+
+
+class PartitionFetcher:
+    """
+    Fetch raw partition blobs with bounded concurrency, backoff and single-flight de-duplication
+    """
+
+    def __init__(self, max_in_flight=8, max_tries=5, base_delay=0.5, max_delay=30.0, timeout=None):
+        self.max_in_flight = max_in_flight
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout  # seconds per attempt, None means wait forever
+
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='hmctools-fetch')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='hmctools-fetch-loop', daemon=True)
+        self._thread.start()
+
+        # these are only touched from inside the loop thread
+        self._semaphore = None
+        self._in_flight = {}  # (layer_key, version, pid) -> asyncio.Future
+
+        # simple counters, useful to check that de-duplication and retries do what they should
+        self.downloads = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    def _backoff(self, attempt) -> float:
+        """Delay before retry number attempt (0-based): exponential with full jitter"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _read_blocking(self, layer, pid, version):
+        blobs = list(layer.read_partitions([str(pid)], version))
+        if len(blobs) == 0:
+            raise PartitionNotFound('no data returned for partition ' + str(pid))
+        return blobs[0]
+
+    def _release(self, call):
+        # runs on the executor thread (or wherever the call was cancelled)
+        try:
+            self._loop.call_soon_threadsafe(self._semaphore.release)
+        except RuntimeError:  # the loop was closed
+            pass
+
+    async def _download(self, layer, pid, version, layer_key=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        last_error = None
+        for attempt in range(self.max_tries):
+            if attempt > 0:
+                self.retries += 1
+                metrics.count('retries', layer_key)
+                await asyncio.sleep(self._backoff(attempt - 1))
+            await self._semaphore.acquire()
+            start = time.perf_counter()
+            try:
+                call = self._executor.submit(self._read_blocking, layer, pid, version)
+            except BaseException:
+                self._semaphore.release()
+                raise
+            # the slot is given back when the thread is done, not when wait_for gives up on it
+            call.add_done_callback(self._release)
+            try:
+                blob = await asyncio.wait_for(asyncio.wrap_future(call, loop=self._loop), self.timeout)
+                self.downloads += 1
+                metrics.record('fetch', layer_key, time.perf_counter() - start, len(blob), pid)
+                return blob
+            except PartitionNotFound:
+                raise  # asking again will not make it appear
+            except Exception as e:  # nagini does not document what it raises, so retry on anything
+                last_error = e
+                metrics.count('fetch_errors', layer_key)
+        raise FetchError('failed to fetch partition %s after %d tries: %r' % (pid, self.max_tries, last_error))
+
+    async def _fetch(self, layer, pid, version, layer_key):
+        key = (layer_key if layer_key is not None else id(layer), version, pid)
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            metrics.count('coalesced', layer_key)
+            return await asyncio.shield(future)
+
+        future = self._loop.create_future()
+        self._in_flight[key] = future
+        try:
+            blob = await self._download(layer, pid, version, layer_key)
+            future.set_result(blob)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            del self._in_flight[key]
+        # retrieve the result through the future so the exception is marked as retrieved
+        return future.result()
+
+    def _submit(self, layer, pid, version, layer_key):
+        return asyncio.run_coroutine_threadsafe(self._fetch(layer, pid, version, layer_key), self._loop)
+
+    def fetch(self, layer, pid, version=None, layer_key=None):
+        """
+        Blocking fetch of one raw blob. layer_key (e.g. the layer id) identifies the layer for de-duplication;
+        if it is not given, requests are only coalesced when they use the same layer object.
+        Raises FetchError if the partition could not be fetched.
+        """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('PartitionFetcher.fetch() called from its own event loop; use afetch()')
+        return self._submit(layer, pid, version, layer_key).result()
+
+    async def afetch(self, layer, pid, version=None, layer_key=None):
+        """Awaitable version of fetch(), usable from any event loop"""
+        return await asyncio.wrap_future(self._submit(layer, pid, version, layer_key))
+
+    async def afetch_many(self, layer, pids, version=None, layer_key=None):
+        """Fetch several partitions concurrently ; returns a dict pid -> blob (or the FetchError for that pid)"""
+        results = await asyncio.gather(*[self.afetch(layer, pid, version, layer_key) for pid in pids],
+                                       return_exceptions=True)
+        return dict(zip(pids, results))
+
+    def fetch_many(self, layer, pids, version=None, layer_key=None):
+        """Blocking version of afetch_many()"""
+        futures = [self._submit(layer, pid, version, layer_key) for pid in pids]
+        output = {}
+        for pid, future in zip(pids, futures):
+            try:
+                output[pid] = future.result()
+            except FetchError as e:
+                output[pid] = e
+        return output
+
+    def close(self):
+        """Stop the event loop and the worker threads"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=False)
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher() -> PartitionFetcher:
+    """Return the fetcher shared by all of hmctools, creating it on first use"""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = PartitionFetcher()
+        return _fetcher
+
+
+def set_fetcher(fetcher):
+    """Replace the shared fetcher, e.g. with one that has a different concurrency limit or timeout"""
+    global _fetcher
+    with _fetcher_lock:
+        _fetcher = fetcher
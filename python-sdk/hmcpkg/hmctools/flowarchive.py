@@ -0,0 +1,488 @@
+"""
+Recorder and on-disk archive of traffic-flow snapshots
+
+LiveTrafficFlow only ever has the current snapshot of the volatile traffic-flow layer. FlowRecorder polls the
+layer for a set of partitions on a schedule and appends every snapshot that changed (by the sha256 of the raw
+blob) to a FlowArchive, which keeps them compact and can replay them into the same API as the live data:
+
+    from hmctools import flowarchive
+    archive = flowarchive.FlowArchive('flow-archive')
+    recorder = flowarchive.FlowRecorder(archive, [23602974, 23602975], interval=60)
+    recorder.run(duration=24 * 3600)        # or recorder.poll() from a scheduler of your own
+
+    for timestamp, arrays in archive.read(23602975, start, end):    # trafficflow.TrafficFlowArrays
+        ...
+    with archive.replay(datetime.datetime(2019, 8, 27, 17, 30)):
+        df, failures = HmcPartition(23602975).live_vs_historical(tz='Europe/Amsterdam')
+
+Layout of the archive directory (append-only, partitioned by tile and UTC hour):
+    <pid>/<YYYY-MM-DD>/<HH>.flow    the snapshots of one tile in one hour, as a sequence of records
+
+A record is a fixed header (magic, kind, snapshot time, payload length, sha256 of the raw blob) followed by
+a zlib-compressed set of columns (the TrafficFlowArrays of the snapshot). The first record of a file is a key
+record with all columns ; the others are deltas against the previous snapshot in the file:
+    new, match  for every traffic item, whether it is new, or else the row of the same item (same id, segments
+                and offsets) in the previous snapshot ; only new items store their id, segments and offsets
+    created, updated    difference with the matched item (with the snapshot time for new items)
+    is_active   of every item
+    flow_changed        only the items whose flow segments changed store them
+so a reader decodes a file from its start. Times are seconds since the epoch, or datetimes (naive ones are UTC).
+A record that was cut off (e.g. by a crash while writing) is ignored, and overwritten by the next append.
+Only one process should write to an archive at a time.
+"""
+
+import calendar
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from . import cache
+from . import fetch
+from . import metrics
+from .segment import LiveTrafficFlow
+from .trafficflow import FLOW_DTYPE, ITEM_DTYPE, TrafficFlowArrays
+
+
+MAGIC = b'HTF1'
+KEY = 0
+DELTA = 1
+# magic, kind, snapshot time, payload length, sha256 of the raw blob
+HEADER = struct.Struct('<4sBqI32s')
+FLOW_FIELDS = ['start_offset', 'jam_factor', 'speed', 'free_flow_speed', 'confidence']
+COMPRESSION = 6  # zlib level
+MAX_AGE = 24 * 3600  # snapshot() looks back at most this many seconds
+
+
+def as_epoch(t) -> int:
+    """Seconds since the epoch of a datetime (naive ones are UTC) or a number"""
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is None:
+            return calendar.timegm(t.timetuple())
+        return int(t.timestamp())
+    return int(t)
+
+
+def _pack(columns) -> bytes:
+    """Serialize a dict of name -> 1-d array"""
+    names = sorted(columns)
+    arrays = [np.ascontiguousarray(columns[name]) for name in names]
+    meta = json.dumps([(name, q.dtype.str, len(q)) for name, q in zip(names, arrays)]).encode()
+    return struct.pack('<I', len(meta)) + meta + b''.join(q.tobytes() for q in arrays)
+
+
+def _unpack(data) -> dict:
+    size = struct.unpack_from('<I', data)[0]
+    position = 4 + size
+    output = {}
+    for name, dtype, length in json.loads(data[4:position].decode()):
+        dtype = np.dtype(dtype)
+        output[name] = np.frombuffer(data, dtype=dtype, count=length, offset=position)
+        position += dtype.itemsize * length
+    return output
+
+
+def _item_keys(arrays):
+    """Identity of every traffic item: its id, segments, offsets and driving direction"""
+    items, ptr, ids = arrays.items, arrays.segment_ptr, arrays.segment_ids
+    return [arrays.item_ids[i].encode() + b'\0' + ids[ptr[i]:ptr[i + 1]].tobytes() +
+            struct.pack('<ff?', items['start_offset'][i], items['end_offset'][i], items['in_driving_direction'][i])
+            for i in range(len(items))]
+
+
+def encode(arrays, timestamp, previous=None) -> dict:
+    """The columns of a snapshot ; a delta against previous (the TrafficFlowArrays of the last record) if given"""
+    n = len(arrays.items)
+    if previous is not None:
+        rows = {key: row for row, key in enumerate(_item_keys(previous))}
+        match = np.array([rows.get(key, -1) for key in _item_keys(arrays)], dtype=np.int32)
+    else:
+        match = np.full(n, -1, dtype=np.int32)
+    new = match < 0
+    old_rows = np.maximum(match, 0)
+
+    # items mostly keep their order, so the distance to the matched row is mostly constant
+    columns = {'new': new, 'match': (match - np.arange(n, dtype=np.int32))[~new]}
+    for name in ['created', 'updated']:
+        base = np.full(n, timestamp, dtype=np.int64)
+        if previous is not None:
+            base[~new] = previous.items[name][old_rows[~new]]
+        columns[name] = arrays.items[name] - base
+    for name in ['start_offset', 'end_offset', 'in_driving_direction']:
+        columns[name] = arrays.items[name][new]
+    columns['item_ids'] = arrays.item_ids[new]
+    columns['is_active'] = arrays.items['is_active']
+    counts = np.diff(arrays.segment_ptr)
+    columns['segment_count'] = counts[new].astype(np.int32)
+    ids = np.concatenate([arrays.item_segments(i) for i in np.flatnonzero(new)]) if new.any() else \
+        np.zeros(0, dtype=np.int64)
+    columns['segment_ids'] = np.diff(ids, prepend=0)  # neighbouring segments have close ids
+
+    ptr = arrays.flow_ptr()
+    changed = new.copy()
+    if previous is not None:
+        old_ptr = previous.flow_ptr()
+        fields = [arrays.flows[q] for q in FLOW_FIELDS]
+        old_fields = [previous.flows[q] for q in FLOW_FIELDS]
+        for i in np.flatnonzero(~new).tolist():
+            lo, hi, old_lo, old_hi = ptr[i], ptr[i + 1], old_ptr[match[i]], old_ptr[match[i] + 1]
+            changed[i] = hi - lo != old_hi - old_lo or \
+                any(not np.array_equal(f[lo:hi], g[old_lo:old_hi], equal_nan=True) for f, g in zip(fields, old_fields))
+    columns['flow_changed'] = changed
+    columns['flow_count'] = np.diff(ptr)[changed].astype(np.int32)
+    rows = np.concatenate([np.arange(ptr[i], ptr[i + 1]) for i in np.flatnonzero(changed)]) if changed.any() else \
+        np.zeros(0, dtype=np.int64)
+    for name in FLOW_FIELDS:
+        columns['flow_' + name] = arrays.flows[name][rows]
+    return columns
+
+
+def decode(columns, timestamp, previous=None) -> TrafficFlowArrays:
+    """The TrafficFlowArrays of a snapshot from its columns (and the snapshot before it, for a delta)"""
+    new = columns['new']
+    n = len(new)
+    match = np.full(n, -1, dtype=np.int64)
+    match[~new] = np.flatnonzero(~new) + columns['match']
+    old = np.flatnonzero(~new)
+    old_rows = match[old]
+
+    items = np.zeros(n, dtype=ITEM_DTYPE)
+    for name in ['created', 'updated']:
+        base = np.full(n, timestamp, dtype=np.int64)
+        base[old] = previous.items[name][old_rows] if len(old) else base[old]
+        items[name] = base + columns[name]
+    for name in ['start_offset', 'end_offset', 'in_driving_direction']:
+        items[name][new] = columns[name]
+        if len(old):
+            items[name][old] = previous.items[name][old_rows]
+    items['is_active'] = columns['is_active']
+    item_ids = np.zeros(n, dtype=columns['item_ids'].dtype if previous is None else
+                        np.promote_types(columns['item_ids'].dtype, previous.item_ids.dtype))
+    item_ids[new] = columns['item_ids']
+    if len(old):
+        item_ids[old] = previous.item_ids[old_rows]
+
+    counts = np.zeros(n, dtype=np.int64)
+    counts[new] = columns['segment_count']
+    if len(old):
+        counts[old] = np.diff(previous.segment_ptr)[old_rows]
+    segment_ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    new_ids = np.cumsum(columns['segment_ids'])
+    new_ptr = np.concatenate([[0], np.cumsum(columns['segment_count'], dtype=np.int64)])
+    parts = []
+    k = 0
+    for i in range(n):
+        if new[i]:
+            parts.append(new_ids[new_ptr[k]:new_ptr[k + 1]])
+            k += 1
+        else:
+            parts.append(previous.item_segments(match[i]))
+    segment_ids = np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+
+    changed = columns['flow_changed']
+    new_flow_ptr = np.concatenate([[0], np.cumsum(columns['flow_count'], dtype=np.int64)])
+    old_flow_ptr = previous.flow_ptr() if previous is not None else None
+    blocks = []  # (item, source, lo, hi) ; source 0 = this record, 1 = previous snapshot
+    k = 0
+    for i in range(n):
+        if changed[i]:
+            blocks.append((i, 0, new_flow_ptr[k], new_flow_ptr[k + 1]))
+            k += 1
+        else:
+            blocks.append((i, 1, old_flow_ptr[match[i]], old_flow_ptr[match[i] + 1]))
+    flows = np.zeros(sum(hi - lo for _, _, lo, hi in blocks), dtype=FLOW_DTYPE)
+    position = 0
+    for i, source, lo, hi in blocks:
+        if hi == lo:
+            continue
+        rows = slice(position, position + hi - lo)
+        flows['item'][rows] = i
+        for name in FLOW_FIELDS:
+            flows[name][rows] = columns['flow_' + name][lo:hi] if source == 0 else previous.flows[name][lo:hi]
+        position += hi - lo
+    # the end of a flow segment is the start of the next one of the item, or 1.0
+    last = np.ones(len(flows), dtype=bool)
+    last[:-1] = flows['item'][1:] != flows['item'][:-1]
+    flows['end_offset'] = np.where(last, 1.0, np.append(flows['start_offset'][1:], 1.0))
+    return TrafficFlowArrays(items, segment_ptr, segment_ids, flows, item_ids)
+
+
+def _set(message, name, value):
+    """Set a numeric field, unless the value is missing (NaN), so that the field stays unset"""
+    if not np.isnan(value):
+        setattr(message, name, float(value))
+
+
+def as_parsed(arrays, partition):
+    """
+    Fill partition, an empty decoded traffic-flow partition of the layer schema (see empty_partition), with the
+    traffic items of a TrafficFlowArrays and return it, e.g. to put an archived snapshot in place of the live one
+    Only the fields that TrafficFlowArrays keeps are set ; missing values are left unset.
+    """
+    items, flows = arrays.items, arrays.flows
+    ptr = arrays.flow_ptr()
+    for i in range(len(items)):
+        item = partition.items.add()
+        item.id = str(arrays.item_ids[i])
+        item.created_timestamp = int(items['created'][i])
+        item.updated_timestamp = int(items['updated'][i])
+        item.is_active = bool(items['is_active'][i])
+        ts = item.topology_segment
+        ts.topology_segment_id.extend(arrays.item_segments(i).tolist())
+        ts.start_offset = float(items['start_offset'][i])
+        ts.end_offset = float(items['end_offset'][i])
+        ts.is_first_segment_in_driving_direction = bool(items['in_driving_direction'][i])
+        if ptr[i + 1] == ptr[i]:
+            continue
+        _set(item.flow, 'confidence', flows['confidence'][ptr[i]])  # the same for all flow rows of the item
+        for row in range(ptr[i], ptr[i + 1]):
+            segment = item.flow.segment.add()
+            segment.start_offset = float(flows['start_offset'][row])
+            _set(segment, 'jam_factor', flows['jam_factor'][row])
+            if not (np.isnan(flows['speed'][row]) and np.isnan(flows['free_flow_speed'][row])):
+                _set(segment.speed, 'average_speed_kph', flows['speed'][row])
+                _set(segment.speed, 'free_flow_speed_kph', flows['free_flow_speed'][row])
+    return partition
+
+
+def empty_partition():
+    """An empty traffic-flow partition message of the layer schema (an empty blob is a valid protobuf message)"""
+    return LiveTrafficFlow._schema.decode_blob(b'')
+
+
+class FlowArchive:
+    """
+    Append-only archive of traffic-flow snapshots, one file per tile and hour (see module docstring)
+    """
+
+    def __init__(self, root, compression=COMPRESSION):
+        self.root = root
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._last = {}  # pid -> (path, TrafficFlowArrays, digest) of the last record this process wrote
+        self._checked = set()  # files that were checked for a cut off last record
+
+    def path(self, pid, timestamp) -> str:
+        t = datetime.datetime.utcfromtimestamp(as_epoch(timestamp))
+        return os.path.join(self.root, str(pid), t.strftime('%Y-%m-%d'), t.strftime('%H') + '.flow')
+
+    @staticmethod
+    def _headers(path):
+        """[(kind, timestamp, digest, payload offset, payload length), ...] of the complete records of a file"""
+        output = []
+        if not os.path.exists(path):
+            return output
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fh:
+            position = 0
+            while position + HEADER.size <= size:
+                fh.seek(position)
+                magic, kind, timestamp, length, digest = HEADER.unpack(fh.read(HEADER.size))
+                if magic != MAGIC or position + HEADER.size + length > size:
+                    break
+                output.append((kind, timestamp, digest, position + HEADER.size, length))
+                position += HEADER.size + length
+        return output
+
+    def _records(self, path):
+        """Yield (timestamp, digest, TrafficFlowArrays) for every record of a file"""
+        headers = self._headers(path)
+        if not headers:
+            return
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        previous = None
+        for kind, timestamp, digest, position, length in headers:
+            with metrics.timed('decode', 'traffic-flow-archive', None, length):
+                columns = _unpack(zlib.decompress(data[position:position + length]))
+                previous = decode(columns, timestamp, previous if kind == DELTA else None)
+            yield timestamp, digest, previous
+
+    def append(self, pid, timestamp, arrays, digest=b''):
+        """Add the snapshot of a tile at time timestamp (snapshots of a tile must be appended in time order)"""
+        timestamp = as_epoch(timestamp)
+        path = self.path(pid, timestamp)
+        with self._lock:
+            last = self._last.get(pid)
+            previous = last[1] if last is not None and last[0] == path else None
+            payload = zlib.compress(_pack(encode(arrays, timestamp, previous)), self.compression)
+            record = HEADER.pack(MAGIC, KEY if previous is None else DELTA, timestamp, len(payload),
+                                 digest.ljust(32, b'\0')) + payload
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if path not in self._checked:
+                # drop a record that was cut off, so that this one is not appended behind it
+                headers = self._headers(path)
+                end = headers[-1][3] + headers[-1][4] if headers else 0
+                if os.path.exists(path) and os.path.getsize(path) > end:
+                    with open(path, 'r+b') as fh:
+                        fh.truncate(end)
+                self._checked.add(path)
+            with open(path, 'ab') as fh:
+                fh.write(record)
+            self._last[pid] = (path, arrays, digest.ljust(32, b'\0'))
+        metrics.count('snapshots_stored', 'traffic-flow')
+        return len(record)
+
+    def _files(self, pid, start=None, end=None):
+        """The files of a tile that can have snapshots between start and end, in time order"""
+        directory = os.path.join(self.root, str(pid))
+        if not os.path.isdir(directory):
+            return []
+        first = self.path(pid, start) if start is not None else None
+        last = self.path(pid, end) if end is not None else None
+        output = []
+        for day in sorted(os.listdir(directory)):
+            for name in sorted(os.listdir(os.path.join(directory, day))):
+                path = os.path.join(directory, day, name)
+                if (first is None or path >= first) and (last is None or path <= last):
+                    output.append(path)
+        return output
+
+    def last_digest(self, pid):
+        """sha256 of the raw blob of the last snapshot of a tile, or None"""
+        last = self._last.get(pid)
+        if last is not None:
+            return last[2]
+        for path in reversed(self._files(pid)):
+            headers = self._headers(path)
+            if headers:
+                return headers[-1][2]
+        return None
+
+    def pids(self):
+        """The tiles in the archive"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(q) for q in os.listdir(self.root) if q.isdigit())
+
+    def timestamps(self, pid, start=None, end=None):
+        """The times of the snapshots of a tile between start and end (inclusive), without decoding them"""
+        start = as_epoch(start) if start is not None else None
+        end = as_epoch(end) if end is not None else None
+        return [q[1] for path in self._files(pid, start, end) for q in self._headers(path)
+                if (start is None or q[1] >= start) and (end is None or q[1] <= end)]
+
+    def read(self, pid, start=None, end=None):
+        """Yield (timestamp, TrafficFlowArrays) of the snapshots of a tile between start and end (inclusive)"""
+        start = as_epoch(start) if start is not None else None
+        end = as_epoch(end) if end is not None else None
+        for path in self._files(pid, start, end):
+            for timestamp, _, arrays in self._records(path):
+                if end is not None and timestamp > end:
+                    return
+                if start is None or timestamp >= start:
+                    yield timestamp, arrays
+
+    def snapshot(self, pid, at, max_age=MAX_AGE):
+        """(timestamp, TrafficFlowArrays) of the last snapshot of a tile at or before at, or None"""
+        at = as_epoch(at)
+        for path in reversed(self._files(pid, at - max_age, at)):
+            found = None
+            for timestamp, _, arrays in self._records(path):
+                if timestamp > at:
+                    break
+                found = (timestamp, arrays)
+            if found is not None:
+                return found
+        return None
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the archive on disk"""
+        return sum(os.path.getsize(os.path.join(d, q)) for d, _, files in os.walk(self.root) for q in files)
+
+    @contextlib.contextmanager
+    def replay(self, at, pids=None):
+        """
+        Make LiveTrafficFlow (and everything built on it: the TopologySegment traffic accessors, live_vs_historical,
+        citywide.jam_summary, ...) serve the archived snapshots at time at instead of the live layer
+        get_arrays() returns the archived TrafficFlowArrays, the decoded partition is rebuilt from them as messages
+        of the layer schema (see as_parsed).
+        pids default to all tiles in the archive ; tiles without a snapshot are left to the live layer.
+        """
+        flow = LiveTrafficFlow()
+        names = [LiveTrafficFlow._data.name, LiveTrafficFlow._arrays.name]
+        ttls = [cache.get_cache(name).ttl for name in names]
+        for name in names:
+            cache.configure(name, ttl=None)  # the snapshots must not expire while they are used
+        try:
+            for pid in (pids if pids is not None else self.pids()):
+                found = self.snapshot(pid, at)
+                if found is None:
+                    continue
+                arrays = found[1]
+                # the array based accessors get the snapshot as it is, the others the same items as schema messages
+                flow._arrays.put(pid, arrays, arrays.nbytes)
+                flow._ingest(pid, as_parsed(arrays, empty_partition()))
+            yield self
+        finally:
+            for name, ttl in zip(names, ttls):
+                cache.invalidate(name)
+                cache.configure(name, ttl=ttl)
+
+
+class FlowRecorder:
+    """
+    Poll the traffic-flow layer for a set of tiles and append the snapshots that changed to a FlowArchive
+    """
+
+    def __init__(self, archive, pids, interval=60.0, verbose=False):
+        self.archive = archive
+        self.pids = [int(q) for q in pids]
+        self.interval = interval
+        self.verbose = verbose
+        self.stored = 0
+        self.unchanged = 0
+        self.errors = 0
+        self._stop = threading.Event()
+
+    def poll(self, now=None) -> int:
+        """Fetch every tile once and archive the changed snapshots at time now (default: now) ; returns how many"""
+        now = as_epoch(now) if now is not None else int(time.time())
+        layer_id = LiveTrafficFlow._layer_id
+        blobs = fetch.get_fetcher().fetch_many(LiveTrafficFlow._layer, self.pids, None, layer_id)
+        stored = 0
+        for pid, blob in blobs.items():
+            if isinstance(blob, fetch.FetchError):
+                self.errors += 1
+                print('FlowRecorder: failure getting data', pid, blob)
+                continue
+            digest = hashlib.sha256(blob).digest()
+            if digest == self.archive.last_digest(pid):
+                self.unchanged += 1
+                metrics.count('snapshots_unchanged', layer_id)
+                continue
+            try:
+                with metrics.timed('decode', layer_id, pid, len(blob)):
+                    parsed = LiveTrafficFlow._schema.decode_blob(blob)
+            except Exception:  # see CatalogAccess.read_data
+                self.errors += 1
+                print('FlowRecorder: unexpected error decoding blob', pid)
+                continue
+            self.archive.append(pid, now, TrafficFlowArrays.from_parsed(parsed), digest)
+            stored += 1
+        self.stored += stored
+        if self.verbose:
+            print('%s: %d of %d tiles changed' % (datetime.datetime.utcfromtimestamp(now), stored, len(self.pids)))
+        return stored
+
+    def run(self, duration=None):
+        """Poll every interval seconds, for duration seconds (default: until stop() is called)"""
+        self._stop.clear()
+        end = time.monotonic() + duration if duration is not None else None
+        while not self._stop.is_set() and (end is None or time.monotonic() < end):
+            start = time.monotonic()
+            self.poll()
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - start)))
+
+    def stop(self):
+        """Make run() return after the current poll"""
+        self._stop.set()
@@ -0,0 +1,216 @@
+"""
+Compact road graph of the topology-geometry layer
+
+TopologyGeometry normally keeps every decoded protobuf Segment, and every node as a list of (pid, sid) tuples.
+RoadGraph keeps the same information in flat arrays instead:
+    segments (one row per segment, sorted by (pid, sid))
+        pid, sid, length, start node (pid, nid), end node (pid, nid)
+        point_ptr / points: the shape points of segment k are points[point_ptr[k]:point_ptr[k + 1]] (CSR style)
+    nodes (one row per node, sorted by (pid, nid))
+        pid, nid
+        adj_ptr / adj_pid / adj_sid: the segments connected to node k are rows adj_ptr[k]:adj_ptr[k + 1]
+(pid, sid) and (pid, nid) are found with a binary search on a combined key, so lengths, nodes and adjacency
+are array lookups, also for many segments at once. The graphs of several tiles can be merged into one.
+
+    from hmctools.segment import TopologyGeometry
+    g = TopologyGeometry().get_graph(23602975)          # or set TopologyGeometry.compact = True
+    g.lengths(pids, sids)
+    g.connected_segments(pid, nid)
+"""
+
+import numpy as np
+
+
+KEY_BITS = 40  # segment and node IDs are less than 2 ** 40 ; the partition goes in the bits above
+
+
+class RoadGraph:
+    """
+    Segments, nodes and node -> segment adjacency of one or more partitions as arrays (see module docstring)
+    """
+
+    ARRAYS = ['seg_pid', 'seg_sid', 'length', 'start_pid', 'start_nid', 'end_pid', 'end_nid', 'point_ptr',
+              'points', 'node_pid', 'node_nid', 'adj_ptr', 'adj_pid', 'adj_sid']
+
+    def __init__(self, seg_pid, seg_sid, length, start_pid, start_nid, end_pid, end_nid, point_ptr, points,
+                 node_pid, node_nid, adj_ptr, adj_pid, adj_sid):
+        self.seg_pid = seg_pid
+        self.seg_sid = seg_sid
+        self.length = length
+        self.start_pid = start_pid
+        self.start_nid = start_nid
+        self.end_pid = end_pid
+        self.end_nid = end_nid
+        self.point_ptr = point_ptr
+        self.points = points
+        self.node_pid = node_pid
+        self.node_nid = node_nid
+        self.adj_ptr = adj_ptr
+        self.adj_pid = adj_pid
+        self.adj_sid = adj_sid
+
+        self.partitions = np.unique(np.concatenate([seg_pid, node_pid]))
+        self._seg_keys = self._keys(seg_pid, seg_sid)
+        self._node_keys = self._keys(node_pid, node_nid)
+
+    def _keys(self, pids, ids):
+        """Combined sortable key of (pid, id) pairs ; -1 for partitions that are not in the graph"""
+        pids = np.asarray(pids, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.partitions) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        code = np.searchsorted(self.partitions, pids)
+        known = (code < len(self.partitions)) & (self.partitions[np.minimum(code, len(self.partitions) - 1)] == pids)
+        return np.where(known, (code.astype(np.int64) << KEY_BITS) | ids, -1)
+
+    @classmethod
+    def from_parsed(cls, pid, parsed, id2int):
+        """
+        Build the graph of one decoded topology-geometry partition
+        (id2int is passed in from segment.py to avoid a circular import)
+        """
+        rows = []
+        points = []
+        for seg in parsed.segment:
+            start, end = seg.start_node_ref, seg.end_node_ref
+            rows.append((id2int(seg.identifier), seg.length, int(start.partition_name), id2int(start.identifier),
+                         int(end.partition_name), id2int(end.identifier)))
+            points.append([(q.latitude, q.longitude) for q in seg.geometry.point])
+        order = sorted(range(len(rows)), key=lambda k: rows[k][0])
+        rows = [rows[k] for k in order]
+        points = [points[k] for k in order]
+
+        nodes = sorted((id2int(n.identifier), [(int(q.partition_name), id2int(q.identifier)) for q in n.segment_ref])
+                       for n in parsed.node)
+
+        def column(values, dtype):
+            return np.array(values, dtype=dtype)
+
+        counts = [len(q) for q in points]
+        adjacency = [q for _, refs in nodes for q in refs]
+        return cls(np.full(len(rows), pid, dtype=np.int64), column([q[0] for q in rows], np.int64),
+                   column([q[1] for q in rows], np.float64),
+                   column([q[2] for q in rows], np.int64), column([q[3] for q in rows], np.int64),
+                   column([q[4] for q in rows], np.int64), column([q[5] for q in rows], np.int64),
+                   np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).astype(np.int64),
+                   np.array([p for q in points for p in q], dtype=np.float64).reshape(-1, 2),
+                   np.full(len(nodes), pid, dtype=np.int64), column([q[0] for q in nodes], np.int64),
+                   np.concatenate([[0], np.cumsum([len(q[1]) for q in nodes], dtype=np.int64)]).astype(np.int64),
+                   column([q[0] for q in adjacency], np.int64), column([q[1] for q in adjacency], np.int64))
+
+    @classmethod
+    def merge(cls, graphs):
+        """Combine the graphs of several (different) partitions into one"""
+        graphs = [q for q in graphs if q is not None]
+        if not graphs:
+            raise ValueError('RoadGraph.merge: nothing to merge')
+        seg_pid = np.concatenate([q.seg_pid for q in graphs])
+        seg_order = np.lexsort((np.concatenate([q.seg_sid for q in graphs]), seg_pid))
+        node_pid = np.concatenate([q.node_pid for q in graphs])
+        node_order = np.lexsort((np.concatenate([q.node_nid for q in graphs]), node_pid))
+
+        def take(name, order):
+            return np.concatenate([getattr(q, name) for q in graphs])[order]
+
+        def ragged(ptr_name, value_names, order):
+            # reorder the CSR rows, keeping every row's values together
+            counts = np.concatenate([np.diff(getattr(q, ptr_name)) for q in graphs])
+            starts = np.concatenate([getattr(q, ptr_name)[:-1] + o for q, o in
+                                     zip(graphs, np.cumsum([0] + [getattr(q, ptr_name)[-1] for q in graphs[:-1]]))])
+            counts, starts = counts[order], starts[order]
+            ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            index = np.repeat(starts - ptr[:-1], counts) + np.arange(ptr[-1])
+            return [ptr] + [np.concatenate([getattr(q, name) for q in graphs])[index] for name in value_names]
+
+        point_ptr, points = ragged('point_ptr', ['points'], seg_order)
+        adj_ptr, adj_pid, adj_sid = ragged('adj_ptr', ['adj_pid', 'adj_sid'], node_order)
+        return cls(seg_pid[seg_order], take('seg_sid', seg_order), take('length', seg_order),
+                   take('start_pid', seg_order), take('start_nid', seg_order), take('end_pid', seg_order),
+                   take('end_nid', seg_order), point_ptr, points, node_pid[node_order], take('node_nid', node_order),
+                   adj_ptr, adj_pid, adj_sid)
+
+    def __len__(self):
+        return len(self.seg_sid)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS) + self._seg_keys.nbytes + \
+            self._node_keys.nbytes
+
+    def segment_rows(self, pids, sids) -> np.ndarray:
+        """Vectorized row of every (pid, sid) ; -1 for segments that are not in the graph"""
+        keys = self._keys(np.broadcast_to(np.asarray(pids, dtype=np.int64), np.shape(sids)), sids)
+        return self._find(self._seg_keys, np.atleast_1d(keys))
+
+    def node_rows(self, pids, nids) -> np.ndarray:
+        """Vectorized row of every (pid, nid) ; -1 for nodes that are not in the graph"""
+        keys = self._keys(np.broadcast_to(np.asarray(pids, dtype=np.int64), np.shape(nids)), nids)
+        return self._find(self._node_keys, np.atleast_1d(keys))
+
+    @staticmethod
+    def _find(sorted_keys, keys):
+        if len(sorted_keys) == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where((keys >= 0) & (sorted_keys[rows] == keys), rows, -1)
+
+    def _segment_row(self, pid, sid):
+        row = int(self.segment_rows(pid, [sid])[0])
+        return row if row >= 0 else None
+
+    def __contains__(self, pid_sid):
+        return self._segment_row(*pid_sid) is not None
+
+    def segment_ids(self, pid) -> np.ndarray:
+        """The (sorted) segment IDs of one partition"""
+        lo, hi = np.searchsorted(self.seg_pid, [pid, pid + 1])
+        return self.seg_sid[lo:hi]
+
+    def lengths(self, pids, sids) -> np.ndarray:
+        """Vectorized segment length in meters ; NaN for segments that are not in the graph"""
+        rows = self.segment_rows(pids, sids)
+        return np.where(rows >= 0, self.length[np.maximum(rows, 0)], np.nan)
+
+    def segment_length(self, pid, sid):
+        row = self._segment_row(pid, sid)
+        return float(self.length[row]) if row is not None else None
+
+    def node(self, pid, sid, index):
+        """(pid, nid) of the start (index 0) or end (index 1) node of a segment, or None"""
+        row = self._segment_row(pid, sid)
+        if row is None:
+            return None
+        if index == 0:
+            return int(self.start_pid[row]), int(self.start_nid[row])
+        return int(self.end_pid[row]), int(self.end_nid[row])
+
+    def shape(self, pid, sid):
+        """(n, 2) lat/lon shape points of a segment (a view on the packed array), or None"""
+        row = self._segment_row(pid, sid)
+        if row is None:
+            return None
+        return self.points[self.point_ptr[row]:self.point_ptr[row + 1]]
+
+    def shapes(self, pid):
+        """dict segment ID -> shape points of all segments of one partition (e.g. for offset.PackedShapes)"""
+        lo, hi = np.searchsorted(self.seg_pid, [pid, pid + 1])
+        return {int(self.seg_sid[k]): self.points[self.point_ptr[k]:self.point_ptr[k + 1]] for k in range(lo, hi)}
+
+    def connected_segments(self, pid, nid):
+        """List of (pid, sid) of the segments connected to a node, or None if the node is not in the graph"""
+        row = int(self.node_rows(pid, [nid])[0])
+        if row < 0:
+            return None
+        lo, hi = self.adj_ptr[row], self.adj_ptr[row + 1]
+        return list(zip(self.adj_pid[lo:hi].tolist(), self.adj_sid[lo:hi].tolist()))
+
+    def shared_node(self, pid1, sid1, sid2):
+        """The node (pid, nid) of segment (pid1, sid1) that segment sid2 is also connected to, or None"""
+        row = self._segment_row(pid1, sid1)
+        if row is None:
+            return None
+        for node_pid, nid in [(self.start_pid[row], self.start_nid[row]), (self.end_pid[row], self.end_nid[row])]:
+            k = int(self.node_rows(node_pid, [nid])[0])
+            if k >= 0 and (self.adj_sid[self.adj_ptr[k]:self.adj_ptr[k + 1]] == sid2).any():
+                return int(node_pid), int(nid)
+        return None
@@ -0,0 +1,189 @@
+"""
+Batch map-matching of points (probe points, photo locations) to (pid, sid, offset, orientation)
+
+Every point is matched independently: the candidates are the nearest segments from the spatial index
+(across partition boundaries), and if the point has a heading, the candidate and direction of travel whose
+bearing is closest to it win, as long as travel_direction allows driving that way.
+
+    from hmctools import mapmatch
+    df = mapmatch.match_points(lats, lons, headings)
+    df = mapmatch.match_geojson('data/photolocations.geojson')
+
+match_points returns a DataFrame with one row per point, in input order, with columns
+    pid, sid, offset, orientation (FORWARD/BACKWARD, or BOTH when there is no heading and both are allowed),
+    distance (meters from the point to the segment), heading_diff (degrees, NaN without heading)
+and NaN/None for points without a match.
+For large inputs, match_stream() takes an iterable of chunks and matches them on a thread pool while the
+next chunks are read, yielding the results chunk by chunk.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import spatial
+from .segment import HmcPartition, TopologyGeometry, prefetch_partitions
+
+
+# the layers matching needs ; fetched for all partitions of a chunk at once before matching
+MATCH_LAYERS = ['topology-geometry', 'navigation-attributes']
+
+
+def bearings(pid, sids, offsets, step=2.0):
+    """
+    Bearing (degrees clockwise from north) in the digitization direction of the segments at the offsets,
+    measured between the points step meters before and after the offset
+    """
+    tg = TopologyGeometry()
+    shapes = tg.get_packed_shapes(pid)
+    sids = np.asarray(sids, dtype=np.int64)
+    delta = step / np.maximum(shapes.lengths[shapes.rows(sids)], step)
+    a = shapes.interpolate(sids, np.clip(offsets - delta, 0.0, 1.0))
+    b = shapes.interpolate(sids, np.clip(offsets + delta, 0.0, 1.0))
+    dx = (b[:, 1] - a[:, 1]) * np.cos(np.radians((a[:, 0] + b[:, 0]) / 2))
+    dy = b[:, 0] - a[:, 0]
+    return np.degrees(np.arctan2(dx, dy)) % 360.0
+
+
+def angle_difference(a, b):
+    """Absolute difference between angles in degrees, in 0..180"""
+    return np.abs((np.asarray(a) - np.asarray(b) + 180.0) % 360.0 - 180.0)
+
+
+def _travel_directions(candidates):
+    """travel_direction of every candidate (pid, sid, offset) row ; None for segments without one"""
+    output = np.full(len(candidates), None, dtype=object)
+    # one interval lookup per partition
+    for pid, rows in candidates.groupby('pid').indices.items():
+        output[rows] = HmcPartition(int(pid)).travel_direction(candidates['sid'].values[rows],
+                                                               candidates['offset'].values[rows])
+    return output
+
+
+def match_points(lats, lons, headings=None, k=5, max_dist=30.0, max_heading_diff=60.0, heading_weight=0.5,
+                 drivable_only=True, prefetch=True) -> pd.DataFrame:
+    """
+    Match arrays of points (and optional headings in degrees, NaN where unknown) to segments
+
+    k, max_dist          -- the number of candidate segments per point, and how far (meters) to look for them
+    max_heading_diff     -- candidates whose direction is more than this many degrees off the heading are skipped
+    heading_weight       -- meters of distance that one degree of heading difference is worth when scoring
+    drivable_only        -- skip segments without a travel direction (e.g. footpaths)
+    prefetch             -- fetch the layers of all partitions near the points first, in one round trip per layer
+    """
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    n = len(lats)
+    if headings is None:
+        headings = np.full(n, np.nan)
+    headings = np.broadcast_to(np.asarray(headings, dtype=np.float64), (n,))
+
+    output = pd.DataFrame({'pid': np.full(n, np.nan), 'sid': np.full(n, np.nan), 'offset': np.full(n, np.nan),
+                           'orientation': np.full(n, None, dtype=object), 'distance': np.full(n, np.nan),
+                           'heading_diff': np.full(n, np.nan)})
+    if n == 0:
+        return output
+
+    if prefetch:
+        prefetch_partitions(spatial.partitions_near(lats, lons, max_dist), layers=MATCH_LAYERS)
+    candidates = spatial.nearest_segments_many(lats, lons, k, max_dist)
+    if len(candidates) == 0:
+        return output
+
+    # bearing of every candidate at the matched offset, per partition
+    bearing = np.empty(len(candidates))
+    for pid, rows in candidates.groupby('pid').indices.items():
+        bearing[rows] = bearings(int(pid), candidates['sid'].values[rows], candidates['offset'].values[rows])
+
+    dot = _travel_directions(candidates)
+    heading = headings[candidates['query'].values]
+    has_heading = ~np.isnan(heading)
+    # segments without a travel direction can be used both ways, unless we only want drivable segments
+    undirected = np.array([q is None for q in dot], dtype=bool) & (not drivable_only)
+    forward_ok = (dot == 'BOTH') | (dot == 'FORWARD') | undirected
+    backward_ok = (dot == 'BOTH') | (dot == 'BACKWARD') | undirected
+
+    # score both directions of every candidate ; the heading difference is infinite for directions not allowed
+    forward_diff = np.where(forward_ok, angle_difference(heading, bearing), np.inf)
+    backward_diff = np.where(backward_ok, angle_difference(heading, bearing + 180.0), np.inf)
+    use_forward = forward_diff <= backward_diff
+    heading_diff = np.where(use_forward, forward_diff, backward_diff)
+    distance = candidates['distance'].values
+    score = np.where(has_heading, distance + heading_weight * heading_diff, distance)
+    valid = np.where(has_heading, heading_diff <= max_heading_diff, forward_ok | backward_ok)
+
+    orientation = np.where(use_forward, 'FORWARD', 'BACKWARD').astype(object)
+    # without a heading we only know the direction if there is just one
+    no_heading_both = ~has_heading & forward_ok & backward_ok
+    orientation[no_heading_both] = 'BOTH'
+    orientation[~has_heading & forward_ok & ~backward_ok] = 'FORWARD'
+    orientation[~has_heading & ~forward_ok & backward_ok] = 'BACKWARD'
+
+    # best valid candidate of every point
+    queries = candidates['query'].values
+    rows = np.flatnonzero(valid)
+    rows = rows[np.lexsort((score[rows], queries[rows]))]
+    best = rows[np.concatenate([[True], queries[rows][1:] != queries[rows][:-1]])] if len(rows) else rows
+    target = queries[best]
+    output.loc[target, 'pid'] = candidates['pid'].values[best]
+    output.loc[target, 'sid'] = candidates['sid'].values[best]
+    output.loc[target, 'offset'] = candidates['offset'].values[best]
+    output.loc[target, 'orientation'] = orientation[best]
+    output.loc[target, 'distance'] = distance[best]
+    output.loc[target, 'heading_diff'] = np.where(has_heading[best], heading_diff[best], np.nan)
+    return output
+
+
+def _chunk_arrays(chunk):
+    """(lats, lons, headings) of a chunk: a DataFrame with latitude/longitude(/heading) columns, or a tuple"""
+    if isinstance(chunk, pd.DataFrame):
+        headings = chunk['heading'].values if 'heading' in chunk else None
+        return chunk['latitude'].values, chunk['longitude'].values, headings
+    if len(chunk) == 2:
+        return chunk[0], chunk[1], None
+    return chunk[0], chunk[1], chunk[2]
+
+
+def match_stream(chunks, max_workers=4, **kwargs):
+    """
+    Match an iterable of chunks (DataFrames with latitude, longitude and optionally heading columns, or
+    (lats, lons[, headings]) tuples), e.g. from pd.read_csv(..., chunksize=100000)
+
+    At most max_workers chunks are in flight at any time, so the input is read lazily and memory stays bounded.
+    Yields the match_points() result of every chunk, in input order, with the index of the chunk.
+    kwargs are passed on to match_points.
+    """
+    def work(chunk):
+        result = match_points(*_chunk_arrays(chunk), **kwargs)
+        if isinstance(chunk, pd.DataFrame):
+            result.index = chunk.index
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = []
+        for chunk in chunks:
+            pending.append(pool.submit(work, chunk))
+            if len(pending) >= max_workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def match_geojson(path, **kwargs) -> pd.DataFrame:
+    """
+    Match the Point features of a GeoJSON file (like data/photolocations.geojson) ; a 'heading' property is
+    used as the heading. Returns the properties of every feature with the match_points() columns added.
+    """
+    with open(path, 'r') as fh:
+        features = [q for q in json.load(fh)['features'] if q['geometry']['type'] == 'Point']
+    properties = pd.DataFrame([q['properties'] for q in features], index=range(len(features)))
+    lons = [q['geometry']['coordinates'][0] for q in features]
+    lats = [q['geometry']['coordinates'][1] for q in features]
+    headings = properties['heading'].astype(float).values if 'heading' in properties else None
+
+    result = match_points(lats, lons, headings, **kwargs)
+    properties['latitude'] = lats
+    properties['longitude'] = lons
+    return pd.concat([properties, result], axis=1)
@@ -0,0 +1,293 @@
+"""
+Counters and timings of the fetch, decode, flatten and cache paths
+
+Always on and cheap (a perf_counter pair and an update of a per-thread dict, no lock, per stage): every stage
+is recorded per name, where the name is the layer id for the data stages and the method name for the
+TopologySegment accessors.
+    fetch       download of a raw blob from OLP (one per attempt that succeeded ; bytes is the blob size)
+    decode      schema.decode_blob of a blob (bytes is the blob size)
+    flatten     turning a decoded partition into what the layer class keeps in its cache (_ingest)
+    accessor    the public TopologySegment accessors (only the outermost call when one accessor uses another,
+                e.g. get_live_traffic_speed and the travel_direction it looks up, so the time is counted once)
+and counters such as retries, coalesced (fetches that shared another download), store_hits and store_misses
+(the persistent partition store). Cache hits, misses, evictions and resident size come from cache.stats().
+
+    from hmctools import metrics
+    metrics.snapshot()              # nested dict
+    print(metrics.prometheus())     # Prometheus text exposition format
+    metrics.reset()
+
+    with metrics.profile() as prof: # time per partition, for whatever runs inside the block (any thread)
+        HmcPartition(23602975).live_vs_historical(tz='Europe/Amsterdam')
+    prof.by_partition()             # [(seconds, stage, name, pid, calls), ...] most expensive first
+
+metrics.disable() turns the recording off altogether.
+"""
+
+import functools
+import threading
+import time
+
+from . import cache
+
+
+enabled = True
+
+_lock = threading.Lock()  # for the counters, the profilers and the tables of the threads ; not taken per stage
+_local = threading.local()  # .stages: the table of the thread, .active: the traced stages it is inside of
+_tables = {}  # thread -> its stage table, each (stage, name) -> [calls, seconds, max seconds, bytes]
+_finished = {}  # the stage tables of the threads that have ended, merged into one (see _compact)
+_counters = {}  # (counter, name) -> count
+_profilers = []  # active Profilers
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def _thread_table() -> dict:
+    """The stage table of the current thread ; only this thread writes to it, so it needs no lock"""
+    table = getattr(_local, 'stages', None)
+    if table is None:
+        table = _local.stages = {}
+        with _lock:
+            _compact()
+            _tables[threading.current_thread()] = table
+    return table
+
+
+def _merge(into, table):
+    for key, (calls, seconds, max_seconds, nbytes) in list(table.items()):
+        entry = into.get(key)
+        if entry is None:
+            into[key] = [calls, seconds, max_seconds, nbytes]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] = max(entry[2], max_seconds)
+            entry[3] += nbytes
+
+
+def _compact():
+    # with the lock held: a thread pool per prefetch means many short-lived threads, so the tables of those
+    # that have ended are folded into _finished (nobody writes to them anymore)
+    for thread in [q for q in _tables if not q.is_alive()]:
+        _merge(_finished, _tables.pop(thread))
+
+
+def record(stage, name, seconds, nbytes=0, pid=None):
+    """Add one timed call of a stage"""
+    if not enabled:
+        return
+    key = (stage, name if name is not None else 'unknown')
+    table = _thread_table()
+    entry = table.get(key)
+    if entry is None:
+        entry = table[key] = [0, 0.0, 0.0, 0]
+    entry[0] += 1
+    entry[1] += seconds
+    entry[3] += nbytes
+    if seconds > entry[2]:
+        entry[2] = seconds
+    if _profilers:
+        with _lock:
+            for profiler in _profilers:
+                profiler._add(key, pid, seconds)
+
+
+def count(counter, name, n=1):
+    """Increment a counter (retries, store_hits, ...)"""
+    if not enabled:
+        return
+    key = (counter, name if name is not None else 'unknown')
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+class timed:
+    """
+    Context manager that records the time of the block as one call of a stage
+    Set .nbytes inside the block to record a size, e.g.
+        with metrics.timed('decode', layer_id, pid) as t:
+            t.nbytes = len(blob)
+    """
+    __slots__ = ('stage', 'name', 'pid', 'nbytes', '_start')
+
+    def __init__(self, stage, name, pid=None, nbytes=0):
+        self.stage = stage
+        self.name = name
+        self.pid = pid
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, self.name, time.perf_counter() - self._start, self.nbytes, self.pid)
+        return False
+
+
+def traced(stage, name=None):
+    """
+    Decorator for methods: records every call as one call of stage
+    The name is name, or else the _layer_id of the object (or the method name if it has none) ; the first
+    argument after self is taken to be the partition id, unless the object has a pid.
+    Calls made from inside another traced call of the same stage (in the same thread) are not recorded,
+    the outer call has their time already.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not enabled:
+                return method(self, *args, **kwargs)
+            active = getattr(_local, 'active', None)
+            if active is None:
+                active = _local.active = set()
+            if stage in active:
+                return method(self, *args, **kwargs)
+            label = name or getattr(self, '_layer_id', None) or method.__name__
+            pid = getattr(self, 'pid', args[0] if args else None)
+            active.add(stage)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                active.discard(stage)
+                record(stage, label, seconds, 0, pid)
+        return wrapper
+    return decorator
+
+
+def snapshot() -> dict:
+    """
+    All metrics as a dict:
+        stages      stage -> name -> {calls, seconds, max_seconds, bytes}
+        counters    counter -> name -> count
+        caches      cache.stats() (entries, nbytes, hits, misses, evictions, ... per cache)
+    """
+    total = {}
+    with _lock:
+        _compact()
+        _merge(total, _finished)
+        for table in _tables.values():
+            _merge(total, table)
+    stages = {}
+    for (stage, name), (calls, seconds, max_seconds, nbytes) in total.items():
+        stages.setdefault(stage, {})[name] = {'calls': calls, 'seconds': seconds, 'max_seconds': max_seconds,
+                                              'bytes': nbytes}
+    with _lock:
+        counters = {}
+        for (counter, name), n in _counters.items():
+            counters.setdefault(counter, {})[name] = n
+    return {'stages': stages, 'counters': counters, 'caches': cache.stats()}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus(prefix='hmctools') -> str:
+    """snapshot() in the Prometheus text exposition format"""
+    snap = snapshot()
+    lines = []
+
+    def family(metric, kind, doc, samples):
+        if not samples:
+            return
+        lines.append('# HELP %s_%s %s' % (prefix, metric, doc))
+        lines.append('# TYPE %s_%s %s' % (prefix, metric, kind))
+        for labels, value in samples:
+            text = ','.join('%s="%s"' % (k, _label(v)) for k, v in labels)
+            lines.append('%s_%s{%s} %s' % (prefix, metric, text, repr(float(value))))
+
+    stages = [((('stage', stage), ('name', name)), values) for stage, names in sorted(snap['stages'].items())
+              for name, values in sorted(names.items())]
+    family('stage_calls_total', 'counter', 'Calls per stage', [(k, v['calls']) for k, v in stages])
+    family('stage_seconds_total', 'counter', 'Time spent per stage', [(k, v['seconds']) for k, v in stages])
+    family('stage_max_seconds', 'gauge', 'Slowest call per stage', [(k, v['max_seconds']) for k, v in stages])
+    family('stage_bytes_total', 'counter', 'Bytes handled per stage', [(k, v['bytes']) for k, v in stages])
+    family('events_total', 'counter', 'Retries, coalesced fetches, partition store hits/misses',
+           [((('event', counter), ('name', name)), n) for counter, names in sorted(snap['counters'].items())
+            for name, n in sorted(names.items())])
+
+    caches = sorted(snap['caches'].items())
+    for field, kind, doc in [('hits', 'counter', 'Cache hits'), ('misses', 'counter', 'Cache misses'),
+                             ('evictions', 'counter', 'Cache evictions'), ('entries', 'gauge', 'Cached entries'),
+                             ('nbytes', 'gauge', 'Estimated resident size of the cache'),
+                             ('max_bytes', 'gauge', 'Memory budget of the cache')]:
+        metric = 'cache_' + field + ('_total' if kind == 'counter' else '')
+        family(metric, kind, doc, [((('cache', name),), stats[field]) for name, stats in caches])
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Zero all stage timings and counters (and the cache hit/miss/eviction counts)"""
+    with _lock:
+        for table in _tables.values():
+            table.clear()
+        _finished.clear()
+        _counters.clear()
+    for name in cache.stats():
+        c = cache.get_cache(name)
+        c.hits = c.misses = c.evictions = 0
+
+
+class Profiler:
+    """Time per (stage, name, partition) of everything recorded while it is active ; see profile()"""
+
+    def __init__(self):
+        self.entries = {}  # (stage, name, pid) -> [calls, seconds]
+        self.wall = 0.0
+        self._start = None
+
+    def _add(self, key, pid, seconds):
+        # called with the metrics lock held
+        entry = self.entries.get(key + (pid,))
+        if entry is None:
+            entry = self.entries[key + (pid,)] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        with _lock:
+            _profilers.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        with _lock:
+            _profilers.remove(self)
+        self.wall = time.perf_counter() - self._start
+        return False
+
+    def by_partition(self, stage=None):
+        """[(seconds, stage, name, pid, calls), ...] most expensive first, optionally for one stage"""
+        rows = [(seconds, key[0], key[1], key[2], calls) for key, (calls, seconds) in self.entries.items()
+                if stage is None or key[0] == stage]
+        return sorted(rows, key=lambda q: -q[0])
+
+    def partitions(self):
+        """dict pid -> total seconds of the data stages (fetch, decode, flatten), most expensive first"""
+        totals = {}
+        for (stage, _, pid), (_, seconds) in self.entries.items():
+            if stage != 'accessor' and pid is not None:
+                totals[pid] = totals.get(pid, 0.0) + seconds
+        return dict(sorted(totals.items(), key=lambda q: -q[1]))
+
+    def to_dataframe(self):
+        """by_partition() as a pandas DataFrame"""
+        import pandas as pd
+        return pd.DataFrame(self.by_partition(), columns=['seconds', 'stage', 'name', 'pid', 'calls'])
+
+
+def profile() -> Profiler:
+    """Context manager that attributes the time of every recorded stage to partitions (see Profiler)"""
+    return Profiler()
@@ -0,0 +1,244 @@
+"""
+Geometry along segment shapes: lengths, offset -> coordinate, and coordinate -> offset
+
+The kernels work on NumPy arrays of (lat, lon) shape points, and take many offsets or many coordinates per call.
+Distances are great-circle (haversine) distances in meters ; offsets are fractions (0..1) of the length of the
+shape, so the exact earth radius does not matter for them.
+PackedShapes holds the shapes of a whole partition in flat arrays, so that offsets on many different segments
+can be interpolated in one array operation.
+"""
+import sys
+
+import numpy as np
+from nagini.utils.geo import Point
+
+
+EARTH_RADIUS = 6371000.0  # meters
+PROJECT_CHUNK = 4096  # coordinates per block in project(), bounds the (coordinates x pieces) temporary arrays
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Vectorized great-circle distance in meters between (arrays of) coordinates in degrees"""
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(q, dtype=np.float64)) for q in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def as_array(points) -> np.ndarray:
+    """Shape points (list of (lat, lon) tuples or an array) as an (n, 2) float array"""
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+def get_lengths(points) -> np.ndarray:
+    """Length in meters of every piece between consecutive shape points"""
+    points = as_array(points)
+    return haversine(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1])
+
+
+def cumulative_lengths(points) -> np.ndarray:
+    """Distance in meters from the first shape point to every shape point (so the last value is the length)"""
+    return np.concatenate([[0.0], np.cumsum(get_lengths(points))])
+
+
+def interpolate(points, offsets, cumlen=None) -> np.ndarray:
+    """
+    Vectorized offset -> coordinate: return an (n, 2) array with the (lat, lon) at each of the offsets
+    cumlen is the cumulative_lengths() of points, pass it in if it is already known
+    """
+    points = as_array(points)
+    if cumlen is None:
+        cumlen = cumulative_lengths(points)
+    offsets = np.clip(np.atleast_1d(np.asarray(offsets, dtype=np.float64)), 0.0, 1.0)
+    total = cumlen[-1]
+    if len(points) < 2 or total <= 0.0:
+        return np.repeat(points[:1], len(offsets), axis=0)
+
+    # interpolate lat/lon linearly between the shape points around the distance we need
+    distance = offsets * total
+    i = np.clip(np.searchsorted(cumlen, distance, side='right') - 1, 0, len(points) - 2)
+    piece = cumlen[i + 1] - cumlen[i]
+    frac = np.where(piece > 0, (distance - cumlen[i]) / np.where(piece > 0, piece, 1.0), 0.0)
+    return points[i] + (points[i + 1] - points[i]) * frac[:, None]
+
+
+def project(points, lats, lons, cumlen=None):
+    """
+    Vectorized coordinate -> offset: project every (lat, lon) onto the closest piece of the shape
+    Returns (offsets, distances): arrays with the offset (0..1) of the projected point and its distance in meters
+
+    The projection is done in a flat (equirectangular) approximation around the shape, which is far more
+    accurate than GPS over the length of a segment.
+    """
+    points = as_array(points)
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    if cumlen is None:
+        cumlen = cumulative_lengths(points)
+    if len(points) < 2 or cumlen[-1] <= 0.0:
+        return np.zeros(len(lats)), haversine(points[0, 0], points[0, 1], lats, lons)
+
+    # meters east/north of the first shape point
+    scale_y = np.radians(1.0) * EARTH_RADIUS
+    scale_x = scale_y * np.cos(np.radians(points[:, 0].mean()))
+    px = (points[:, 1] - points[0, 1]) * scale_x
+    py = (points[:, 0] - points[0, 0]) * scale_y
+    ax, ay = px[:-1], py[:-1]
+    dx, dy = px[1:] - ax, py[1:] - ay
+    piece2 = dx * dx + dy * dy
+    piece2 = np.where(piece2 > 0, piece2, 1.0)  # zero-length pieces project to their start
+
+    offsets = np.empty(len(lats))
+    distances = np.empty(len(lats))
+    for lo in range(0, len(lats), PROJECT_CHUNK):
+        qx = ((lons[lo:lo + PROJECT_CHUNK] - points[0, 1]) * scale_x)[:, None]
+        qy = ((lats[lo:lo + PROJECT_CHUNK] - points[0, 0]) * scale_y)[:, None]
+        # (coordinates, pieces): position along every piece, clamped to the piece, and distance to it
+        t = np.clip(((qx - ax) * dx + (qy - ay) * dy) / piece2, 0.0, 1.0)
+        d2 = (ax + t * dx - qx) ** 2 + (ay + t * dy - qy) ** 2
+        best = np.argmin(d2, axis=1)
+        rows = np.arange(len(best))
+        along = cumlen[best] + t[rows, best] * (cumlen[best + 1] - cumlen[best])
+        offsets[lo:lo + PROJECT_CHUNK] = along / cumlen[-1]
+        distances[lo:lo + PROJECT_CHUNK] = np.sqrt(d2[rows, best])
+    return offsets, distances
+
+
+# get the coordinate from the segment geometry and offset
+def get_latlng_from_link_offset(shape_points, offset, cumlen=None):
+    p = interpolate(shape_points, [offset], cumlen)[0]
+    return (float(p[0]), float(p[1]))
+
+
+def get_offset(shape_points, lat, lng, cumlen=None):
+    """Return the offset of the point on the shape that is closest to (lat, lng)"""
+    return float(project(shape_points, [lat], [lng], cumlen)[0][0])
+
+
+class PackedShapes:
+    """
+    The shapes of many segments (normally all of a partition) packed into flat arrays:
+        points  (total number of shape points, 2) array of lat/lon
+        cumlen  distance in meters from the start of its own segment, for every shape point
+        first   index of the first shape point of every segment, plus the total, so that
+                segment k has the points first[k]:first[k+1]
+        lengths length in meters of every segment
+    so that interpolating many (segment, offset) pairs is a single searchsorted.
+    """
+
+    def __init__(self, shapes):
+        """shapes is a dict of segment ID -> shape points"""
+        self.sids = np.fromiter(shapes.keys(), dtype=np.int64, count=len(shapes))
+        self._rows = {sid: k for k, sid in enumerate(shapes.keys())}
+        arrays = [as_array(q) for q in shapes.values()]
+        counts = np.array([len(q) for q in arrays], dtype=np.int64)
+        self.first = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.points = np.concatenate(arrays) if arrays else np.zeros((0, 2))
+
+        # the length of the pieces across a segment border are not part of any segment
+        pieces = get_lengths(self.points)
+        pieces[self.first[1:-1] - 1] = 0.0
+        running = np.concatenate([[0.0], np.cumsum(pieces)])
+        segment_of_point = np.repeat(np.arange(len(arrays)), counts)
+        self.cumlen = running - running[self.first[:-1]][segment_of_point]
+        self.lengths = self.cumlen[self.first[1:] - 1] if len(arrays) else np.zeros(0)
+
+        # one sorted key for all points: 2 * segment row + fraction of the segment
+        seglen = self.lengths[segment_of_point]
+        self._keys = 2.0 * segment_of_point + np.where(seglen > 0, self.cumlen / np.where(seglen > 0, seglen, 1), 0)
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __contains__(self, sid):
+        return sid in self._rows
+
+    @property
+    def nbytes(self) -> int:
+        return self.points.nbytes + self.cumlen.nbytes + self.first.nbytes + self.lengths.nbytes + \
+            self._keys.nbytes + self.sids.nbytes + 100 * len(self._rows)
+
+    def rows(self, sids) -> np.ndarray:
+        """Row of every segment ID ; raises KeyError for segments that are not in here"""
+        return np.array([self._rows[q] for q in np.atleast_1d(sids).tolist()], dtype=np.int64)
+
+    def shape(self, sid):
+        """Return (points, cumlen) of one segment, as views on the packed arrays"""
+        k = self._rows[sid]
+        return self.points[self.first[k]:self.first[k + 1]], self.cumlen[self.first[k]:self.first[k + 1]]
+
+    def point_offsets(self, sid) -> np.ndarray:
+        """Offset (0..1) of every shape point of the segment"""
+        _, cumlen = self.shape(sid)
+        return cumlen / cumlen[-1] if cumlen[-1] > 0 else np.zeros(len(cumlen))
+
+    def interpolate(self, sids, offsets) -> np.ndarray:
+        """Vectorized offset -> (lat, lon) for arrays of segment IDs and offsets ; returns an (n, 2) array"""
+        k = self.rows(sids)
+        offsets = np.clip(np.broadcast_to(np.asarray(offsets, dtype=np.float64), k.shape), 0.0, 1.0)
+        i = np.searchsorted(self._keys, 2.0 * k + offsets, side='right') - 1
+        # stay inside the segment, also for segments with a single shape point
+        i = np.clip(i, self.first[k], np.maximum(self.first[k + 1] - 2, self.first[k]))
+        j = np.minimum(i + 1, self.first[k + 1] - 1)
+        piece = self.cumlen[j] - self.cumlen[i]
+        distance = offsets * self.lengths[k]
+        frac = np.where(piece > 0, (distance - self.cumlen[i]) / np.where(piece > 0, piece, 1.0), 0.0)
+        return self.points[i] + (self.points[j] - self.points[i]) * frac[:, None]
+
+    def project(self, sids, lats, lons):
+        """
+        Vectorized coordinate -> offset for arrays of segment IDs and coordinates
+        Returns (offsets, distances) like project()
+        """
+        sids = np.atleast_1d(np.asarray(sids, dtype=np.int64))
+        lats = np.broadcast_to(np.asarray(lats, dtype=np.float64), sids.shape)
+        lons = np.broadcast_to(np.asarray(lons, dtype=np.float64), sids.shape)
+        offsets = np.empty(len(sids))
+        distances = np.empty(len(sids))
+        # every segment has its own pieces, so this is vectorized per segment
+        for sid in np.unique(sids):
+            mask = sids == sid
+            points, cumlen = self.shape(int(sid))
+            offsets[mask], distances[mask] = project(points, lats[mask], lons[mask], cumlen)
+        return offsets, distances
+
+
+#p is a (lat,long) and segments are lat/longs
+def closestSegment(p1, shape_points):
+
+    BIG_NUM=1000000
+
+    minimum=[]
+    mindist =BIG_NUM
+    mindiff =BIG_NUM
+    threshold  =1
+    seg_heading=999
+    iwhile=0
+    #jmt - I don't have any evidence that this while loop does anything (other than cause an infinite loop sometimes)
+    # i can't remember the history of this
+    while mindiff==BIG_NUM:
+        for iseg in range(1,len(shape_points)):
+            lp1 = shape_points[iseg-1]
+            lp2 = shape_points[iseg]
+            #diff = mapmatch.DistancePointLine(p1, lp1, lp2) #this was eric's way of doing it; he combined it with a check on angles
+            #it looks for the smallest perp distance from the segment to the point
+            #print 'debug',lp1,lp2,p1
+            #this is the 'triangle side length' method ; is there a flaw to it? seems to work for me.
+
+            LP1 = Point(latitude=lp1[0],longitude=lp1[1])
+            P1 = Point(latitude=p1[0],longitude=p1[1])
+            LP2 = Point(latitude=lp2[0],longitude=lp2[1])
+            diff1 = LP1.distance(P1) + LP2.distance(P1) - LP1.distance(LP2)
+            #diff1 = haversine( lp1[0],lp1[1], p1[0],p1[1])+haversine( lp2[0],lp2[1], p1[0],p1[1])-haversine( lp1[0],lp1[1], lp2[0],lp2[1])
+            #print 'difference:',iseg,diff1
+            if diff1<=mindiff:
+                #seg_dist, seg_heading = mapmatch.distBearingBetweenPoints(lp2[0], lp2[1], lp1[0], lp1[1])
+                mindist= 0.0#mapmatch.DistancePointLine(p1,lp1,lp2) #FIXME -- this is probably not used!
+                minimum = [p1, iseg, mindist]
+                mindiff=diff1
+        if mindiff==BIG_NUM:
+            print('Problem in maptools.py - still in the loop ', iwhile)
+            print(p1)
+            print(shape_points)
+            sys.exit(1)
+        iwhile+=1
+    return minimum[1]-1
@@ -0,0 +1,248 @@
+"""
+Persistent on-disk store for raw (undecoded) partition blobs.
+
+The in-memory caches in segment.py disappear every time the kernel restarts, and the same handful of
+versioned RIB-2 partitions then get downloaded again. This store sits underneath CatalogAccess.read_data
+and keeps the raw blobs on disk so a warm run does (almost) no network calls.
+
+Layout of the store directory:
+    objects/ab/abcdef...   the blobs themselves, named by the sha256 of their content
+    refs/12/12ef...        one small file per (catalog HRN, layer id, version, partition id) key,
+                           containing the content hash of the blob for that key
+    lock                   lock file used while evicting
+
+Because the blobs are content-addressed, two keys with the same content (e.g. an unchanged partition in
+two catalog versions) share one file on disk. Every file is written to a temporary name and then renamed
+into place, so several notebook processes can share the same store directory without seeing half-written
+blobs. Eviction is least-recently-used by the modification time of the ref files (which is bumped on
+every hit) and runs under an exclusive lock.
+
+Blobs are returned as bytes: the protobuf parser (ParseFromString) does not accept memory maps or other buffers.
+
+Every process keeps a running total of the store size (from one scan on its first write), and only scans and
+evicts when that total goes over the cap, so filling the store is linear in the number of entries.
+
+Configuration is via environment variables:
+    HMCTOOLS_CACHE_DIR        store directory (default ~/.cache/hmctools/partitions); set to '' to disable
+    HMCTOOLS_CACHE_MAX_BYTES  size cap in bytes (default 2 GiB)
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on windows ; eviction is then not locked between processes
+    fcntl = None
+
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# the version used in keys when no explicit catalog version is requested
+LATEST = 'latest'
+
+
+class PartitionStore:
+    """
+    Content-addressed blob store keyed by (catalog HRN, layer id, version, partition id)
+
+    Entries stored for version=None ("whatever the latest version is") are only trusted for
+    latest_max_age seconds, since the latest version of the catalog moves on over time.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, latest_max_age=24 * 3600):
+        self.root = os.path.expanduser(root)
+        self.max_bytes = max_bytes
+        self.latest_max_age = latest_max_age
+
+        self._objects = os.path.join(self.root, 'objects')
+        self._refs = os.path.join(self.root, 'refs')
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._refs, exist_ok=True)
+        # running total of the blob sizes, from a scan on the first put ; see evict()
+        self._total = None
+
+    @staticmethod
+    def key(catalog_hrn, layer_id, version, pid) -> str:
+        """Return the hash used as file name for the ref of this key"""
+        if version is None:
+            version = LATEST
+        s = '|'.join([str(catalog_hrn), str(layer_id), str(version), str(pid)])
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def _ref_path(self, key):
+        return os.path.join(self._refs, key[:2], key)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def _write_atomic(self, path, data):
+        """Write data to a temporary file next to path and rename it into place"""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def get(self, catalog_hrn, layer_id, version, pid):
+        """Return the blob for the key as bytes, or None if the key is not in the store"""
+        ref = self._ref_path(self.key(catalog_hrn, layer_id, version, pid))
+        try:
+            if version is None and time.time() - os.path.getmtime(ref) > self.latest_max_age:
+                return None
+            with open(ref, 'r') as fh:
+                digest = fh.read().strip()
+            with open(self._object_path(digest), 'rb') as fh:
+                blob = fh.read()
+        except (FileNotFoundError, ValueError):
+            # either a miss, or the entry was evicted by another process between the two opens
+            return None
+
+        if version is not None:
+            # bump the ref for LRU eviction ; for 'latest' entries the mtime doubles as age, so leave it
+            try:
+                os.utime(ref)
+            except FileNotFoundError:
+                pass
+        return blob
+
+    def put(self, catalog_hrn, layer_id, version, pid, blob):
+        """Store the blob for the key, then evict old entries if the store is over its size cap"""
+        blob = bytes(blob)
+        if self._total is None:
+            self._total = self.size()
+        digest = hashlib.sha256(blob).hexdigest()
+        obj = self._object_path(digest)
+        if not os.path.exists(obj):
+            self._write_atomic(obj, blob)
+            self._total += len(blob)
+        self._write_atomic(self._ref_path(self.key(catalog_hrn, layer_id, version, pid)), digest.encode())
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def discard(self, catalog_hrn, layer_id, version, pid):
+        """Remove the key from the store, e.g. because its blob could not be decoded"""
+        try:
+            os.remove(self._ref_path(self.key(catalog_hrn, layer_id, version, pid)))
+        except FileNotFoundError:
+            pass
+
+    def _scan(self):
+        """Return (list of (mtime, ref path, digest), dict of digest -> size)"""
+        refs = []
+        for dirpath, _, filenames in os.walk(self._refs):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                    with open(path, 'r') as fh:
+                        refs.append((mtime, path, fh.read().strip()))
+                except FileNotFoundError:
+                    continue
+
+        sizes = {}
+        for dirpath, _, filenames in os.walk(self._objects):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                try:
+                    sizes[name] = os.path.getsize(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+        return refs, sizes
+
+    def size(self) -> int:
+        """Total size in bytes of the blobs in the store"""
+        return sum(self._scan()[1].values())
+
+    def evict(self):
+        """
+        Drop least recently used entries until the store is below max_bytes
+        This scans the whole store (under the lock), so put() only calls it when its running total is over the cap.
+        """
+        with open(os.path.join(self.root, 'lock'), 'a') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                refs, sizes = self._scan()
+
+                # objects that are no longer referenced (e.g. after discard) are always removed
+                nrefs = {}
+                for _, _, digest in refs:
+                    nrefs[digest] = nrefs.get(digest, 0) + 1
+                for digest in list(sizes):
+                    if digest not in nrefs:
+                        self._remove_object(digest)
+                        del sizes[digest]
+
+                total = sum(sizes.values())
+                for _, path, digest in sorted(refs):
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    nrefs[digest] -= 1
+                    if nrefs[digest] == 0 and digest in sizes:
+                        self._remove_object(digest)
+                        total -= sizes.pop(digest)
+                # includes what other processes wrote since our last scan
+                self._total = total
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _remove_object(self, digest):
+        try:
+            os.remove(self._object_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Remove everything from the store"""
+        refs, sizes = self._scan()
+        for _, path, _ in refs:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        for digest in sizes:
+            self._remove_object(digest)
+        self._total = 0
+
+
+_default_store = None
+_default_store_configured = False
+
+
+def get_default_store():
+    """
+    Return the store configured by the environment (see module docstring), or None if disabled
+    The store is created on first use.
+    """
+    global _default_store, _default_store_configured
+    if not _default_store_configured:
+        root = os.environ.get('HMCTOOLS_CACHE_DIR', os.path.join('~', '.cache', 'hmctools', 'partitions'))
+        if root:
+            max_bytes = int(os.environ.get('HMCTOOLS_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+            _default_store = PartitionStore(root, max_bytes)
+        _default_store_configured = True
+    return _default_store
+
+
+def set_default_store(store):
+    """Replace the default store, e.g. with a PartitionStore in a different location ; None disables it"""
+    global _default_store, _default_store_configured
+    _default_store = store
+    _default_store_configured = True
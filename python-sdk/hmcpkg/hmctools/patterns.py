@@ -0,0 +1,234 @@
+"""
+Columnar representation of the traffic-patterns layer
+
+Each partition is decoded once into NumPy arrays:
+    rows (one per segment anchor with a pattern), sorted by (segment id, orientation, start offset)
+        sid, orientation, start, end, profile
+        rank    the position of the anchor in the partition ; where several rows cover an offset, the first
+                one in the partition is used (as the per-segment scan of traffic_pattern did)
+    profiles
+        uint16 array of shape (number of distinct patterns, 7, 288):
+        the speed for every day of the week (0 = Sunday, like OLP minus 1) and every 5-minute epoch.
+        0 means there is no pattern for that day.
+
+Many anchors share the same pattern, so the profiles are de-duplicated and the rows only point to them.
+
+Point lookups use binary search on the sorted rows ; batch lookups do the same for whole arrays of
+segments/offsets/times at once. Matrices of several partitions can be merged (e.g. for a whole city),
+and saved to / loaded from a directory of .npy files that is memory-mapped on load.
+"""
+
+import math
+import os
+
+import numpy as np
+
+from .attributes import IntervalIndex
+
+
+EPOCHS_PER_DAY = 288  # 5-minute epochs
+NODATA = 0
+
+
+def epoch_and_day(local_time):
+    """Return (5-minute epoch of the day, day index with 0 = Sunday) for a datetime"""
+    my_epoch = int(math.floor((local_time.hour * 60 + local_time.minute + local_time.second / 60.0) / 5))
+    day_index = (local_time.weekday() + 1) % 7  # weekday() returns 0 for monday
+    return my_epoch, day_index
+
+
+def expand_day(speed_pattern) -> np.ndarray:
+    """
+    Expand the (epoch, speed) steps of one day into 288 speeds
+    Same semantics as TopologySegment.decode_tpinfo: the speed of the last step at or before the epoch,
+    and the speed of the first step for epochs before it.
+    """
+    steps = sorted((p.epoch, p.speed) for p in speed_pattern)
+    if len(steps) == 0:
+        return np.full(EPOCHS_PER_DAY, NODATA, dtype=np.uint16)
+    epochs = np.array([q[0] for q in steps])
+    speeds = np.array([q[1] for q in steps], dtype=np.uint16)
+    idx = np.searchsorted(epochs, np.arange(EPOCHS_PER_DAY), side='right') - 1
+    return speeds[np.maximum(idx, 0)]
+
+
+def expand_week(tpinfo) -> np.ndarray:
+    """Expand a traffic pattern (list of per-day entries) into a (7, 288) array"""
+    week = np.full((7, EPOCHS_PER_DAY), NODATA, dtype=np.uint16)
+    for item in tpinfo:
+        # OLP has enum=1 mean SUNDAY ; subtracting 1 means 0->SUNDAY
+        week[item.day_of_week - 1] = expand_day(item.speed_pattern)
+    return week
+
+
+class TrafficPatternMatrix:
+    """
+    Traffic patterns of one or more partitions as sorted NumPy arrays (see module docstring)
+    """
+
+    ARRAYS = ['sid', 'orientation', 'start', 'end', 'profile', 'rank', 'profiles']
+
+    def __init__(self, sid, orientation, start, end, profile, rank, profiles, orientation_names):
+        self.sid = sid
+        self.orientation = orientation
+        self.start = start
+        self.end = end
+        self.profile = profile
+        self.rank = rank
+        self.profiles = profiles
+        # index = orientation code, e.g. ['BOTH', 'FORWARD', 'BACKWARD', ...]
+        self.orientation_names = list(orientation_names)
+        self._orientation_codes = {name: code for code, name in enumerate(self.orientation_names)}
+        self._index = IntervalIndex(self.sid, self.orientation, self.start, self.end, self.rank)
+
+    @classmethod
+    def from_parsed(cls, parsed, anchors, id2int, get_start_end):
+        """
+        Build the matrix from a decoded traffic-patterns partition
+        (id2int and get_start_end are passed in from segment.py to avoid a circular import)
+        """
+        orientation_names = []
+        rows = []
+        profiles = []
+        for item in parsed.traffic_pattern:
+            week = None
+            for sai in item.segment_anchor_index:
+                anchor = anchors[sai]
+                assert len(anchor.oriented_segment_ref) == 1, 'TrafficPatternMatrix wrong length of osr list'
+                if week is None:  # only expand patterns that are actually used
+                    week = expand_week(item.traffic_pattern)
+                    profiles.append(week)
+                if not orientation_names:
+                    enum_type = anchor.DESCRIPTOR.fields_by_name['attribute_orientation'].enum_type
+                    orientation_names = [q.name for q in sorted(enum_type.values, key=lambda v: v.number)]
+                start, end = get_start_end(anchor)
+                rows.append((id2int(anchor.oriented_segment_ref[0].segment_ref.identifier),
+                             anchor.attribute_orientation, start, end, len(profiles) - 1))
+
+        order = sorted(range(len(rows)), key=lambda i: (rows[i][0], rows[i][1], rows[i][2]))
+        rows = [rows[i] for i in order]
+        if profiles:
+            profiles = np.stack(profiles)
+        else:
+            profiles = np.zeros((0, 7, EPOCHS_PER_DAY), dtype=np.uint16)
+        return cls(np.array([q[0] for q in rows], dtype=np.int64),
+                   np.array([q[1] for q in rows], dtype=np.int8),
+                   np.array([q[2] for q in rows], dtype=np.float64),
+                   np.array([q[3] for q in rows], dtype=np.float64),
+                   np.array([q[4] for q in rows], dtype=np.int32),
+                   np.array(order, dtype=np.int64), profiles, orientation_names)
+
+    def __len__(self):
+        return len(self.sid)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS) + self._index.nbytes
+
+    def orientation_code(self, orientation) -> int:
+        """Integer code of an orientation name ; -1 (which matches nothing) for unknown names such as None"""
+        return self._orientation_codes.get(orientation, -1)
+
+    def find_rows(self, sids, orientations, offsets) -> np.ndarray:
+        """
+        Vectorized lookup of the row for each (segment, orientation, offset) ; -1 where there is no pattern
+        orientations can be a single string or an array of strings/codes
+        """
+        sids = np.atleast_1d(np.asarray(sids, dtype=np.int64))
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=np.float64), sids.shape)
+        if len(self.sid) == 0:
+            return np.full(sids.shape, -1, dtype=np.int64)
+        if isinstance(orientations, str):
+            codes = np.full(sids.shape, self.orientation_code(orientations), dtype=np.int8)
+        else:
+            codes = np.array([q if isinstance(q, (int, np.integer)) else self.orientation_code(q) for q in
+                              np.broadcast_to(np.asarray(orientations, dtype=object), sids.shape)], dtype=np.int8)
+
+        return self._index.find(sids, codes, offsets)
+
+    def speeds(self, sids, orientations, offsets, epochs, days) -> np.ndarray:
+        """
+        Vectorized historical speed for arrays of (segment, orientation, offset, epoch, day) ; NaN where no data
+        epochs/days can also be scalars (e.g. the whole city at one time)
+        """
+        rows = self.find_rows(sids, orientations, offsets)
+        epochs = np.broadcast_to(np.asarray(epochs), rows.shape)
+        days = np.broadcast_to(np.asarray(days), rows.shape)
+        out = np.full(rows.shape, np.nan)
+        ok = rows >= 0
+        values = self.profiles[self.profile[rows[ok]], days[ok], epochs[ok]]
+        out[ok] = np.where(values == NODATA, np.nan, values)
+        return out
+
+    def speeds_at(self, sids, orientations, offsets, local_times) -> np.ndarray:
+        """Same as speeds() but with datetimes (one, or one per query) instead of epoch/day"""
+        if hasattr(local_times, 'hour'):
+            epoch, day = epoch_and_day(local_times)
+            return self.speeds(sids, orientations, offsets, epoch, day)
+        pairs = np.array([epoch_and_day(q) for q in local_times], dtype=np.int64).reshape(-1, 2)
+        return self.speeds(sids, orientations, offsets, pairs[:, 0], pairs[:, 1])
+
+    def speed(self, sid, orientation, offset, local_time):
+        """Point lookup: historical speed as int, or None"""
+        row = self.find_rows([sid], orientation, [offset])[0]
+        if row < 0:
+            return None
+        my_epoch, day_index = epoch_and_day(local_time)
+        value = int(self.profiles[self.profile[row], day_index, my_epoch])
+        return None if value == NODATA else value
+
+    def week_profile(self, sid, orientation, offset) -> np.ndarray:
+        """The (7, 288) speeds of the pattern at this position, or None"""
+        row = self.find_rows([sid], orientation, [offset])[0]
+        if row < 0:
+            return None
+        return self.profiles[self.profile[row]]
+
+    def day_profile(self, sid, orientation, offset, day_index) -> np.ndarray:
+        """The 288 speeds of one day (0 = Sunday), or None"""
+        week = self.week_profile(sid, orientation, offset)
+        return None if week is None else week[day_index]
+
+    def segment_rows(self, sid, orientation):
+        """Return the row indices for the segment/orientation, in order of start offset"""
+        if len(self.sid) == 0:
+            return []
+        code = self.orientation_code(orientation)
+        lo, hi = np.searchsorted(self.sid, [sid, sid + 1])
+        return [i for i in range(lo, hi) if self.orientation[i] == code]
+
+    @classmethod
+    def merge(cls, matrices):
+        """Combine the matrices of several partitions into one"""
+        matrices = [q for q in matrices if q is not None]
+        if not matrices:
+            raise ValueError('TrafficPatternMatrix.merge: nothing to merge')
+        names = matrices[0].orientation_names
+        profile_offsets = np.cumsum([0] + [len(q.profiles) for q in matrices[:-1]])
+        rank_offsets = np.cumsum([0] + [len(q) for q in matrices[:-1]])
+        sid = np.concatenate([q.sid for q in matrices])
+        orientation = np.concatenate([q.orientation for q in matrices])
+        start = np.concatenate([q.start for q in matrices])
+        order = np.lexsort((start, orientation, sid))
+        return cls(sid[order], orientation[order], start[order],
+                   np.concatenate([q.end for q in matrices])[order],
+                   np.concatenate([q.profile + o for q, o in zip(matrices, profile_offsets)])[order],
+                   np.concatenate([q.rank + o for q, o in zip(matrices, rank_offsets)])[order],
+                   np.concatenate([q.profiles for q in matrices]), names)
+
+    def save(self, directory):
+        """Save to a directory of .npy files (which load() memory-maps)"""
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'orientation_names.txt'), 'w') as fh:
+            fh.write('\n'.join(self.orientation_names))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Load a matrix written by save() ; with mmap=True the arrays stay on disk until used"""
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode) for name in cls.ARRAYS]
+        with open(os.path.join(directory, 'orientation_names.txt'), 'r') as fh:
+            names = fh.read().split('\n')
+        return cls(*arrays, orientation_names=names)
@@ -0,0 +1,263 @@
+"""
+Draw segment-level results (a value per segment, e.g. the residuals of live_vs_historical) on a map
+
+The input is columnar: arrays of pid, sid and value (pid can also be a single partition). Colours are mapped
+for all rows at once through a 256-entry lookup table, and the shape of every distinct segment is fetched
+(from TopologyGeometry.get_packed_shapes) and converted to coordinates once, no matter how many rows refer to it.
+
+    from hmctools import render
+    df, _ = HmcPartition(23602975).live_vs_historical('Europe/Amsterdam')
+    fc = render.feature_collection(23602975, df['segment'], df['residual'], symmetric=True)
+    mymap.add_layer(render.geojson_layer(fc))
+
+By default rows with the same colour are merged into one MultiLineString feature, which keeps the
+FeatureCollection small and leaves the browser one layer to draw instead of one Polyline per segment.
+For a whole city write_tiles() cuts the result into web map (z/x/y) tiles instead, as GeoJSON or, with
+mapbox_vector_tile installed, as Mapbox vector tiles.
+
+Shapes can be simplified (Douglas-Peucker, tolerance in meters), which drops most of the shape points of
+long straight segments without visible difference at city zoom levels.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from . import offset
+from .segment import TopologyGeometry
+
+
+DEFAULT_CMAP = 'RdYlGn'
+NAN_COLOR = '#808080'
+MVT_EXTENT = 4096
+MERCATOR_RADIUS = 6378137.0
+
+_tables = {}
+
+
+def color_table(cmap=DEFAULT_CMAP):
+    """The 256 colours of a matplotlib colormap as an array of '#rrggbb' strings"""
+    if cmap not in _tables:
+        import matplotlib  # only needed by those who draw
+        # matplotlib.colormaps is new in 3.5, cm.get_cmap is gone in 3.9
+        colormap = matplotlib.colormaps[cmap] if hasattr(matplotlib, 'colormaps') else matplotlib.cm.get_cmap(cmap)
+        rgba = colormap(np.linspace(0.0, 1.0, 256), bytes=True)
+        _tables[cmap] = np.array(['#%02x%02x%02x' % tuple(q[:3]) for q in rgba], dtype=object)
+    return _tables[cmap]
+
+
+def colors(values, vmin=None, vmax=None, cmap=DEFAULT_CMAP, symmetric=False, nan_color=NAN_COLOR):
+    """
+    Vectorized value -> '#rrggbb' colour ; vmin/vmax default to the range of the values
+    With symmetric=True the range is -max|value| .. max|value| (for residuals)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    if symmetric and vmin is None and vmax is None:
+        vmax = np.abs(finite).max() if len(finite) else 1.0
+        vmin = -vmax
+    vmin = (finite.min() if len(finite) else 0.0) if vmin is None else vmin
+    vmax = (finite.max() if len(finite) else 1.0) if vmax is None else vmax
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    index = np.clip(np.nan_to_num((values - vmin) * scale), 0, 255).astype(np.int64)
+    return np.where(np.isfinite(values), color_table(cmap)[index], nan_color)
+
+
+def simplify(points, tolerance) -> np.ndarray:
+    """
+    Douglas-Peucker simplification of an (n, 2) lat/lon shape ; tolerance in meters
+    Returns the boolean mask of the points to keep (the first and last are always kept)
+    """
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[[0, n - 1]] = True
+    # meters east/north, flat approximation around the shape
+    xy = np.radians(points[:, ::-1]) * offset.EARTH_RADIUS
+    xy[:, 0] *= np.cos(np.radians(points[:, 0].mean()))
+    stack = [(0, n - 1)]
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo < 2:
+            continue
+        a, b = xy[lo], xy[hi]
+        d = b - a
+        rest = xy[lo + 1:hi] - a
+        length = np.hypot(d[0], d[1])
+        if length > 0:
+            distance = np.abs(rest[:, 0] * d[1] - rest[:, 1] * d[0]) / length
+        else:
+            distance = np.hypot(rest[:, 0], rest[:, 1])
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            keep[lo + 1 + i] = True
+            stack.append((lo, lo + 1 + i))
+            stack.append((lo + 1 + i, hi))
+    return keep
+
+
+def segment_shapes(pids, sids, tolerance=None):
+    """
+    The (n, 2) lat/lon shape of every distinct (pid, sid), optionally simplified
+    Returns a dict (pid, sid) -> array ; segments that are not in their partition are left out
+    """
+    tg = TopologyGeometry()
+    output = {}
+    pairs = np.unique(np.stack([pids, sids], axis=1), axis=0) if len(sids) else np.zeros((0, 2), dtype=np.int64)
+    for pid in np.unique(pairs[:, 0]):
+        shapes = tg.get_packed_shapes(int(pid))
+        for sid in pairs[pairs[:, 0] == pid, 1]:
+            sid = int(sid)
+            if sid not in shapes:
+                continue
+            points, _ = shapes.shape(sid)
+            if tolerance is not None:
+                points = points[simplify(points, tolerance)]
+            output[(int(pid), sid)] = points
+    return output
+
+
+def _columns(pids, sids, values):
+    sids = np.atleast_1d(np.asarray(sids, dtype=np.int64))
+    pids = np.broadcast_to(np.asarray(pids, dtype=np.int64), sids.shape)
+    values = np.broadcast_to(np.asarray(values, dtype=np.float64), sids.shape)
+    return pids, sids, values
+
+
+def _coordinates(points, precision):
+    """GeoJSON (lon, lat) coordinate list of a shape"""
+    return np.round(points[:, ::-1], precision).tolist()
+
+
+def _value(value):
+    """A value as a JSON-friendly float (None for NaN)"""
+    value = float(value)
+    return None if value != value else value
+
+
+def feature_collection(pids, sids, values, vmin=None, vmax=None, cmap=DEFAULT_CMAP, symmetric=False,
+                       tolerance=None, precision=6, merge=True, nan_color=NAN_COLOR) -> dict:
+    """
+    GeoJSON FeatureCollection of the segments, coloured by value (see colors() for the colour arguments)
+
+    With merge=True there is one MultiLineString feature per colour, with properties color and count.
+    Otherwise there is one LineString feature per row, with properties pid, sid, value and color.
+    tolerance (meters) simplifies the shapes, precision is the number of decimals of the coordinates.
+    Rows with a NaN value are drawn in nan_color, or left out if nan_color is None.
+    """
+    pids, sids, values = _columns(pids, sids, values)
+    if nan_color is None:
+        ok = np.isfinite(values)
+        pids, sids, values = pids[ok], sids[ok], values[ok]
+    row_colors = colors(values, vmin, vmax, cmap, symmetric, nan_color)
+    shapes = segment_shapes(pids, sids, tolerance)
+    # every distinct segment is converted once, and shared by all features that draw it
+    coordinates = {key: _coordinates(points, precision) for key, points in shapes.items()}
+
+    features = []
+    if merge:
+        lines = {}
+        for pid, sid, color in zip(pids.tolist(), sids.tolist(), row_colors.tolist()):
+            if (pid, sid) in coordinates:
+                lines.setdefault(color, []).append(coordinates[(pid, sid)])
+        for color, multi in lines.items():
+            features.append({'type': 'Feature', 'properties': {'color': color, 'count': len(multi)},
+                             'geometry': {'type': 'MultiLineString', 'coordinates': multi}})
+    else:
+        for pid, sid, value, color in zip(pids.tolist(), sids.tolist(), values.tolist(), row_colors.tolist()):
+            if (pid, sid) not in coordinates:
+                continue
+            features.append({'type': 'Feature',
+                             'properties': {'pid': pid, 'sid': sid, 'value': _value(value), 'color': color},
+                             'geometry': {'type': 'LineString', 'coordinates': coordinates[(pid, sid)]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def geojson_layer(fc, weight=3, opacity=1.0, **kwargs):
+    """An ipyleaflet GeoJSON layer that draws every feature in its color property"""
+    from ipyleaflet import GeoJSON
+    return GeoJSON(data=fc, style_callback=lambda feature: {'color': feature['properties']['color'],
+                                                            'weight': weight, 'opacity': opacity}, **kwargs)
+
+
+def _mercator(points):
+    """Web mercator (x, y) in meters of (n, 2) lat/lon points"""
+    lat = np.clip(points[:, 0], -85.05112878, 85.05112878)
+    return np.stack([np.radians(points[:, 1]) * MERCATOR_RADIUS,
+                     np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * MERCATOR_RADIUS], axis=1)
+
+
+def write_tiles(out_dir, pids, sids, values, zooms=range(12, 16), vmin=None, vmax=None, cmap=DEFAULT_CMAP,
+                symmetric=False, tolerance=None, precision=6, file_format='geojson', layer_name='segments'):
+    """
+    Cut the coloured segments into web map tiles, written to <out_dir>/<z>/<x>/<y>.geojson (or .pbf)
+
+    A segment goes into every tile its bounding box touches, whole (it is not clipped), with properties
+    pid, sid, value and color. Unless a tolerance is given, the shapes are simplified to about half a
+    pixel at every zoom level. file_format 'mvt' writes Mapbox vector tiles (needs mapbox_vector_tile).
+    Returns the number of tiles written.
+    """
+    if file_format not in ['geojson', 'mvt']:
+        raise ValueError('write_tiles: file_format must be geojson or mvt')
+    if file_format == 'mvt':
+        import mapbox_vector_tile
+    pids, sids, values = _columns(pids, sids, values)
+    row_colors = colors(values, vmin, vmax, cmap, symmetric)
+    full = segment_shapes(pids, sids)
+    keys = [q for q in zip(pids.tolist(), sids.tolist()) if q in full]
+    rows = [i for i, q in enumerate(zip(pids.tolist(), sids.tolist())) if q in full]
+    if not rows:
+        return 0
+    rows = np.array(rows)
+    mercator = {key: _mercator(points) for key, points in full.items()}
+    lows = np.array([mercator[q].min(axis=0) for q in keys])
+    highs = np.array([mercator[q].max(axis=0) for q in keys])
+    world = 2 * np.pi * MERCATOR_RADIUS
+
+    count = 0
+    for z in zooms:
+        size = world / 2 ** z
+        # the distinct shapes at this zoom level ; simplified once, shared by all tiles
+        step = tolerance if tolerance is not None else size / 512
+        shapes = {key: points[simplify(points, step)] for key, points in full.items()}
+        x0 = np.floor((lows[:, 0] + world / 2) / size).astype(np.int64)
+        x1 = np.floor((highs[:, 0] + world / 2) / size).astype(np.int64)
+        y0 = np.floor((world / 2 - highs[:, 1]) / size).astype(np.int64)
+        y1 = np.floor((world / 2 - lows[:, 1]) / size).astype(np.int64)
+        tiles = {}
+        for k in range(len(rows)):
+            for x in range(x0[k], x1[k] + 1):
+                for y in range(y0[k], y1[k] + 1):
+                    tiles.setdefault((x, y), []).append(k)
+
+        for (x, y), members in tiles.items():
+            path = os.path.join(out_dir, str(z), str(x), '%d.%s' % (y, 'geojson' if file_format == 'geojson'
+                                                                        else 'pbf'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if file_format == 'geojson':
+                features = [{'type': 'Feature',
+                             'properties': {'pid': keys[k][0], 'sid': keys[k][1], 'value': _value(values[rows[k]]),
+                                            'color': row_colors[rows[k]]},
+                             'geometry': {'type': 'LineString',
+                                          'coordinates': _coordinates(shapes[keys[k]], precision)}}
+                            for k in members]
+                with open(path, 'w') as fh:
+                    json.dump({'type': 'FeatureCollection', 'features': features}, fh, separators=(',', ':'))
+            else:
+                west, north = x * size - world / 2, world / 2 - y * size
+                features = []
+                for k in members:
+                    # tile pixels with y up, which is what mapbox_vector_tile expects by default
+                    pixels = (_mercator(shapes[keys[k]]) - [west, north - size]) * (MVT_EXTENT / size)
+                    features.append({'geometry': 'LINESTRING (%s)' % ', '.join('%.1f %.1f' % tuple(q)
+                                                                               for q in pixels),
+                                     'properties': {'pid': keys[k][0], 'sid': keys[k][1],
+                                                    'value': _value(values[rows[k]]),
+                                                    'color': row_colors[rows[k]]}})
+                with open(path, 'wb') as fh:
+                    fh.write(mapbox_vector_tile.encode([{'name': layer_name, 'features': features}]))
+            count += 1
+    return count
+
@@ -0,0 +1,330 @@
+"""
+Join roadworks feeds (CORA/WIOR projects, roadblocks) to the HERE road network
+
+The GeoJSON feeds in data/ (cora.geojson, cora-projects-sample.geojson, actual-roadblocks-sample.geojson)
+are parsed one feature at a time, and every feature is joined to the segments it touches:
+    - the candidate segments are the ones in the bounding box of the feature plus a buffer (spatial index)
+    - the candidates are sampled every few meters along their shape, and a sample is affected if it is within
+      the buffer distance of the feature (for polygons: inside it, or within the buffer of its border)
+    - the affected samples of every segment give its offset range (from the first to the last affected sample)
+The result has one row per (project, segment):
+
+    project_id, pid, sid, start_offset, end_offset, start_date, end_date
+
+RoadworksJoin keeps the result per project together with a hash of the feature, so that feeding it a new
+version of a feed only recomputes the projects that changed (and drops the ones that are gone):
+
+    join = RoadworksJoin.load('roadworks-state.json')   # or RoadworksJoin() the first time
+    changed = join.update(iter_features('data/cora.geojson'))
+    join.save('roadworks-state.json')
+    df = join.to_dataframe()
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from . import spatial
+from . import tiling
+from .segment import TopologyGeometry, prefetch_partitions
+
+
+BUFFER = 10.0  # meters around the feature that count as affected
+SAMPLE_STEP = 5.0  # meters between the samples along the candidate segments
+DATE_FORMAT = '%d-%m-%Y'  # STARTDATUM/EINDDATUM in the CORA feed
+COLUMNS = ['project_id', 'pid', 'sid', 'start_offset', 'end_offset', 'start_date', 'end_date']
+
+
+def iter_features(path, block_size=1 << 16):
+    """
+    Yield the features of a GeoJSON FeatureCollection one at a time, without loading the whole file
+    (only the feature that is being decoded and one block of the file are in memory)
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as fh:
+        buffer = ''
+        position = -1
+        # skip to the start of the features array
+        while position < 0:
+            block = fh.read(block_size)
+            if not block:
+                return
+            buffer += block
+            start = buffer.find('"features"')
+            if start >= 0:
+                position = buffer.find('[', start)
+        buffer = buffer[position + 1:]
+
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                feature, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                block = fh.read(block_size)
+                eof = not block
+                buffer += block
+                continue
+            yield feature
+            buffer = buffer[end:]
+
+
+def project_id(feature, index):
+    """Stable id of a feature: WIORPR_ID for CORA projects, otherwise an id property, otherwise its position"""
+    properties = feature.get('properties') or {}
+    for name in ['WIORPR_ID', 'id']:
+        if properties.get(name) is not None:
+            return str(properties[name])
+    if feature.get('id') is not None:
+        return str(feature['id'])
+    return str(index)
+
+
+def feature_dates(feature):
+    """(start date, end date) of a CORA feature as datetime.date, None where unknown"""
+    properties = feature.get('properties') or {}
+    output = []
+    for name in ['STARTDATUM', 'EINDDATUM']:
+        try:
+            output.append(datetime.datetime.strptime(properties[name], DATE_FORMAT).date())
+        except (KeyError, TypeError, ValueError):
+            output.append(None)
+    return tuple(output)
+
+
+def feature_hash(feature) -> str:
+    return hashlib.sha1(json.dumps(feature, sort_keys=True).encode()).hexdigest()
+
+
+def _parts(geometry):
+    """Split a GeoJSON geometry into (points, lines, polygons) lists of (n, 2) lat/lon arrays (polygons: rings)"""
+    points, lines, polygons = [], [], []
+
+    def latlon(coordinates):
+        return np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)[:, ::-1]
+
+    kind = geometry['type']
+    coordinates = geometry.get('coordinates')
+    if kind == 'Point':
+        points.append(latlon([coordinates]))
+    elif kind == 'MultiPoint':
+        points.append(latlon(coordinates))
+    elif kind == 'LineString':
+        lines.append(latlon(coordinates))
+    elif kind == 'MultiLineString':
+        lines.extend(latlon(q) for q in coordinates)
+    elif kind == 'Polygon':
+        polygons.append([latlon(q) for q in coordinates])
+    elif kind == 'MultiPolygon':
+        polygons.extend([latlon(r) for r in q] for q in coordinates)
+    elif kind == 'GeometryCollection':
+        for q in geometry['geometries']:
+            p, l, g = _parts(q)
+            points += p
+            lines += l
+            polygons += g
+    return points, lines, polygons
+
+
+def _distance_to_edges(lats, lons, a, b):
+    """Distance in meters from every sample to the closest of the edges a[i] -> b[i] (flat approximation)"""
+    if len(a) == 0:
+        return np.full(len(lats), np.inf)
+    scale_x = spatial.METERS_PER_DEGREE * np.cos(np.radians(lats.mean()))
+    scale_y = spatial.METERS_PER_DEGREE
+    ax = (a[:, 1] - lons[:, None]) * scale_x
+    ay = (a[:, 0] - lats[:, None]) * scale_y
+    dx, dy = (b[:, 1] - a[:, 1]) * scale_x, (b[:, 0] - a[:, 0]) * scale_y
+    d2 = dx * dx + dy * dy
+    t = np.clip(-(ax * dx + ay * dy) / np.where(d2 > 0, d2, 1.0), 0.0, 1.0)
+    return np.hypot(ax + t * dx, ay + t * dy).min(axis=1)
+
+
+def _inside(lats, lons, rings):
+    """Even-odd point in polygon test of every sample against a polygon (outer ring and holes)"""
+    inside = np.zeros(len(lats), dtype=bool)
+    for ring in rings:
+        a, b = ring, np.roll(ring, -1, axis=0)
+        crosses = ((a[:, 0] > lats[:, None]) != (b[:, 0] > lats[:, None]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = a[:, 1] + (lats[:, None] - a[:, 0]) * (b[:, 1] - a[:, 1]) / (b[:, 0] - a[:, 0])
+        inside ^= (np.count_nonzero(crosses & (lons[:, None] < x), axis=1) % 2).astype(bool)
+    return inside
+
+
+def _feature_distance(lats, lons, points, lines, polygons, buffer, chunk=512):
+    """
+    Distance in meters from every sample to the feature (0 inside polygons) ; inf for samples that are more than
+    buffer meters outside the bounding box of every part of the feature, which are not looked at
+    """
+    output = np.full(len(lats), np.inf)
+    if len(lats) == 0:
+        return output
+    dlat = buffer / spatial.METERS_PER_DEGREE
+    dlon = buffer / (spatial.METERS_PER_DEGREE * np.cos(np.radians(lats.mean())))
+    # visit the samples in Morton order, so that every block of samples covers a small area and only
+    # needs the edges of the feature near that area
+    morton = np.argsort(tiling.tile_ids_from_coordinates(lats, lons, 20), kind='stable')
+
+    # (edge starts, edge ends, polygon rings or None) per part of the feature
+    parts = [(p, p, None) for p in points] + [(q[:-1], q[1:], None) for q in lines] + \
+            [(np.concatenate([q[:-1] for q in rings]), np.concatenate([q[1:] for q in rings]), rings)
+             for rings in polygons]
+    for a, b, rings in parts:
+        south, north = np.minimum(a[:, 0], b[:, 0]) - dlat, np.maximum(a[:, 0], b[:, 0]) + dlat
+        west, east = np.minimum(a[:, 1], b[:, 1]) - dlon, np.maximum(a[:, 1], b[:, 1]) + dlon
+        near = morton[(lats[morton] >= south.min()) & (lats[morton] <= north.max()) &
+                      (lons[morton] >= west.min()) & (lons[morton] <= east.max())]
+        for lo in range(0, len(near), chunk):
+            rows = near[lo:lo + chunk]
+            block_lats, block_lons = lats[rows], lons[rows]
+            edges = (south <= block_lats.max()) & (north >= block_lats.min()) & \
+                    (west <= block_lons.max()) & (east >= block_lons.min())
+            d = _distance_to_edges(block_lats, block_lons, a[edges], b[edges])
+            if rings is not None:
+                d = np.where(_inside(block_lats, block_lons, rings), 0.0, d)
+            output[rows] = np.minimum(output[rows], d)
+    return output
+
+
+def feature_bbox(feature, buffer=BUFFER):
+    """(south, west, north, east) of the feature plus the buffer, or None for a feature without geometry"""
+    if not feature.get('geometry'):
+        return None
+    points, lines, polygons = _parts(feature['geometry'])
+    coordinates = points + lines + [q for rings in polygons for q in rings]
+    if not coordinates:
+        return None
+    coordinates = np.concatenate(coordinates)
+    dlat = buffer / spatial.METERS_PER_DEGREE
+    dlon = buffer / (spatial.METERS_PER_DEGREE * np.cos(np.radians(coordinates[:, 0].mean())))
+    return (coordinates[:, 0].min() - dlat, coordinates[:, 1].min() - dlon,
+            coordinates[:, 0].max() + dlat, coordinates[:, 1].max() + dlon)
+
+
+def join_feature(feature, buffer=BUFFER, step=SAMPLE_STEP):
+    """Return the list of (pid, sid, start offset, end offset) of the segments affected by one feature"""
+    bbox = feature_bbox(feature, buffer)
+    if bbox is None:
+        return []
+    points, lines, polygons = _parts(feature['geometry'])
+
+    tg = TopologyGeometry()
+    candidates = {}
+    for pid, sid in spatial.segments_in_bbox(*bbox):
+        candidates.setdefault(pid, []).append(sid)
+
+    output = []
+    for pid, sids in candidates.items():
+        shapes = tg.get_packed_shapes(pid)
+        sids = np.array(sids, dtype=np.int64)
+        # samples every step meters along every candidate (at least both ends)
+        counts = np.maximum(np.ceil(shapes.lengths[shapes.rows(sids)] / step).astype(np.int64), 1) + 1
+        owner = np.repeat(np.arange(len(sids)), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        offsets = (np.arange(len(owner)) - first) / np.repeat(counts - 1, counts)
+        samples = shapes.interpolate(sids[owner], offsets)
+
+        affected = _feature_distance(samples[:, 0], samples[:, 1], points, lines, polygons, buffer) <= buffer
+        for k in np.unique(owner[affected]):
+            hit = offsets[affected & (owner == k)]
+            output.append((pid, int(sids[k]), float(hit.min()), float(hit.max())))
+    return output
+
+
+class RoadworksJoin:
+    """
+    Incrementally maintained join of roadworks projects to segments ; see the module docstring
+    """
+
+    def __init__(self, buffer=BUFFER, step=SAMPLE_STEP):
+        self.buffer = buffer
+        self.step = step
+        self.projects = {}  # project id -> {'hash': ..., 'dates': (start, end), 'segments': [(pid, sid, o1, o2)]}
+
+    def update(self, features, remove_missing=True):
+        """
+        Bring the join up to date with the features of a feed (an iterable, e.g. iter_features(path))
+        Only new and changed features are joined ; projects that are no longer in the feed are removed
+        (unless remove_missing is False, e.g. when features only has the changed projects).
+        Returns the set of project ids that were added, changed or removed.
+        """
+        seen = set()
+        todo = []
+        for index, feature in enumerate(features):
+            key = project_id(feature, index)
+            seen.add(key)
+            digest = feature_hash(feature)
+            if key not in self.projects or self.projects[key]['hash'] != digest:
+                todo.append((key, digest, feature))
+
+        changed = {q[0] for q in todo}
+        if remove_missing:
+            for key in set(self.projects) - seen:
+                del self.projects[key]
+                changed.add(key)
+
+        # the topology of all tiles the changed features touch, in one round trip
+        tiles = set()
+        for _, _, feature in todo:
+            bbox = feature_bbox(feature, self.buffer)
+            if bbox is not None:
+                tiles.update(int(q) for q in spatial.partitions_in_bbox(*bbox))
+        if tiles:
+            prefetch_partitions(sorted(tiles), layers=['topology-geometry'])
+
+        for key, digest, feature in todo:
+            self.projects[key] = {'hash': digest, 'dates': feature_dates(feature),
+                                  'segments': join_feature(feature, self.buffer, self.step)}
+        return changed
+
+    def to_dataframe(self, projects=None) -> pd.DataFrame:
+        """The join as a DataFrame with COLUMNS, optionally only for the given project ids"""
+        rows = []
+        for key in (projects if projects is not None else sorted(self.projects)):
+            if key not in self.projects:
+                continue
+            start, end = self.projects[key]['dates']
+            rows.extend((key,) + tuple(q) + (start, end) for q in self.projects[key]['segments'])
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def save(self, path):
+        """Save the state (atomically) to a JSON file"""
+        state = {'buffer': self.buffer, 'step': self.step, 'projects': {
+            key: {'hash': q['hash'], 'segments': [list(s) for s in q['segments']],
+                  'dates': [d.isoformat() if d is not None else None for d in q['dates']]}
+            for key, q in self.projects.items()}}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a state written by save() ; an empty join if the file does not exist"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as fh:
+            state = json.load(fh)
+        join = cls(state['buffer'], state['step'])
+        for key, q in state['projects'].items():
+            dates = tuple(datetime.date.fromisoformat(d) if d is not None else None for d in q['dates'])
+            join.projects[key] = {'hash': q['hash'], 'dates': dates,
+                                  'segments': [tuple(s) for s in q['segments']]}
+        return join
+
+
+def join_roadworks(path, buffer=BUFFER, step=SAMPLE_STEP) -> pd.DataFrame:
+    """One-off join of a whole feed, e.g. join_roadworks('data/cora.geojson')"""
+    join = RoadworksJoin(buffer, step)
+    join.update(iter_features(path))
+    return join.to_dataframe()
@@ -0,0 +1,1607 @@
+"""
+For now this contains all classes related to HMC access. In the future I may want
+to split this file into multiple files.
+
+The user will (mostly?) interact with the classes:
+    HmcPartition
+    TopologySegment
+These provide access to methods that logically relate to the properties of a partition
+and segment, respectively.
+
+The actual data access, and in-memory caching, is performed by the classes:
+    TopologyGeometry
+    RoadAttributes
+    NavigationAttributes
+    TrafficPatterns
+    LiveTrafficFlow
+These in turn inherit from low-level classes:
+    HmcAccess
+    TrafficAccess
+which inherit from CatalogAccess
+
+I will use int for HMC partition IDs and segment IDs (instead of the OLP standard strings)
+Convert to string only when i need to acccess the actual HMC content
+
+Some misc notes:
+- my old RibInterface did everything with python primitive types. Maybe this is a bit too simplistic
+in the long term. (Too many convoluted nested data structures -- dicts of dicts of dicts...)
+However I have started resorting to that again here, so maybe I haven't been able to improve...
+
+Some items for potential improvement:
+    In my zeal to make this a nested class-based structure instead of a single giant class, I ended up with some common
+    functions getting repeated. The attribute layers now share AttributeAccess, which compiles every attribute
+    into interval arrays (attributes.AttributeIntervals) instead of keeping the raw segment anchors.
+
+    Initially I only implemented segment.property(offset = X) returning a single value
+    Now segment.property(offset = None) returns a list of (start,end,value) for all of the attributes
+    The latter can be very useful.
+    For many segments at once use HmcPartition.attribute_values() or the AttributeIntervals themselves.
+
+"""
+
+import functools
+import os
+import pickle
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import nagini
+from nagini.utils.tiling import Point, bounding_box_from_tile_id, tile_id_from_coordinate
+import numpy as np
+
+from . import attributes
+from . import cache
+from . import fetch
+from . import graph
+from . import metrics
+from . import offset
+from . import partitionstore
+from . import patterns
+from . import trafficflow
+
+
+def id2int(s: str) -> int:
+    """
+    Convert an OLP identifier like here:cm:segment:12345 to just the integer 12345 portion
+    """
+    return int(s.split(':')[-1])
+
+
+def get_start_end(sa) -> Tuple[float, float]:
+    """
+    Convert a raw segmentAnchor sa from protobuf into a (start,end) offset as float (or int)
+    """
+
+    # It is not clear to me how nagini handles the default (non-existent) offsets now
+    # Does it already return 0.0 and 1.0?
+    # No matter what it does, this code will work
+    if sa.HasField("first_segment_start_offset"):
+        start = sa.first_segment_start_offset.value
+    else:
+        start = 0
+
+    if sa.HasField("last_segment_end_offset"):
+        end = sa.last_segment_end_offset.value
+    else:
+        end = 1
+
+    return start, end
+
+
+# basically this is synonymous with getattr(item, attr) but decodes enums in addition
+# item is a protobuf object
+def decode_enum(item, attr):
+    """
+    For enums stored in the protobuf, nagini returns the enum index, not the corresponding String
+    This is annoying -- in most cases the user wants the meaningful string and not the enum value
+
+    The automatic translation to string is possible but convoluted so we do it here.
+
+    In case attr is not a reference to an enum this method is equivalent to getattr()
+    """
+    attr_value = getattr(item, attr)
+
+    # I think this test works to detect an enum versus a non-enum but some testing ought to be done
+    if (attr in item.DESCRIPTOR.fields_by_name):
+        if item.DESCRIPTOR.fields_by_name[attr].enum_type is not None:  # new addition to the enum detection logic
+            attr_value = item.DESCRIPTOR.fields_by_name[attr].enum_type.values_by_number[attr_value].name
+    return attr_value
+
+
+def get_road_attribute(layer_accessor, offset, orientation, attribute, pid, sid):
+    """
+    Generic accessor for attributes; use orientation='ignore' to indicate not to match on orientation
+    CANNOT handle inverted segments
+    layer_accessor object must implement get_intervals() method
+
+    If None is passed for offset, will return an array of (start offset, end offset, value) instead of a single value
+    """
+    intervals = layer_accessor.get_intervals(attribute, pid)
+    if offset is None:
+        return intervals.ranges(sid, orientation)
+    return intervals.value(sid, orientation, offset)
+
+
+# nagini resources are created on first use, not at import: connecting to OLP and reading schemas takes seconds
+# (and needs the network), and most jobs only touch a few layers
+@functools.lru_cache(maxsize=None)
+def get_olp():
+    """The nagini OLP resource"""
+    return nagini.resource('olp')
+
+
+@functools.lru_cache(maxsize=None)
+def get_catalog(catalog_hrn):
+    """The nagini catalog of an HRN"""
+    return get_olp().catalog_by_hrn(catalog_hrn)
+
+
+@functools.lru_cache(maxsize=None)
+def get_layer(catalog_hrn, layer_id):
+    """The nagini layer of a catalog"""
+    return get_catalog(catalog_hrn).layer_by_id(layer_id)
+
+
+# directory where schemas are kept between runs ; None (the default, unless HMCTOOLS_SCHEMA_CACHE_DIR is set)
+# means every process reads them from OLP. Delete the files to pick up a new schema.
+SCHEMA_CACHE_DIR = os.environ.get('HMCTOOLS_SCHEMA_CACHE_DIR')
+
+
+@functools.lru_cache(maxsize=None)
+def get_schema(layer, catalog_hrn, layer_id):
+    """
+    The schema of a layer, from the local schema cache if it is enabled (see SCHEMA_CACHE_DIR)
+    Schemas that cannot be pickled are simply not cached locally.
+    """
+    path = None
+    if SCHEMA_CACHE_DIR:
+        path = os.path.join(os.path.expanduser(SCHEMA_CACHE_DIR),
+                            (catalog_hrn + '.' + layer_id).replace(':', '_') + '.pickle')
+        try:
+            with open(path, 'rb') as fh:
+                return pickle.load(fh)
+        except Exception:
+            pass  # not cached yet (or unreadable) ; read it from OLP
+
+    schema = layer.read_schema()
+    if path is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as fh:
+                pickle.dump(schema, fh)
+            os.replace(tmp, path)
+        except Exception:
+            pass
+    return schema
+
+
+class LazyAttribute:
+    """
+    Class attribute that is computed the first time it is used (from the class or an instance) and then kept
+    func is called with the class it is looked up on, e.g.
+        _layer = LazyAttribute(lambda cls: get_layer(cls._catalog_hrn, cls._layer_id))
+    Assigning to the attribute of a class (e.g. a fakecatalog.FakeLayer in a test) replaces it.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self._values = {}  # key is the class
+
+    def __get__(self, obj, owner):
+        if owner not in self._values:
+            self._values[owner] = self.func(owner)
+        return self._values[owner]
+
+
+# ##### want to have the highest reuse of code possible
+#      (least code duplication)
+# here we've got just the definition of the olp resource
+# and a generic function for reading and parsing one partition of data
+# from a versioned or volatile catalog
+# We don't define which catalog here because this function can be shared between
+# RIB and other catalogs
+class CatalogAccess:
+    # this OLP resource is a class variable and thus will be shared by every child of this class
+    _olp = LazyAttribute(lambda cls: get_olp())
+    # the catalog of the child class (from _catalog_hrn), and the layer and schema of a layer class (from _layer_id) ;
+    # all of them are only looked up when first used
+    _catalog = LazyAttribute(lambda cls: get_catalog(cls._catalog_hrn))
+    _layer = LazyAttribute(lambda cls: get_layer(cls._catalog_hrn, cls._layer_id))
+    _schema = LazyAttribute(lambda cls: get_schema(cls._layer, cls._catalog_hrn, cls._layer_id))
+
+    # this could just be a function defined outside the class, but I would like to keep it
+    # inside the class to keep it more "hidden"
+    @staticmethod
+    def read_data(layer, schema, pid, version, store_key=None, layer_id=None):
+        """
+        Read and decode one partition
+
+        store_key is an optional (catalog HRN, layer id) pair. If given, the raw blob is looked up in
+        (and saved to) the persistent partition store before going to OLP.
+        Volatile layers should not pass a store_key ; they can pass their layer_id instead, which is
+        used for de-duplicating fetches and in the metrics.
+        """
+        layer_key = store_key[1] if store_key is not None else layer_id
+        store = partitionstore.get_default_store() if store_key is not None else None
+        if store is not None:
+            catalog_hrn, layer_id = store_key
+            pblob = store.get(catalog_hrn, layer_id, version, pid)
+            metrics.count('store_hits' if pblob is not None else 'store_misses', layer_key)
+            if pblob is not None:
+                try:
+                    with metrics.timed('decode', layer_key, pid, len(pblob)):
+                        return schema.decode_blob(pblob)
+                except Exception:
+                    # corrupt or truncated entry ; drop it and go to OLP instead
+                    print('unexpected error decoding stored blob', layer_id, pid)
+                    store.discard(catalog_hrn, layer_id, version, pid)
+
+        # the fetch engine takes care of retries, backoff, and de-duplicating concurrent requests for the same
+        # partition ; here we only retry (once) if the downloaded blob cannot be decoded
+        fetcher = fetch.get_fetcher()
+        for attempt in range(2):
+            try:
+                pblob = fetcher.fetch(layer, pid, version, layer_key)
+            except fetch.FetchError as e:
+                print('failure getting data', layer_key, pid, e)
+                break
+
+            try:
+                with metrics.timed('decode', layer_key, pid, len(pblob)):
+                    parsed = schema.decode_blob(pblob)
+                # print('         success decoding blob',pid) #for debugging
+            except Exception:  # nagini/protobuf do not document what they raise for bad blobs
+                print('unexpected error decoding blob', layer_key, pid)
+                continue
+
+            # only store blobs that decoded successfully
+            if store is not None:
+                store.put(catalog_hrn, layer_id, version, pid, pblob)
+            return parsed
+        print("reading data from OLP FAILED")
+        return None
+
+    @staticmethod
+    def read_data_many(layer, schema, pids, version, store_key=None):
+        """
+        Read and decode several partitions of one layer, return a dict of pid -> decoded partition
+
+        The partitions that are not in the persistent store are requested in a single read_partitions call.
+        read_partitions does not tell us which blob belongs to which partition, so the blobs are matched
+        using the partition_name inside the decoded data (which all RIB-2 layers have).
+        Anything that cannot be matched that way is read one partition at a time by read_data.
+        """
+        output = {}
+        store = partitionstore.get_default_store() if store_key is not None else None
+
+        missing = []
+        for pid in pids:
+            pblob = store.get(store_key[0], store_key[1], version, pid) if store is not None else None
+            if store is not None:
+                metrics.count('store_hits' if pblob is not None else 'store_misses', store_key[1])
+            if pblob is not None:
+                try:
+                    with metrics.timed('decode', store_key[1], pid, len(pblob)):
+                        output[pid] = schema.decode_blob(pblob)
+                    continue
+                except Exception:
+                    store.discard(store_key[0], store_key[1], version, pid)
+            missing.append(pid)
+
+        if len(missing) > 1:
+            layer_key = store_key[1] if store_key is not None else None
+            try:
+                with metrics.timed('fetch', layer_key) as t:
+                    pblobs = list(layer.read_partitions([str(q) for q in missing], version))
+                    t.nbytes = sum(len(q) for q in pblobs)
+            except Exception:
+                print('Exception reading partitions', missing)
+                pblobs = []
+            for pblob in pblobs:
+                try:
+                    with metrics.timed('decode', layer_key, None, len(pblob)):
+                        parsed = schema.decode_blob(pblob)
+                    pid = int(getattr(parsed, 'partition_name', ''))
+                except Exception:
+                    continue
+                if (pid in missing) and (pid not in output):
+                    output[pid] = parsed
+                    if store is not None:
+                        store.put(store_key[0], store_key[1], version, pid, pblob)
+
+        # fall back to the one-at-a-time read (with its retries) for anything still missing
+        for pid in missing:
+            if pid not in output:
+                output[pid] = CatalogAccess.read_data(layer, schema, pid, version, store_key)
+        return output
+
+"""
+Each catalog that we're going to access needs a class that inherits from CatalogAccess.
+The catalog HRN and nagini catalog object is a class variable so that it is shared between instances.
+The catalog, layer and schema are looked up the first time they are used (see LazyAttribute), so importing
+this module does not touch OLP.
+Here we have access classes for the HMC and Traffic.
+In weather.py we have a similar class for Weather
+"""
+
+
+# inherit from CatalogAccess and define the catalog to be HMC (RIB-2)
+class HmcAccess(CatalogAccess):
+    _catalog_hrn = 'hrn:here:data:::rib-2'
+    _hmc_version = None  # or a hard-coded version if desired ; default to latest version
+
+    # layer is a nagini layer and schema is a nagini schema ; pid is an integer
+    # access the catalog and use the schema to decode the data
+    # FIXME better error handling tbd
+    # I did not have a good plan for leading underscores in method names. To be improved.
+    # HMC layers are versioned, so the raw blobs can go into the persistent partition store
+    def _read_data(self, layer, schema, pid):
+        return super().read_data(layer, schema, pid, self._hmc_version, (self._catalog_hrn, self._layer_id))
+
+    def _read_data_many(self, layer, schema, pids):
+        return super().read_data_many(layer, schema, pids, self._hmc_version, (self._catalog_hrn, self._layer_id))
+
+
+class TrafficAccess(CatalogAccess):
+    _catalog_hrn = 'hrn:here:data:::olp-traffic-1'
+
+    # set version=None because there are no versioned layers in this catalog (volatile only)
+    def _read_data(self, layer, schema, pid):
+        return super().read_data(layer, schema, pid, None, layer_id=self._layer_id)
+
+
+"""
+Now define classes for parsing the data pulled from the OLP catalogs.
+There is one class per layer.
+
+These classes also keep the decoded (and flattened) partitions in memory, in a per-layer LayerCache
+from cache.py. The caches have a memory budget with LRU eviction, and the volatile traffic-flow layer
+has a time-to-live, so a long-running job does not grow without limit or serve stale traffic.
+_load_data() returns the partition data ; do not assume it is still in the cache afterwards.
+"""
+
+
+class LiveTrafficFlow(TrafficAccess):
+    _layer_id = 'traffic-flow'
+    _data = cache.get_cache(_layer_id)
+    # the columnar form is only built if someone asks for it with get_arrays()
+    _arrays = cache.get_cache(_layer_id + '-arrays')  # key is partition -> TrafficFlowArrays
+
+    # For volatile layers, the concept of having a cache is a little more ugly:
+    # The data is not persistent even at the source so the idea of keeping it
+    # cached locally is dubious.
+    # However I still think that the overhead of accessing the data on OLP will be high
+    # so i think a local cache is still justified for a short running job
+    # Maybe even desirable from the perspective of data consistency...
+    # The cache for this layer has a ttl (see cache.DEFAULT_SETTINGS) so a long running job will pick up new data.
+
+    def _load_data(self, pid):
+        return self._load_snapshot(pid)[0]
+
+    def _load_snapshot(self, pid):
+        """
+        Return (decoded partition, segment index) for the current snapshot of the partition
+        Both come from the same cache entry, so they always belong to the same snapshot.
+        """
+        snapshot = self._data.get(pid)
+        if snapshot is not None:
+            #print("\t\tLiveTrafficFlow cache hit",pid)
+            return snapshot
+
+        #print("\t\tLiveTrafficFlow cache miss",pid)
+        parsed = super()._read_data(self._layer, self._schema, pid)
+        return self._ingest(pid, parsed)
+
+    @metrics.traced('flatten')
+    def _ingest(self, pid, parsed):
+        """Index a decoded partition, put it in the cache and return (parsed, index) (also used by prefetch)"""
+        # in the zeppelin code i did not do a "flattening" like i did for RIB data
+        # i just filled the cache like this
+        # (plus the segment index, so lookups do not have to go through every item)
+        snapshot = (parsed, self._index_segments(parsed))
+        self._data.put(pid, snapshot, cache.estimate_size(parsed))
+        return snapshot
+
+    def get_arrays(self, pid) -> trafficflow.TrafficFlowArrays:
+        """
+        Return the current snapshot of the partition as a TrafficFlowArrays
+        If the decoded protobuf is not cached already it is not kept, only the (much smaller) arrays are.
+        """
+        arrays = self._arrays.get(pid)
+        if arrays is not None:
+            return arrays
+        snapshot = self._data.get(pid)
+        parsed = snapshot[0] if snapshot is not None else super()._read_data(self._layer, self._schema, pid)
+        arrays = trafficflow.TrafficFlowArrays.from_parsed(parsed)
+        self._arrays.put(pid, arrays, arrays.nbytes)
+        return arrays
+
+    @staticmethod
+    def _index_segments(parsed):
+        """
+        Build the inverted index segment id -> list of (item index, position in item, is_first_segment_in_driving_direction)
+        Only the first position is kept if a segment occurs more than once in the same item.
+        """
+        index = {}
+        if parsed is None:
+            return index
+        for item_index, item in enumerate(parsed.items):
+            ts = item.topology_segment
+            trafitem_dd = ts.is_first_segment_in_driving_direction
+            for position, sid in enumerate(ts.topology_segment_id):
+                entries = index.setdefault(sid, [])
+                if len(entries) == 0 or entries[-1][0] != item_index:
+                    entries.append((item_index, position, trafitem_dd))
+        return index
+
+
+def _forget(pid, sids):
+    for sid in sids:
+        if TopologyGeometry._pidlookup.get(sid) == pid:
+            del TopologyGeometry._pidlookup[sid]
+
+
+# _pidlookup is filled from the protobuf cache, or from the graph cache in compact mode ; the eviction callbacks
+# must not look into the other cache (they may run in any thread), so each one only forgets what it filled
+
+def _forget_segments(pid, pdata):
+    """Eviction callback for the TopologyGeometry cache: keep _pidlookup consistent with the cache"""
+    if not TopologyGeometry.compact:
+        _forget(pid, pdata[0])
+
+
+def _forget_graph(pid, pgraph):
+    """Eviction callback for the graph cache: the same for the segments of a RoadGraph in compact mode"""
+    if TopologyGeometry.compact:
+        _forget(pid, pgraph.seg_sid.tolist())
+
+
+class TopologyGeometry(HmcAccess):
+    # Some of the implementation is copied from curv_utils.py
+
+    _layer_id = 'topology-geometry'
+    # key is partition id ; value is a pair of
+    #   dict of segment IDs mapping to the segment data itself
+    #   dict of nodeID -> Node Data
+    _data = cache.get_cache(_layer_id, on_evict=_forget_segments)
+    _pidlookup = {}  # for Segment ID -> Partition lookups (only for partitions that are in the cache)
+    # key is partition id ; value is an offset.PackedShapes with the shape points and cumulative lengths
+    _shapes = cache.get_cache(_layer_id + '-shapes')
+    # key is partition id ; value is a spatial.SegmentIndex
+    _indexes = cache.get_cache(_layer_id + '-index')
+    index_dir = None  # if set, spatial indexes are saved here (one directory per partition) and memory-mapped
+    # a segmentindex.SegmentPartitionIndex ; if set, translate_segments finds partitions in it instead of
+    # walking from node to node (see segmentindex.use_index)
+    partition_index = None
+    # key is partition id ; value is a graph.RoadGraph, the compact (array) form of the partition
+    _graphs = cache.get_cache(_layer_id + '-graph', on_evict=_forget_graph)
+    # if True, nodes, adjacency, lengths and shapes come from the RoadGraph of the partition and the decoded
+    # protobuf is not kept (see get_graph) ; the default keeps the protobuf, like it always did
+    compact = False
+
+    def _load_data(self, pid):
+        """
+        Load data from the cache or, if not in the cache, from OLP
+        This should not be called by the user.
+        Instead every method called by the user should call this method as a first step
+
+        Returns the dict of segment ID -> segment data for the partition
+        """
+        return self._load_partition(pid)[0]
+
+    def _load_nodes(self, pid):
+        """Same as _load_data but returns the dict of node ID -> connected segments for the partition"""
+        return self._load_partition(pid)[1]
+
+    def _load_partition(self, pid):
+        pdata = self._data.get(pid)
+        if pdata is not None:
+            #print("\t\tTopologyGeometry cache hit",pid)
+            return pdata
+        #print("\t\tTopologyGeometry cache miss",pid)
+
+        parsed = super()._read_data(self._layer, self._schema, pid)
+        if parsed is None:
+            raise ValueError('no topology-geometry data for partition ' + str(pid))
+        if self.compact:
+            # the few callers that still want the protobuf in compact mode get it, but it is not cached
+            return self._flatten(pid, parsed)
+        return self._ingest(pid, parsed)
+
+    @metrics.traced('flatten')
+    def _ingest(self, pid, parsed):
+        """
+        Index a decoded partition, put it in the cache and return it (also used by prefetch)
+        In compact mode only the graph is built and cached, and None is returned.
+        """
+        if self.compact:
+            self._put_graph(pid, graph.RoadGraph.from_parsed(pid, parsed, id2int))
+            return None
+        pdata = self._flatten(pid, parsed)
+        self._data.put(pid, pdata, cache.estimate_size(parsed))
+        for sid in pdata[0]:
+            self._pidlookup[sid] = pid
+        return pdata
+
+    @metrics.traced('flatten')
+    def _flatten(self, pid, parsed):
+        """The dict of segment ID -> segment and the dict of node ID -> connected segments of a decoded partition"""
+        segments = {}
+        nodes = {}
+
+        segment_data = parsed.segment
+        # this is an iterable of type Segment
+        # we want to store the data for access that avoids loops
+        # so we want a dict (pid,sid) -> segment data
+
+        for seg in segment_data:
+            sidI = id2int(seg.identifier)
+
+            # the segment protobuf doesn't really need any "flattening" or other manipulation
+            # just store it in the cache without any manipulation
+            segments[sidI] = seg
+
+        node_data = parsed.node
+        for n in node_data:
+            nid = id2int(n.identifier)
+            # only store the segment ref list
+            # ### question for my data model...do I construct TopologySegments here?
+            #     or do i just keep the partition,segment id in tuples?
+            #     for now i will stick with tuples
+            nodes[nid] = [(int(q.partition_name), id2int(q.identifier)) for q in n.segment_ref]
+
+        return segments, nodes
+
+    def get_shape_points(self, pid, sid, fmt='tuples'):
+        """
+        Return the shape points (including nodes) for the segment.
+        Return type depends on fmt:
+            'tuples' -> list of tuples of (lat, lon)
+        """
+        # i am leaving myself flexibility to return other formats here, for instance a list of nagini Point instead of
+        # plain tuple, or even geoJson
+        if self.compact:
+            points = self.get_graph(pid).shape(pid, sid)
+            if points is None or fmt != 'tuples':
+                return None
+            return [tuple(q) for q in points.tolist()]
+        segments = self._load_data(pid)
+        output = None
+        if sid in segments:
+            if fmt == 'tuples':
+                output = [(q.latitude, q.longitude) for q in segments[sid].geometry.point]
+
+        return output
+
+    def get_packed_shapes(self, pid) -> offset.PackedShapes:
+        """
+        Return the shapes of all segments in the partition as an offset.PackedShapes, which has the cumulative
+        lengths and does the batch offset <-> coordinate conversions
+        """
+        shapes = self._shapes.get(pid)
+        if shapes is None:
+            if self.compact:
+                shapes = offset.PackedShapes(self.get_graph(pid).shapes(pid))
+            else:
+                segments = self._load_data(pid)
+                shapes = offset.PackedShapes({sid: [(q.latitude, q.longitude) for q in seg.geometry.point]
+                                              for sid, seg in segments.items()})
+            self._shapes.put(pid, shapes, shapes.nbytes)
+        return shapes
+
+    def get_graph(self, pid) -> graph.RoadGraph:
+        """
+        Return the graph.RoadGraph of the partition: segments, nodes and adjacency as arrays
+        It is built from the decoded partition, which is only kept in the cache if it was there already.
+        """
+        pgraph = self._graphs.get(pid)
+        if pgraph is not None:
+            return pgraph
+        parsed = super()._read_data(self._layer, self._schema, pid)
+        if parsed is None:
+            raise ValueError('no topology-geometry data for partition ' + str(pid))
+        pgraph = graph.RoadGraph.from_parsed(pid, parsed, id2int)
+        self._put_graph(pid, pgraph)
+        return pgraph
+
+    def _put_graph(self, pid, pgraph):
+        self._graphs.put(pid, pgraph, pgraph.nbytes)
+        # the protobuf is not loaded in compact mode, so the graph keeps the segment -> partition lookup
+        if self.compact:
+            for sid in pgraph.seg_sid.tolist():
+                self._pidlookup[sid] = pid
+
+    def get_graphs(self, pids) -> graph.RoadGraph:
+        """The RoadGraphs of several partitions merged into one, e.g. for the tiles of a city"""
+        return graph.RoadGraph.merge([self.get_graph(pid) for pid in pids])
+
+    def get_spatial_index(self, pid):
+        """
+        Return the spatial.SegmentIndex of the partition, for bounding box and nearest segment queries
+        If index_dir is set, the index is loaded from (or, the first time, saved to) index_dir/pid
+        """
+        from . import spatial  # spatial imports this module
+
+        index = self._indexes.get(pid)
+        if index is not None:
+            return index
+
+        directory = os.path.join(self.index_dir, str(pid)) if self.index_dir is not None else None
+        if directory is not None and os.path.exists(os.path.join(directory, 'grid.npy')):
+            index = spatial.SegmentIndex.load(directory)
+        else:
+            index = spatial.SegmentIndex.from_shapes(self.get_packed_shapes(pid))
+            if directory is not None:
+                index.save(directory)
+        self._indexes.put(pid, index, index.nbytes)
+        return index
+
+    def segments_in_bbox(self, pid, south, west, north, east):
+        """Return the IDs of the segments in the partition that are in the box (see also spatial.segments_in_bbox)"""
+        return [int(q) for q in self.get_spatial_index(pid).segments_in_bbox(south, west, north, east)]
+
+    def nearest_segments(self, pid, lat, lon, k=5, max_dist=50.0):
+        """
+        Return a list of (sid, distance in meters, offset) of the k nearest segments in the partition within
+        max_dist meters (see also spatial.nearest_segments, which looks across partition boundaries)
+        """
+        return self.get_spatial_index(pid).nearest_segments(lat, lon, k, max_dist)
+
+    def points_from_offsets(self, pid, sids, offsets):
+        """Batch version of TopologySegment.point_from_offset: (n, 2) array of (lat, lon) for arrays of sids/offsets"""
+        return self.get_packed_shapes(pid).interpolate(sids, offsets)
+
+    def offsets_from_points(self, pid, sids, lats, lons):
+        """
+        Batch version of TopologySegment.get_offset: project arrays of coordinates onto the given segments
+        Returns (offsets, distances in meters)
+        """
+        return self.get_packed_shapes(pid).project(sids, lats, lons)
+
+    def get_node(self, pid, sid, index) -> Tuple[int, int]:
+        """
+        Fetch start/end nodes of a segment as (partition, node ID) pair; index=0 means start, 1 means end
+        """
+        assert index in [0, 1], 'illegal node index'
+        if self.compact:
+            return self.get_graph(pid).node(pid, sid, index)
+        segments = self._load_data(pid)
+        if sid in segments:
+            if index == 0:
+                n = segments[sid].start_node_ref
+            elif index == 1:
+                n = segments[sid].end_node_ref
+            return int(n.partition_name), id2int(n.identifier)
+
+    # Not clear if this should be implemented here or as a method of a Node class
+    # I will just do it here
+    def get_connected_segments(self, pid, nid):
+        """
+        For the given node, return a list of connected segments as List[TopologySegment]
+        """
+        if self.compact:
+            connected = self.get_graph(pid).connected_segments(pid, nid)
+            return [TopologySegment(q[0], q[1]) for q in connected] if connected is not None else None
+        nodes = self._load_nodes(pid)
+        if nid in nodes:
+            # not clear if it is better to stick to plain IDs or construct the TopologySegment objects
+            return [TopologySegment(q[0], q[1]) for q in nodes[nid]]
+
+    def get_shared_node(self, pid1, sid1, pid2, sid2):
+        """
+        Given 2 segments, return the node (pid, nid) shared by the segments
+        """
+        if not self.compact:
+            self._load_data(pid1)
+            self._load_data(pid2)
+
+        # try all 4 combinations of orientations for 2 joined segments
+        for which_node1 in [0, 1]:
+            for which_node2 in [0, 1]:
+                if (self.get_node(pid1, sid1, which_node1) == self.get_node(pid2, sid2, which_node2)):
+                    return self.get_node(pid1, sid1, which_node1)
+
+        # in case the segments don't intersect
+        return None
+
+    def get_shared_node2(self, pid1, sid1, sid2):
+        """
+        Given 2 segments, return the node (pid, nid) shared by the segments
+        This is an alternative implementation that does not require knowing the partition ID of segment 2
+        """
+        sid1node1 = self.get_node(pid1, sid1, 0)
+        sid1node2 = self.get_node(pid1, sid1, 1)
+
+        for inode in [sid1node1, sid1node2]:
+            connected_segments = self.get_connected_segments(inode[0], inode[1])
+            if sid2 in [q.sid for q in connected_segments]:
+                return inode  # (pid,nid)
+        return None
+
+    def get_segment_length(self, pid, sid) -> float:
+        """
+        Get segment length
+        """
+        if self.compact:
+            return self.get_graph(pid).segment_length(pid, sid)
+        segments = self._load_data(pid)
+
+        if sid in segments:
+            return segments[sid].length
+        return None
+
+    def get_all_segment_ids(self, pid):
+        """
+        Given a Partition ID, get a list of all segment IDs
+        """
+        if self.compact:
+            return self.get_graph(pid).segment_ids(pid).tolist()
+        data = self._load_data(pid)
+        return list(data.keys())
+
+    def translate_segments(self, pid, sid, seglist):
+        """
+        Input: segment ID list [123,456,789,987,654] where the partition is known only for an arbitrary ID in the list
+        Output:  [(pid1,123),(pid2,456),(pid3,789),etc]
+
+        Not likely to be needed by the average user but needed internally for interpreting live traffic data
+        """
+        N = len(seglist)
+        output = [None] * N
+
+        i0 = seglist.index(sid)
+        # put known result into output
+        output[i0] = (pid, sid)
+
+        # everything the partition index knows needs no node walking (and no loading of neighbouring partitions)
+        if self.partition_index is not None:
+            for i, the_pid in enumerate(self.partition_index.lookup(seglist).tolist()):
+                if output[i] is None and the_pid >= 0:
+                    output[i] = (the_pid, seglist[i])
+
+        # go forward from known result to the end of the list
+        for i in range(i0 + 1, N):
+            if output[i] is not None:
+                continue
+            the_pid = output[i - 1][0]
+            the_sid = output[i - 1][1]
+            adjacent_partition = self.get_partition_for_adjacent_segment(the_pid, the_sid, seglist[i])
+            output[i] = (adjacent_partition, seglist[i])
+
+        # now go backward from known result to beginning of list
+        for i in range(i0 - 1, -1, -1):
+            if output[i] is not None:
+                continue
+            the_pid = output[i + 1][0]
+            the_sid = output[i + 1][1]
+            adjacent_partition = self.get_partition_for_adjacent_segment(the_pid, the_sid, seglist[i])
+            output[i] = (adjacent_partition, seglist[i])
+        return output
+
+    def get_partition_for_adjacent_segment(self, pid, sid, sid2):
+        """
+        in case we know the pId,sId for one segment,
+           and the sId of an adjacent segment, but do NOT know the partition for that adjacent segment
+        This method will determine and return that unknown partition Id
+        """
+        if self.partition_index is not None:
+            the_pid = self.partition_index.partition(sid2)
+            if the_pid is not None:
+                return the_pid
+        # a segment of a partition that we have loaded already
+        the_pid = self._pidlookup.get(sid2)
+        if the_pid is not None:
+            return the_pid
+        shared_node = self.get_shared_node2(pid, sid, sid2)
+        if shared_node is None:
+            raise ValueError("In get_partition_for_adjacent_segment: shared_node is None")
+        connected_segs = self.get_connected_segments(shared_node[0], shared_node[1])
+        for seg in connected_segs:
+            if sid2 == seg.sid: #seg[1]:
+                return seg.pid #seg[0]
+        return None
+
+
+class TrafficPatterns(HmcAccess):
+    _layer_id = 'traffic-patterns'
+    _data = cache.get_cache(_layer_id)  # key is partition -> TrafficPatternMatrix
+    # the flattened protobuf patterns are only built if someone asks for them with traffic_pattern()
+    _raw_data = cache.get_cache(_layer_id + '-raw')  # key is partition -> attribute -> dict of segments
+
+    def _load_data(self, pid):
+        """Return the TrafficPatternMatrix for the partition"""
+        pdata = self._data.get(pid)
+        if pdata is not None:
+            return pdata
+
+        # read the data from OLP
+        parsed = super()._read_data(self._layer, self._schema, pid)
+        return self._ingest(pid, parsed)
+
+    @metrics.traced('flatten')
+    def _ingest(self, pid, parsed):
+        """Decode a partition into a TrafficPatternMatrix, put it in the cache and return it (also used by prefetch)"""
+        matrix = patterns.TrafficPatternMatrix.from_parsed(parsed, parsed.segment_anchor, id2int, get_start_end)
+        self._data.put(pid, matrix, matrix.nbytes)
+        return matrix
+
+    def _load_raw(self, pid):
+        """Return the flattened protobuf patterns (attribute -> segment ID -> list of (anchor, pattern))"""
+        pdata = self._raw_data.get(pid)
+        if pdata is not None:
+            return pdata
+        pdata = {}  # key is attribute, then segment ID
+
+        # read the data from OLP (or, more likely by now, the partition store)
+        parsed = super()._read_data(self._layer, self._schema, pid)
+        anchors = parsed.segment_anchor
+        self._flatten_trafficpatterns(pdata, parsed, anchors)
+
+        self._raw_data.put(pid, pdata, cache.estimate_size(parsed))
+        return pdata
+
+    def _flatten_trafficpatterns(self, pdata, parsed, anchors):
+        attribute = 'traffic_pattern'
+        pdata[attribute] = {}  # key is segment id
+
+        attrlist = getattr(parsed, attribute)
+        for item in attrlist:
+            # fetch all of the data for this pattern
+            pattern = getattr(item, attribute)
+            sai_list = item.segment_anchor_index
+            for sai in sai_list:
+                anchor = anchors[sai]
+                assert len(anchor.oriented_segment_ref) == 1, 'load_accessible_data wrong length of osr list'
+                segid = id2int(anchor.oriented_segment_ref[0].segment_ref.identifier)
+                if segid not in pdata[attribute]:
+                    pdata[attribute][segid] = []
+                pdata[attribute][segid].append((anchor, pattern))
+
+
+class AttributeAccess(HmcAccess):
+    """
+    Common code of the attribute layers (navigation-attributes, road-attributes, ...)
+    A partition is kept as a dict of attribute -> attributes.AttributeIntervals.
+    """
+    # attribute name -> (repeated field of the partition, field of its items that holds the value or None)
+    ATTRIBUTES = {}
+    # the attributes compiled when a partition is loaded ; the others are compiled when they are first asked for
+    # (reading the partition again, from the partition store if it is enabled)
+    eager_attributes = ()
+
+    def _load_data(self, pid):
+        # check if data is already loaded
+        pdata = self._data.get(pid)
+        if pdata is not None:
+            return pdata
+
+        # read the data from OLP
+        parsed = super()._read_data(self._layer, self._schema, pid)
+        return self._ingest(pid, parsed)
+
+    @metrics.traced('flatten')
+    def _ingest(self, pid, parsed, names=None):
+        """Compile attributes of a decoded partition, put them in the cache and return them (also used by prefetch)"""
+        pdata = dict(self._data.get(pid) or {})  # key is attribute
+        for attribute in (self.eager_attributes if names is None else names):
+            field, value_field = self.ATTRIBUTES[attribute]
+            pdata[attribute] = attributes.AttributeIntervals.from_parsed(parsed, field, value_field, id2int,
+                                                                         get_start_end)
+        self._data.put(pid, pdata, sum(q.nbytes for q in pdata.values()))
+        return pdata
+
+    def get_intervals(self, attribute, pid) -> attributes.AttributeIntervals:
+        """Return the AttributeIntervals of one attribute of the partition"""
+        assert attribute in self.ATTRIBUTES, 'get_intervals (%s): incorrect attribute: %s' % (
+            type(self).__name__, attribute)
+        pdata = self._load_data(pid)
+        if attribute not in pdata:
+            parsed = super()._read_data(self._layer, self._schema, pid)
+            pdata = self._ingest(pid, parsed, [attribute])
+        return pdata[attribute]
+
+
+class NavigationAttributes(AttributeAccess):
+    _layer_id = 'navigation-attributes'
+    _data = cache.get_cache(_layer_id)  # key is partition -> attribute -> AttributeIntervals
+
+    # travel direction is weird in that there is no attribute value ; the orientation is the direction
+    ATTRIBUTES = {'travel_direction': ('travel_direction', None),
+                  'speed_category': ('speed_category', 'speed_category')}
+    eager_attributes = tuple(ATTRIBUTES)
+
+
+class AdvancedNavigationAttributes(AttributeAccess):
+    _layer_id = 'advanced-navigation-attributes'
+    _data = cache.get_cache(_layer_id)  # key is partition -> attribute -> AttributeIntervals
+
+    ATTRIBUTES = {'speed_limit:value': ('speed_limit', 'value')}  # extract only the value from speed limit
+    eager_attributes = tuple(ATTRIBUTES)
+
+
+class RoadAttributes(AttributeAccess):
+    _layer_id = 'road-attributes'
+    _data = cache.get_cache(_layer_id)  # key is partition -> attribute -> AttributeIntervals
+
+    # note: we have no choice but to read the whole partition of the road-attributes layer
+    # (of course if we were using OMA this would be somewhat different)
+    # but we only compile the attributes listed in eager_attributes ; set it to e.g. ('functional_class',) to save the
+    # time and memory of the others, which are then compiled when they are first asked for
+    ATTRIBUTES = {'functional_class': ('functional_class', 'functional_class'),
+                  'iso_country_code': ('iso_country_code', 'iso_country_code'),
+                  # there are lots of attributes: autos, motor cycles, etc ; the value holds all of them
+                  'accessible_by': ('accessible_by', 'applies_to')}
+    eager_attributes = tuple(ATTRIBUTES)
+
+
+"""
+Define the "user-facing" classes:
+    HmcPartition
+    TopologySegment
+These abstract away, to some extent, the fact that there are all of these different layers for the HMC (and related) data
+Instead just give the user a segment object and have that class implement accessors for all of the properties that
+segments can have.
+
+These classes instantiate and call the classes defined above as needed.
+Because the nagini data access and my data caches are class variables, they will between
+all instances of each class.
+"""
+
+
+# remains to be seen "how needed" this class is
+# maybe it is just a wrapper around TopologyGeometry
+# or maybe there is more than 1 layer that we'll want properties of a partition for
+# and then this will provide a nice abstraction
+class HmcPartition:
+    def __init__(self, pid):
+        self.pid = pid
+
+    def get_all_segment_ids(self):
+        """
+        return a list of segment Ids for all segments in the partition
+        """
+        topo = TopologyGeometry()
+        return topo.get_all_segment_ids(self.pid)
+
+    def prefetch(self, layers=None, neighbours=False, pids=None, max_workers=8):
+        """
+        Load this partition (plus any others given in pids) for all of the requested layers in parallel,
+        so that the TopologySegment accessors afterwards are served from the cache.
+        See prefetch_partitions() for the arguments.
+        """
+        all_pids = [self.pid] + [q for q in (pids or []) if q != self.pid]
+        prefetch_partitions(all_pids, layers, neighbours, max_workers)
+
+    def attribute_values(self, accessor, attribute, sids, offsets, orientation='ignore', decode=True):
+        """
+        Batch lookup of an attribute for arrays of segments/offsets in this partition, e.g.
+            p.attribute_values(RoadAttributes, 'functional_class', sids, 0.5)
+        Returns an object array of values (None where there is none), or the integer codes if decode is False
+        """
+        intervals = accessor().get_intervals(attribute, self.pid)
+        if decode:
+            return intervals.values_at(sids, orientation, offsets)
+        return intervals.codes_at(sids, orientation, offsets)
+
+    def functional_class(self, sids, offsets):
+        """Batch version of TopologySegment.functional_class"""
+        return self.attribute_values(RoadAttributes, 'functional_class', sids, offsets)
+
+    def speed_category(self, sids, offsets):
+        """Batch version of TopologySegment.speed_category"""
+        return self.attribute_values(NavigationAttributes, 'speed_category', sids, offsets)
+
+    def speed_limit(self, sids, offsets, direction):
+        """Batch version of TopologySegment.speed_limit"""
+        return self.attribute_values(AdvancedNavigationAttributes, 'speed_limit:value', sids, offsets, direction)
+
+    def travel_direction(self, sids, offsets):
+        """Batch version of TopologySegment.travel_direction"""
+        return NavigationAttributes().get_intervals('travel_direction', self.pid).orientations_at(sids, offsets)
+
+    def accessible_by(self, sids, offsets, which='automobiles'):
+        """Batch version of TopologySegment.accessible_by ; None where there is no value"""
+        intervals = RoadAttributes().get_intervals('accessible_by', self.pid)
+        # one getattr per distinct value ; the extra None at the end is for code -1
+        table = np.array([getattr(q, which) for q in intervals.values] + [None], dtype=object)
+        return table[intervals.codes_at(sids, 'ignore', offsets)]
+
+    def live_vs_historical(self, tz, offset=0.5):
+        """
+        Compare live and historical traffic speed for every drivable segment in the partition
+        Returns (results, failures) DataFrames ; see comparison.live_vs_historical()
+        """
+        # imported here so that pandas is only needed by those who use this
+        from . import comparison
+        return comparison.live_vs_historical(self.pid, tz, offset)
+
+
+# layer id -> class ; the layers that prefetch_partitions() knows about
+LAYER_CLASSES = {
+    TopologyGeometry._layer_id: TopologyGeometry,
+    RoadAttributes._layer_id: RoadAttributes,
+    NavigationAttributes._layer_id: NavigationAttributes,
+    AdvancedNavigationAttributes._layer_id: AdvancedNavigationAttributes,
+    TrafficPatterns._layer_id: TrafficPatterns,
+    LiveTrafficFlow._layer_id: LiveTrafficFlow,
+}
+
+# what a live vs historical sweep over a partition touches
+DEFAULT_PREFETCH_LAYERS = ('topology-geometry', 'road-attributes', 'navigation-attributes', 'traffic-patterns',
+                           'traffic-flow')
+
+
+def neighbour_tiles(pid):
+    """Return the (up to 8) tiles at the same level that surround the tile pid"""
+    level = (pid.bit_length() - 1) // 2
+    size = 360.0 / 2 ** level
+    center = bounding_box_from_tile_id(pid).center()
+
+    output = []
+    for dlat in [-size, 0.0, size]:
+        for dlon in [-size, 0.0, size]:
+            lat = center.latitude + dlat
+            if (dlat == 0.0 and dlon == 0.0) or abs(lat) >= 90.0:
+                continue
+            lon = (center.longitude + dlon + 180.0) % 360.0 - 180.0
+            tile = int(tile_id_from_coordinate(Point(latitude=lat, longitude=lon), level))
+            if tile not in output:
+                output.append(tile)
+    return output
+
+
+def prefetch_partitions(pids, layers=None, neighbours=False, max_workers=8):
+    """
+    Fetch and decode the given partitions for several layers at once on a thread pool.
+
+    layers is a list of layer ids (keys of LAYER_CLASSES), default DEFAULT_PREFETCH_LAYERS
+    If neighbours is True, the topology-geometry of the surrounding tiles is fetched as well, since that is
+    what translate_segments() needs for traffic items that cross the partition border.
+
+    Partitions that are already cached are skipped. For the versioned RIB-2 layers all partitions of a
+    layer are requested in one read_partitions call, so a cold start costs roughly one round trip per layer,
+    with all layers in flight at the same time.
+    """
+    if layers is None:
+        layers = DEFAULT_PREFETCH_LAYERS
+
+    pids = list(dict.fromkeys(pids))  # remove duplicates but keep the order
+    topo_pids = list(pids)
+    if neighbours:
+        for pid in pids:
+            topo_pids.extend(q for q in neighbour_tiles(pid) if q not in topo_pids)
+
+    def load_many(accessor, layer_pids):
+        # only fetch what is not already cached ; compact mode caches graphs instead of protobufs
+        cached = accessor._graphs if getattr(accessor, 'compact', False) else accessor._data
+        todo = [q for q in layer_pids if q not in cached]
+        if len(todo) == 0:
+            return
+        for pid, parsed in accessor._read_data_many(accessor._layer, accessor._schema, todo).items():
+            if parsed is not None:
+                accessor._ingest(pid, parsed)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = []
+        for layer_id in layers:
+            if layer_id not in LAYER_CLASSES:
+                raise ValueError('prefetch_partitions: unknown layer ' + layer_id)
+            accessor = LAYER_CLASSES[layer_id]()
+            layer_pids = topo_pids if layer_id == TopologyGeometry._layer_id else pids
+            if isinstance(accessor, HmcAccess):
+                futures.append(pool.submit(load_many, accessor, layer_pids))
+            else:
+                # volatile layers have no partition_name to match blobs on, so read them one by one (in parallel)
+                futures.extend(pool.submit(accessor._load_data, pid) for pid in layer_pids)
+        for future in futures:
+            future.result()  # re-raise anything that went wrong in the workers
+
+
+class TopologySegment:
+    """
+    Top level user access for segments and their properties
+    """
+    # do not store data in this class ; instead go fetch data from the
+    # classes that represent layers ; those classes load data from OLP and cache it
+    # (so it is only a (pid, sid) view, and there can be a lot of them: no per-instance __dict__)
+    __slots__ = ('pid', 'sid')
+
+    def __init__(self, pid, sid):
+        self.pid = pid
+        self.sid = sid
+
+    def __eq__(self, other):
+        return (self.pid == other.pid) and (self.sid == other.sid)
+
+    def __str__(self):
+        s = str(self.pid) + ':' + str(self.sid)
+        return s
+
+    @metrics.traced('accessor')
+    def length(self):
+        """Return segment length"""
+        tg = TopologyGeometry()
+        return tg.get_segment_length(self.pid, self.sid)
+
+    @metrics.traced('accessor')
+    def start_node(self):
+        """Return (pid, nid) of start node"""
+        tg = TopologyGeometry()
+        return tg.get_node(self.pid, self.sid, 0)
+
+    @metrics.traced('accessor')
+    def end_node(self):
+        """Return (pid, nid) of end node"""
+        tg = TopologyGeometry()
+        return tg.get_node(self.pid, self.sid, 1)
+
+    def _get_road_attribute_BFB(self, offset, orientation, attribute):
+        """
+        generic accessor for attributes, use orientation='ignore' to indicate not to match on orientation
+        CANNOT handle inverted segments
+        """
+        ra = RoadAttributes()
+        return get_road_attribute(ra, offset, orientation, attribute, self.pid, self.sid)
+
+    def _get_road_atttribute_BOTH(self, offset, attribute):
+        """generic accessor for attributes that always use orientation BOTH"""
+        return self._get_road_attribute_BFB(offset, 'ignore', attribute)
+
+    @metrics.traced('accessor')
+    def functional_class(self, offset):
+        """Return functional class"""
+        return self._get_road_atttribute_BOTH(offset, 'functional_class')
+
+    @metrics.traced('accessor')
+    def country_code(self, offset):
+        """Return ISO country code"""
+        cc = self._get_road_atttribute_BOTH(offset, 'iso_country_code')
+        if offset is None:
+            return [(start, end, decode_enum(q, 'official_country_code')) for start, end, q in cc]
+        if cc is not None:
+            return decode_enum(cc, 'official_country_code')
+        return None
+
+    @metrics.traced('accessor')
+    def speed_category(self, offset):
+        """Return Speed Category"""
+        na = NavigationAttributes()
+        return get_road_attribute(na, offset, 'ignore', 'speed_category', self.pid, self.sid)
+
+    @metrics.traced('accessor')
+    def speed_limit(self, offset, direction):
+        """Return speed limit"""
+        ana = AdvancedNavigationAttributes()
+        return get_road_attribute(ana, offset, direction, 'speed_limit:value', self.pid, self.sid)
+
+    @metrics.traced('accessor')
+    def live_traffic_info(self, rib_offset, my_orient='any'):  # ,attribute='traffic-flow'
+        """
+        For the given position on the segment,
+        Return the Live Traffic info
+        """
+        # This code in zeppelin was also able to handle traffic incidents ; requires work to reach that stage here
+        flow = LiveTrafficFlow()
+        thedata, segment_lookup = flow._load_snapshot(self.pid)
+
+        if thedata is None:
+            return None
+
+        segment_index = self.sid
+
+        tg = TopologyGeometry()
+
+        # this is copied as closely as possible from the original zeppelin notebook
+        # but some adjustments are needed because nagini exposes the protobuf datatypes more than zeppelin did
+        # only look at the traffic items that contain this segment, using the index built when the snapshot was loaded
+        output = []
+        for item_index, this_segment_i, trafitem_dd in segment_lookup.get(segment_index, []):
+            item = thedata.items[item_index]
+            topo_seg_id_list = item.topology_segment.topology_segment_id
+
+            # case: traffic item is exactly 1 segment long
+            if len(topo_seg_id_list) == 1:
+                rib_dd = self.travel_direction(rib_offset)
+                access_flag = self.accessible_by(rib_offset)
+
+                if (trafitem_dd and (rib_dd == 'BOTH' or rib_dd == 'FORWARD')) or (
+                        (not trafitem_dd) and rib_dd == 'BACKWARD'):
+                    if (rib_offset >= item.topology_segment.start_offset) and (
+                            rib_offset <= 1.0 - item.topology_segment.end_offset):
+                        if (my_orient == 'any' or (trafitem_dd and my_orient == 'FORWARD')):
+                            output.append(item)
+                        elif ((not trafitem_dd) and my_orient == 'BACKWARD'):
+                            output.append(item)
+                elif ((not trafitem_dd) and (rib_dd == 'BOTH' or rib_dd == 'FORWARD')) or (
+                        trafitem_dd and rib_dd == 'BACKWARD'):
+                    if (rib_offset >= item.topology_segment.end_offset) and (
+                            rib_offset <= 1.0 - item.topology_segment.start_offset):
+                        if (my_orient == 'any' or ((not trafitem_dd) and my_orient == 'BACKWARD')):
+                            output.append(item)
+                        elif (trafitem_dd and my_orient == 'FORWARD'):
+                            output.append(item)
+                else:
+                    assert False, 'ERROR in 1-segment TrafficItem logic. This should not happen'
+            # case: trafficItem is at least 3 segments, and our segment is in the middle (i.e. not the beginning or the end)
+            elif (len(topo_seg_id_list) > 2) and (segment_index != topo_seg_id_list[0]) and (
+                    segment_index != topo_seg_id_list[-1]):
+                # careful - index here means segment number e.g. here:cm:segment:123456789
+                adjacent_segment_index = topo_seg_id_list[this_segment_i - 1]
+                # adjacent_segment_id = "here:cm:segment:"+str(adjacent_segment_index)
+                shared_node_id = tg.get_shared_node2(self.pid, segment_index,
+                                                     adjacent_segment_index)  # returns (pid,nodeId) pair
+                in_dd_456 = (shared_node_id == self.start_node())
+                if my_orient == 'any':
+                    output.append(item)
+                elif in_dd_456 and (my_orient == 'FORWARD'):
+                    output.append(item)
+                elif (not in_dd_456) and (my_orient == 'BACKWARD'):
+                    output.append(item)
+            # case: our segment is the first segment in the list
+            elif (len(topo_seg_id_list) >= 2) and (segment_index == topo_seg_id_list[0]):
+                if trafitem_dd and (my_orient in ['any', 'FORWARD']):
+                    if rib_offset >= item.topology_segment.start_offset:
+                        output.append(item)
+                elif (not trafitem_dd) and (my_orient in ['any', 'BACKWARD']):
+                    if (1.0 - rib_offset) >= item.topology_segment.start_offset:
+                        output.append(item)
+            # case: our segment is the last segment in the list
+            elif (len(topo_seg_id_list) >= 2) and (segment_index == topo_seg_id_list[-1]):
+                adjacent_segment_index = topo_seg_id_list[-2]
+                # adjacent_segment_id = "here:cm:segment:"+str(adjacent_segment_index)
+                shared_node_id = tg.get_shared_node2(self.pid, segment_index,
+                                                     adjacent_segment_index)  # returns (pid,nodeId) pair
+
+                dd_aligned = (shared_node_id == self.start_node())
+                if dd_aligned:
+                    if rib_offset <= (1.0 - item.topology_segment.end_offset):
+                        if my_orient in ['any', 'FORWARD']:
+                            output.append(item)
+                else:
+                    if rib_offset >= item.topology_segment.end_offset:
+                        if my_orient in ['any', 'BACKWARD']:
+                            output.append(item)
+
+            else:
+                assert False, 'ERROR in finding correct TrafficItem.'
+        return output
+
+    @metrics.traced('accessor')
+    def get_offset_on_trafitem(self, trafitem_segment_info, rib_offset):
+        """
+        Utility for converting between coordinate systems
+        For the given rib_offset on this segment, and the segment info from a traffic item,
+        Return the offset on the traffic item
+        """
+        from . import chain  # chain imports this module
+
+        # the chain of the traffic item (translated segments, cumulative lengths, orientations) is built once
+        # per item and cached, so the other segments of the item are a lookup
+        model = chain.ChainModel.from_trafitem(self.pid, self.sid, trafitem_segment_info)
+        return model.offset_from_rib(self.pid, self.sid, rib_offset)
+
+    # again, i'm going to try to change as little of this as possible from zeppelin and just hope it still works
+    @metrics.traced('accessor')
+    def get_live_traffic_speed(self, rib_offset, rib_orient):
+        """
+        fetch the live traffic and return (timestamp, update time, live speed)
+        """
+        debug = False
+
+        # exactly what should be returned can evolve ; stick with convention that we return primitive python types
+        # for now return a tuple of timestamp,update timestamp, live average speed
+        the_live_traffic_info = self.live_traffic_info(rib_offset, rib_orient)
+        if debug:
+            print('the_live_traffic_info', the_live_traffic_info)
+            print(len(the_live_traffic_info))
+        if len(the_live_traffic_info) == 0:
+            return None
+        elif len(the_live_traffic_info) > 1:
+            bad_ids = [q.id for q in the_live_traffic_info]
+            print('WARNING in get_live_traffic_speed; there are too many matches (will just use the first one)',
+                  len(the_live_traffic_info), self.pid, self.sid, rib_orient, rib_offset, bad_ids)
+
+        info = the_live_traffic_info[0]
+        if debug:
+            print('list item 1', info)
+        timestamp = info.created_timestamp
+        update = info.updated_timestamp
+        flow = info.flow
+        speed = None
+        if flow is not None:
+            flow_segments = list(flow.segment)
+            if debug:
+                print('flow_segments', flow_segments)
+            if len(flow_segments) == 1:
+                if (flow_segments[0] is not None) and (flow_segments[0].speed is not None):
+                    speed = flow_segments[
+                        0].speed.average_speed_kph  # or .free_flow_speed_kph or whatever data member is desired
+                # disable this warning for now ; seems to usually just indicate that traversability_status is CLOSED
+                # else:
+                #    print("WARNING - flow segment is missing:",info)
+            elif len(flow_segments) > 1:  # some of this might need revisiting for transition from zeppelin ; not sure if "is None" tests still work
+                # print('There are multiple flow segments!')
+                # print(info)
+                offset_on_trafitem = self.get_offset_on_trafitem(info.topology_segment, rib_offset)
+                # print('Offset on TrafficItem:',offset_on_trafitem)
+                for ifs in range(len(flow_segments)):
+                    if (flow_segments[ifs] is None) or (flow_segments[ifs].speed is None):
+                        # see note above about disabling the warning
+                        # print("WARNING - flow segment is missing:",info)
+                        continue
+                    so = flow_segments[ifs].start_offset
+                    if ifs + 1 == len(flow_segments):
+                        eo = 1.0
+                    else:
+                        eo = flow_segments[ifs + 1].start_offset
+                    if offset_on_trafitem >= so and offset_on_trafitem <= eo:
+                        # print("Flow segment found:",ifs)
+                        speed = flow_segments[ifs].speed.average_speed_kph
+                        break
+        return (timestamp, update, speed)
+
+    @metrics.traced('accessor')
+    def traffic_pattern(self, offset, direction):
+        """
+        Return the traffic pattern object for the segment
+        """
+        # i honestly do not know if offset matters
+        # i.e. does a single segment ever have more than one pattern?
+        tp = TrafficPatterns()
+        raw_patterns = tp._load_raw(self.pid)['traffic_pattern']
+
+        output = []
+        if self.sid in raw_patterns:
+            for p in raw_patterns[self.sid]:
+                sa, pattern = p
+                start, end = get_start_end(sa)
+                # note that if we want to match to FORWARD, BACKWARD strings we need
+                # to use decode_enum() to get the string version of the attribute_orientation
+                if decode_enum(sa, 'attribute_orientation') == direction:
+                    if offset is None:
+                        output.append((start, end, pattern))
+                    elif (offset >= start) and (offset <= end):
+                        return pattern
+        if offset is None:
+            return output
+        return None
+
+    def decode_tpinfo(self, tpinfo, my_epoch, day_index):
+        my_speed = None
+        isdone = False
+        for item in tpinfo:
+            # do not decode the enum into a string
+            # OLP has enum=1 mean SUNDAY
+            # subtracting 1 means 0->SUNDAY
+            day_of_week = item.day_of_week - 1
+
+            if (day_of_week == day_index):
+                for pattern in item.speed_pattern:
+
+                    # for the first pattern, put it into my_speed right away
+                    if my_speed is None:
+                        my_speed = pattern.speed
+
+                    # print(pattern)
+                    if my_epoch < pattern.epoch:
+                        isdone = True
+                        break
+                    my_speed = pattern.speed
+            if isdone:  # just saves a little time
+                break
+
+        # print('speed',my_speed)
+        return my_speed
+
+    def expand_tpinfo(self, tpinfo, day_index):
+        """Return the list of (epoch, speed) steps of tpinfo for one day (0 = Sunday)"""
+        pat = []
+
+        for item in tpinfo:
+            # OLP has enum=1 mean SUNDAY
+            # subtracting 1 means 0->SUNDAY
+
+            day_of_week = item.day_of_week - 1
+            if day_of_week == day_index:
+                for pattern in item.speed_pattern:
+                    pat.append((pattern.epoch, pattern.speed))
+        return pat
+
+    # Higher-level function than traffic_pattern() --
+    # looks up the speed in the TrafficPatternMatrix of the partition
+    # ONLY handles 7-day patterns for now
+    @metrics.traced('accessor')
+    def get_historical_traffic_speed(self, offset, orientation, local_time, return_type='speed'):
+        """
+        Return historical traffic speed for this segment at time local_time
+
+        return_type can be:
+        speed -- return integer speed at local_time
+        1day -- return the 288 speeds (5-minute epochs) for the entire day of local_time, as a numpy array
+        7day -- return the (7, 288) speeds for the entire week (day 0 = Sunday), as a numpy array
+
+        If offset is None, return a sorted list of (start, end, value) for every pattern on the segment
+        For many segments at once, use TrafficPatterns()._load_data(pid) and the batch methods of
+        patterns.TrafficPatternMatrix
+        """
+        assert return_type in ['speed', '1day', '7day'], 'get_historical_traffic_speed: unknown return_type ' + return_type
+        # local_time should be a datetime
+        matrix = TrafficPatterns()._load_data(self.pid)
+
+        my_epoch, day_index = patterns.epoch_and_day(local_time)
+
+        def value(row):
+            week = matrix.profiles[matrix.profile[row]]
+            if return_type == 'speed':
+                speed = int(week[day_index, my_epoch])
+                return None if speed == patterns.NODATA else speed
+            elif return_type == '1day':
+                return week[day_index]
+            return week
+
+        if offset is None:
+            return sorted([(float(matrix.start[row]), float(matrix.end[row]), value(row))
+                           for row in matrix.segment_rows(self.sid, orientation)], key=lambda q: (q[0], q[1]))
+
+        row = matrix.find_rows([self.sid], orientation, [offset])[0]
+        if row < 0:
+            return None
+        return value(row)
+
+    @metrics.traced('accessor')
+    def travel_direction(self, offset):
+        """
+        Return the travel direction
+        """
+        # the travel direction is the (decoded) attribute_orientation of the first anchor of the partition with
+        # start <= offset < end (or offset == end == 1)
+        intervals = NavigationAttributes().get_intervals('travel_direction', self.pid)
+        if offset is None:
+            return sorted([(float(intervals.start[row]), float(intervals.end[row]),
+                            intervals.orientation_names[intervals.orientation[row]])
+                           for row in intervals.segment_rows(self.sid)], key=lambda q: (q[0], q[1]))
+        return intervals.orientations_at([self.sid], [offset])[0]
+
+    @metrics.traced('accessor')
+    def accessible_by(self, offset, which='automobiles'):
+        """
+        returns whether the segment is accessible by the class of vehicles specified in the 'which' arugment
+        """
+        val = get_road_attribute(RoadAttributes(), offset, 'ignore', 'accessible_by', self.pid, self.sid)
+        if offset is None:
+            return [(start, end, getattr(q, which)) for start, end, q in val]
+        if val is not None:
+            return getattr(val, which)
+        return None
+
+    @metrics.traced('accessor')
+    def shape_points(self):
+        """Return shape points as tuples"""
+        tg = TopologyGeometry()
+        return tg.get_shape_points(self.pid, self.sid, 'tuples')
+
+    @metrics.traced('accessor')
+    def point_from_offset(self, offset0):
+        """Given an offset, return the coordinate along the segment as a tuple of (lat, lon)"""
+        p = TopologyGeometry().points_from_offsets(self.pid, [self.sid], [offset0])[0]
+        return (float(p[0]), float(p[1]))
+
+    @metrics.traced('accessor')
+    def points_from_offsets(self, offsets):
+        """Given an array of offsets, return an (n, 2) array of the coordinates along the segment"""
+        return TopologyGeometry().points_from_offsets(self.pid, np.full(len(offsets), self.sid), offsets)
+
+    @metrics.traced('accessor')
+    def get_offset(self, coord):
+        """Given (lat, lon) return the offset"""
+        offsets, _ = TopologyGeometry().offsets_from_points(self.pid, [self.sid], [coord[0]], [coord[1]])
+        return float(offsets[0])
+
+    @metrics.traced('accessor')
+    def get_offsets(self, lats, lons):
+        """Given arrays of latitudes and longitudes, return the array of offsets of their projection on the segment"""
+        return TopologyGeometry().offsets_from_points(self.pid, np.full(len(lats), self.sid), lats, lons)[0]
+
+    @metrics.traced('accessor')
+    def shape_points_between_offsets(self, o1, o2):
+        """Given 2 offsets, return all of the shape points in between them"""
+        sp = self.shape_points()
+        offs = TopologyGeometry().get_packed_shapes(self.pid).point_offsets(self.sid)
+
+        out = []
+        for o, p in zip(offs, sp):
+            if (o >= o1) and (o <= o2):
+                out.append(p)
+
+        return out
+
+    @metrics.traced('accessor')
+    def shape_points_as_joined_string(self):
+        """Convenience function for getting output suitable for copy/paste to Dongwook's web viewer"""
+        # arguably this should not be a method of this class but rather a generally available convenience function
+        # that takes a list of tuples as input and does the one-liner implemented here
+        sp = self.shape_points()
+        return ','.join([str(q[0])+','+str(q[1]) for q in sp])
+
+# END of class definitions
+# ### quasi-tests are down here
+
+
+def main():
+    pid = 23611529
+
+    offset = 0.5
+
+    print("=== 1")
+    p1 = HmcPartition(pid)
+    all_segment_ids = p1.get_all_segment_ids()
+    print("=== 2")
+    for iseg, seg in enumerate(all_segment_ids):
+        segment = TopologySegment(pid, seg)
+        aa = segment.accessible_by(offset)
+        fcstring = segment.functional_class(offset)
+        dot = segment.travel_direction(offset)
+        segment_length = segment.length()
+        print(seg, "\t", fcstring, aa, dot, segment_length)
+        # sys.exit(1)
+
+
+def tr():
+    s = TopologySegment(20095971, 457683118)
+    # p = s.traffic_pattern(0.5,"BACKWARD")
+    # sp = s.get_historical_traffic_speed(0.5,"BACKWARD",datetime.datetime.now() )#datetime.datetime(2019,11,15,17,15,0)
+    # print(sp)
+    lt = s.get_live_traffic_speed(0.5, 'BACKWARD')
+    print('live output:', lt)
+
+
+def shape1():
+    s = TopologySegment(20095971, 457683118)
+    print( s.shape_points_as_joined_string() )
+
+
+def country_code():
+    s = TopologySegment(20095971, 457683118)
+    print( s.country_code(0.5) )
+
+
+def speed_cat():
+    s = TopologySegment(20095971, 457683118)
+    print(s.speed_category(0.5))
+
+
+def interp():
+    s = TopologySegment(20095971, 457683118)
+    print( s.point_from_offset(0.1) )
+    print( s.point_from_offset(0.5) )
+    print( s.point_from_offset(0.9) )
+
+def dump_attributes():
+    offset = 0.5
+
+    p1 = HmcPartition(20097302)
+    for sid in p1.get_all_segment_ids():
+        s = TopologySegment(p1.pid, sid)
+
+        aa = s.accessible_by(offset)
+        if not aa:
+            continue
+        td = s.travel_direction(offset)
+        sc = s.speed_category(offset)
+
+        if td=='BOTH':
+            sl = s.speed_limit(offset, 'FORWARD')
+        else:
+            sl = s.speed_limit(offset, td)
+
+        fc = s.functional_class(offset)
+
+        print(sid, td, sc, sl, fc)
+
+if __name__ == '__main__':
+    # main()
+    #speed_cat()
+    #dump_attributes()
+    interp()
@@ -0,0 +1,147 @@
+"""
+Segment ID -> partition ID index for a whole region
+
+Segment IDs are unique across the whole of HMC, but the partition of a segment is not part of its ID. The
+traffic items of the traffic-flow layer only list segment IDs, so TopologyGeometry.translate_segments used to
+find the partition of every next segment by walking the shared node, loading neighbouring partitions one at
+a time. With this index the partition is found with a binary search instead.
+
+The index is three arrays:
+    sids        int64, sorted
+    codes       for every segment, the position of its partition in partitions (smallest unsigned type)
+    partitions  int64, the distinct partition IDs
+
+It is built from the topology-geometry layer of a list of partitions (without keeping the decoded data) and
+saved per catalog version as .npy files, which are memory-mapped on load:
+
+    from hmctools import segmentindex, spatial
+    index = segmentindex.build_index(spatial.partitions_in_bbox(52.2, 4.6, 52.6, 5.2))
+    index.save('segment-index', version=None)
+    segmentindex.use_index(segmentindex.SegmentPartitionIndex.load('segment-index'))
+"""
+
+import os
+
+import numpy as np
+
+from .segment import CatalogAccess, TopologyGeometry, id2int
+
+
+LATEST = 'latest'  # directory name of an index built for version=None
+
+
+class SegmentPartitionIndex:
+    """
+    Sorted segment ID -> partition ID arrays (see module docstring)
+    """
+
+    ARRAYS = ['sids', 'codes', 'partitions']
+
+    def __init__(self, sids, codes, partitions):
+        self.sids = sids
+        self.codes = codes
+        self.partitions = partitions
+
+    @classmethod
+    def from_partitions(cls, segments):
+        """Build the index from a dict of partition ID -> iterable of segment IDs"""
+        partitions = np.array(sorted(segments), dtype=np.int64)
+        sids = [np.fromiter(segments[pid], dtype=np.int64) for pid in partitions.tolist()]
+        counts = [len(q) for q in sids]
+        code_type = np.min_scalar_type(max(len(partitions) - 1, 0))
+        codes = np.repeat(np.arange(len(partitions), dtype=code_type), counts)
+        sids = np.concatenate(sids) if sids else np.zeros(0, dtype=np.int64)
+        order = np.argsort(sids, kind='stable')
+        return cls(sids[order], codes[order], partitions)
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __contains__(self, sid):
+        return self.partition(sid) is not None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def lookup(self, sids) -> np.ndarray:
+        """Vectorized lookup of the partition of every segment ID ; -1 for segments that are not in the index"""
+        sids = np.atleast_1d(np.asarray(sids, dtype=np.int64))
+        if len(self.sids) == 0:
+            return np.full(sids.shape, -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.sids, sids), len(self.sids) - 1)
+        found = self.sids[rows] == sids
+        return np.where(found, self.partitions[self.codes[rows]], -1)
+
+    def partition(self, sid):
+        """Partition ID of one segment, or None"""
+        pid = int(self.lookup([sid])[0])
+        return pid if pid >= 0 else None
+
+    def segment_ids(self, pid) -> np.ndarray:
+        """The (sorted) segment IDs of one partition"""
+        k = np.searchsorted(self.partitions, pid)
+        if k == len(self.partitions) or self.partitions[k] != pid:
+            return np.zeros(0, dtype=np.int64)
+        return self.sids[self.codes == k]
+
+    def update(self, segments):
+        """
+        Return a new index with the partitions in segments (dict of partition ID -> segment IDs) replaced,
+        e.g. to extend a region or refresh some partitions ; the other partitions are kept as they are
+        """
+        order = np.argsort(self.codes, kind='stable')
+        bounds = np.searchsorted(self.codes[order], np.arange(len(self.partitions) + 1))
+        merged = {pid: self.sids[order[bounds[k]:bounds[k + 1]]] for k, pid in enumerate(self.partitions.tolist())
+                  if pid not in segments}
+        merged.update(segments)
+        return SegmentPartitionIndex.from_partitions(merged)
+
+    @staticmethod
+    def directory_for(root, version=None):
+        """Directory of the index of a catalog version under root"""
+        return os.path.join(root, str(version) if version is not None else LATEST)
+
+    def save(self, root, version=None):
+        """Save to root/<version> (root/latest for version None) as .npy files"""
+        directory = self.directory_for(root, version)
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        return directory
+
+    @classmethod
+    def load(cls, root, version=None, mmap=True):
+        """Load an index written by save() ; with mmap=True the arrays stay on disk until used"""
+        directory = cls.directory_for(root, version)
+        mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode) for name in cls.ARRAYS])
+
+
+def read_segment_ids(pids, version=None, batch_size=32):
+    """
+    Return a dict partition ID -> array of segment IDs, read from the topology-geometry layer
+    The decoded partitions are not put in the TopologyGeometry cache, so this works for a region of any size.
+    Partitions without topology (e.g. open sea) are left out.
+    """
+    tg = TopologyGeometry
+    pids = [int(q) for q in pids]
+    output = {}
+    for start in range(0, len(pids), batch_size):
+        chunk = pids[start:start + batch_size]
+        decoded = CatalogAccess.read_data_many(tg._layer, tg._schema, chunk, version,
+                                               (tg._catalog_hrn, tg._layer_id))
+        for pid, parsed in decoded.items():
+            if parsed is not None:
+                output[pid] = np.array([id2int(q.identifier) for q in parsed.segment], dtype=np.int64)
+    return output
+
+
+def build_index(pids, version=None, batch_size=32) -> SegmentPartitionIndex:
+    """Build the index for a list of partitions (e.g. spatial.partitions_in_bbox of a region)"""
+    return SegmentPartitionIndex.from_partitions(read_segment_ids(pids, version, batch_size))
+
+
+def use_index(index):
+    """Make TopologyGeometry (translate_segments and friends) look partitions up in index ; None to stop"""
+    TopologyGeometry.partition_index = index
@@ -0,0 +1,277 @@
+"""
+Spatial index over the segments of topology-geometry partitions
+
+SegmentIndex is a uniform grid over the edges (pieces between consecutive shape points) of all segments of a
+partition, stored as flat NumPy arrays (cells -> edges in CSR form). It answers
+    segments_in_bbox(south, west, north, east)
+    nearest_segments(lat, lon, k, max_dist)
+    nearest_segments_many(lats, lons, k, max_dist)   -- all queries in one set of array operations
+Distances are in meters, computed in a flat approximation around each query point.
+
+Normally the index is used through TopologyGeometry.get_spatial_index(pid), which builds it from the cached
+shapes of the partition (and can keep it on disk, see TopologyGeometry.index_dir), or through the module
+functions below, which work across tile boundaries:
+
+    from hmctools import spatial
+    df = spatial.nearest_segments_many(lats, lons, k=3, max_dist=30)
+    pairs = spatial.segments_in_bbox(52.36, 4.88, 52.38, 4.91)
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import tiling
+from .offset import EARTH_RADIUS
+from .segment import TopologyGeometry
+
+
+CELL_DEGREES = 0.001  # grid cell size, about 110 x 70 meters in the Netherlands
+HMC_LEVEL = 12  # tile level of the HMC partitions
+METERS_PER_DEGREE = np.radians(1.0) * EARTH_RADIUS
+
+
+def _expand(starts, counts):
+    """For ragged ranges [starts[i], starts[i] + counts[i]), return (owner i, position) of every element"""
+    owners = np.repeat(np.arange(len(counts)), counts)
+    if len(owners) == 0:
+        return owners, owners
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return owners, np.repeat(starts, counts) + (np.arange(len(owners)) - np.repeat(first, counts))
+
+
+class SegmentIndex:
+    """
+    Grid index over the edges of one partition ; build it with from_shapes(offset.PackedShapes)
+    """
+
+    ARRAYS = ['sids', 'points', 'cumlen', 'lengths', 'edge_start', 'edge_segment', 'cell_start', 'cell_edges',
+              'grid']
+
+    def __init__(self, sids, points, cumlen, lengths, edge_start, edge_segment, cell_start, cell_edges, grid):
+        self.sids = sids  # segment ID of every segment row
+        self.points = points  # (number of shape points, 2) lat/lon
+        self.cumlen = cumlen  # distance from the start of its segment, for every shape point
+        self.lengths = lengths  # length of every segment
+        self.edge_start = edge_start  # index of the first shape point of every edge (the second is the next one)
+        self.edge_segment = edge_segment  # segment row of every edge
+        self.cell_start = cell_start  # CSR: the edges of cell c are cell_edges[cell_start[c]:cell_start[c + 1]]
+        self.cell_edges = cell_edges
+        self.grid = grid  # south, west, cell size (degrees), number of rows, number of columns
+        self._south, self._west, self._cell = float(grid[0]), float(grid[1]), float(grid[2])
+        self._ny, self._nx = int(grid[3]), int(grid[4])
+
+    @classmethod
+    def from_shapes(cls, shapes, cell_degrees=CELL_DEGREES):
+        """Build the index for an offset.PackedShapes"""
+        first = shapes.first
+        counts = np.diff(first)
+        # every pair of consecutive shape points within a segment is an edge
+        edge_counts = np.maximum(counts - 1, 0)
+        edge_segment, edge_start = _expand(first[:-1], edge_counts)
+        edge_segment = edge_segment.astype(np.int32)
+        edge_start = edge_start.astype(np.int64)
+
+        points = shapes.points
+        if len(points):
+            south, west = points[:, 0].min(), points[:, 1].min()
+            ny = int((points[:, 0].max() - south) // cell_degrees) + 1
+            nx = int((points[:, 1].max() - west) // cell_degrees) + 1
+        else:
+            south, west, ny, nx = 0.0, 0.0, 1, 1
+        grid = np.array([south, west, cell_degrees, ny, nx], dtype=np.float64)
+
+        # every edge goes into all of the cells that its bounding box overlaps
+        a, b = points[edge_start], points[edge_start + 1]
+        y0 = ((np.minimum(a[:, 0], b[:, 0]) - south) // cell_degrees).astype(np.int64)
+        y1 = ((np.maximum(a[:, 0], b[:, 0]) - south) // cell_degrees).astype(np.int64)
+        x0 = ((np.minimum(a[:, 1], b[:, 1]) - west) // cell_degrees).astype(np.int64)
+        x1 = ((np.maximum(a[:, 1], b[:, 1]) - west) // cell_degrees).astype(np.int64)
+        width = x1 - x0 + 1
+        edges, position = _expand(np.zeros(len(edge_start), dtype=np.int64), width * (y1 - y0 + 1))
+        cells = (y0[edges] + position // width[edges]) * nx + x0[edges] + position % width[edges]
+
+        order = np.argsort(cells, kind='stable')
+        cell_edges = edges[order].astype(np.int64)
+        cell_start = np.searchsorted(cells[order], np.arange(ny * nx + 1)).astype(np.int64)
+        return cls(shapes.sids, points, shapes.cumlen, shapes.lengths, edge_start, edge_segment, cell_start,
+                   cell_edges, grid)
+
+    def __len__(self):
+        return len(self.sids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def _cell_ranges(self, south, west, north, east):
+        """Clipped (y0, y1, x0, x1) cell ranges of arrays of boxes ; empty where y0 > y1 or x0 > x1"""
+        y0 = np.maximum(np.floor((south - self._south) / self._cell), 0).astype(np.int64)
+        y1 = np.minimum(np.floor((north - self._south) / self._cell), self._ny - 1).astype(np.int64)
+        x0 = np.maximum(np.floor((west - self._west) / self._cell), 0).astype(np.int64)
+        x1 = np.minimum(np.floor((east - self._west) / self._cell), self._nx - 1).astype(np.int64)
+        return y0, y1, x0, x1
+
+    def _candidates(self, south, west, north, east):
+        """(box, edge) pairs for arrays of boxes: every edge in a grid cell that the box overlaps (with duplicates)"""
+        y0, y1, x0, x1 = self._cell_ranges(south, west, north, east)
+        width = np.maximum(x1 - x0 + 1, 0)
+        height = np.maximum(y1 - y0 + 1, 0)
+        boxes, position = _expand(np.zeros(len(y0), dtype=np.int64), width * height)
+        cells = (y0[boxes] + position // np.maximum(width[boxes], 1)) * self._nx + x0[boxes] + \
+            position % np.maximum(width[boxes], 1)
+        owners, slots = _expand(self.cell_start[cells], self.cell_start[cells + 1] - self.cell_start[cells])
+        return boxes[owners], self.cell_edges[slots]
+
+    def segments_in_bbox(self, south, west, north, east) -> np.ndarray:
+        """Return the (sorted) IDs of the segments that have an edge whose bounding box overlaps the box"""
+        _, edges = self._candidates(np.array([south]), np.array([west]), np.array([north]), np.array([east]))
+        a, b = self.points[self.edge_start[edges]], self.points[self.edge_start[edges] + 1]
+        overlap = (np.maximum(a[:, 0], b[:, 0]) >= south) & (np.minimum(a[:, 0], b[:, 0]) <= north) & \
+                  (np.maximum(a[:, 1], b[:, 1]) >= west) & (np.minimum(a[:, 1], b[:, 1]) <= east)
+        return np.unique(self.sids[self.edge_segment[edges[overlap]]])
+
+    def nearest_segments_many(self, lats, lons, k=5, max_dist=50.0) -> pd.DataFrame:
+        """
+        For every query point, the (up to) k nearest segments within max_dist meters
+        Returns a DataFrame with columns query (index into lats/lons), sid, distance (meters) and offset
+        (of the closest point on the segment), sorted by query and distance
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        coslat = np.cos(np.radians(lats))
+        dlat = max_dist / METERS_PER_DEGREE
+        dlon = max_dist / (METERS_PER_DEGREE * np.maximum(coslat, 1e-6))
+        queries, edges = self._candidates(lats - dlat, lons - dlon, lats + dlat, lons + dlon)
+
+        # distance from every query to every candidate edge, in meters east/north of the query
+        i = self.edge_start[edges]
+        scale_x = METERS_PER_DEGREE * coslat[queries]
+        ax = (self.points[i, 1] - lons[queries]) * scale_x
+        ay = (self.points[i, 0] - lats[queries]) * METERS_PER_DEGREE
+        dx = (self.points[i + 1, 1] - lons[queries]) * scale_x - ax
+        dy = (self.points[i + 1, 0] - lats[queries]) * METERS_PER_DEGREE - ay
+        d2 = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(d2 > 0, d2, 1.0), 0.0, 1.0)
+        distance = np.hypot(ax + t * dx, ay + t * dy)
+
+        keep = distance <= max_dist
+        queries, edges, i, t, distance = queries[keep], edges[keep], i[keep], t[keep], distance[keep]
+        segments = self.edge_segment[edges]
+        length = self.lengths[segments]
+        along = self.cumlen[i] + t * (self.cumlen[i + 1] - self.cumlen[i])
+        offsets = np.where(length > 0, along / np.where(length > 0, length, 1.0), 0.0)
+
+        # the closest edge of every (query, segment), then the k closest segments of every query
+        order = np.lexsort((distance, segments, queries))
+        queries, segments, distance, offsets = queries[order], segments[order], distance[order], offsets[order]
+        first = np.ones(len(queries), dtype=bool)
+        first[1:] = (queries[1:] != queries[:-1]) | (segments[1:] != segments[:-1])
+        queries, segments, distance, offsets = queries[first], segments[first], distance[first], offsets[first]
+
+        order = np.lexsort((distance, queries))
+        queries, segments, distance, offsets = queries[order], segments[order], distance[order], offsets[order]
+        starts = np.searchsorted(queries, queries, side='left')
+        rank = np.arange(len(queries)) - starts
+        keep = rank < k
+        return pd.DataFrame({'query': queries[keep], 'sid': self.sids[segments[keep]],
+                             'distance': distance[keep], 'offset': offsets[keep]})
+
+    def nearest_segments(self, lat, lon, k=5, max_dist=50.0):
+        """Return a list of (sid, distance in meters, offset) of the k nearest segments within max_dist"""
+        df = self.nearest_segments_many([lat], [lon], k, max_dist)
+        return [(int(q.sid), float(q.distance), float(q.offset)) for q in df.itertuples()]
+
+    def save(self, directory):
+        """Save to a directory of .npy files (which load() memory-maps)"""
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Load an index written by save() ; with mmap=True the arrays stay on disk until used"""
+        mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode) for name in cls.ARRAYS])
+
+
+def partitions_in_bbox(south, west, north, east):
+    """Return the HMC partitions (array of tile ids) that overlap the box"""
+    corners = tiling.tile_ids_from_coordinates([south, south, north, north], [west, east, west, east], HMC_LEVEL)
+    lats, lons = tiling.tile_centers(corners)
+    size = 360.0 / 2 ** HMC_LEVEL
+    ys = np.arange(lats.min(), lats.max() + size / 2, size)
+    xs = np.arange(lons.min(), lons.max() + size / 2, size)
+    grid_lats, grid_lons = np.meshgrid(ys, xs)
+    return np.unique(tiling.tile_ids_from_coordinates(grid_lats.ravel(), grid_lons.ravel(), HMC_LEVEL))
+
+
+def _query_tiles(lats, lons, max_dist):
+    """(query, partition) pairs for every partition within max_dist meters of every query"""
+    dlat = max_dist / METERS_PER_DEGREE
+    dlon = max_dist / (METERS_PER_DEGREE * np.maximum(np.cos(np.radians(lats)), 1e-6))
+    # the partitions of the 4 corners of the search box of every query (a box is much smaller than a tile)
+    corner_tiles = np.stack([tiling.tile_ids_from_coordinates(lats + sy * dlat, lons + sx * dlon, HMC_LEVEL)
+                             for sy in [-1, 1] for sx in [-1, 1]], axis=1)
+    return np.unique(np.stack([np.repeat(np.arange(len(lats)), 4), corner_tiles.ravel()], axis=1), axis=0)
+
+
+def partitions_near(lats, lons, max_dist=50.0):
+    """Return the (sorted) HMC partitions within max_dist meters of any of the points"""
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    return [int(q) for q in np.unique(_query_tiles(lats, lons, max_dist)[:, 1])]
+
+
+def _get_index(tg, pid):
+    try:
+        return tg.get_spatial_index(int(pid))
+    except ValueError:  # no topology for this tile, e.g. open sea
+        return None
+
+
+def segments_in_bbox(south, west, north, east):
+    """Return the list of (pid, sid) of all segments in the box, across partition boundaries"""
+    tg = TopologyGeometry()
+    output = []
+    for pid in partitions_in_bbox(south, west, north, east):
+        index = _get_index(tg, pid)
+        if index is not None:
+            output.extend((int(pid), int(q)) for q in index.segments_in_bbox(south, west, north, east))
+    return output
+
+
+def nearest_segments_many(lats, lons, k=5, max_dist=50.0) -> pd.DataFrame:
+    """
+    Like SegmentIndex.nearest_segments_many, but across partition boundaries: every query is matched against
+    all of the partitions within max_dist of it. The result has an extra column pid.
+    """
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    pairs = _query_tiles(lats, lons, max_dist)
+
+    tg = TopologyGeometry()
+    results = []
+    for pid in np.unique(pairs[:, 1]):
+        queries = pairs[pairs[:, 1] == pid, 0]
+        index = _get_index(tg, pid)
+        if index is None:
+            continue
+        df = index.nearest_segments_many(lats[queries], lons[queries], k, max_dist)
+        df['query'] = queries[df['query'].values]
+        df['pid'] = int(pid)
+        results.append(df)
+
+    columns = ['query', 'pid', 'sid', 'distance', 'offset']
+    if not results:
+        return pd.DataFrame({name: [] for name in columns})
+    df = pd.concat(results, ignore_index=True).sort_values(['query', 'distance'], kind='stable')
+    df = df[df.groupby('query').cumcount() < k]
+    return df[columns].reset_index(drop=True)
+
+
+def nearest_segments(lat, lon, k=5, max_dist=50.0):
+    """Return a list of (pid, sid, distance in meters, offset) of the k nearest segments, across partitions"""
+    df = nearest_segments_many([lat], [lon], k, max_dist)
+    return [(int(q.pid), int(q.sid), float(q.distance), float(q.offset)) for q in df.itertuples()]
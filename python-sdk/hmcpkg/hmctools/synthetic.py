@@ -0,0 +1,421 @@
+"""
+Synthetic RIB-2, traffic-flow, traffic-patterns and weather partitions, for benchmarks without OLP
+
+Every tile gets the same kind of road network: a jittered grid of GRID x GRID nodes with horizontal and
+vertical segments between neighbouring nodes (every fourth row and column is a main road). All layers are
+derived from that network, so they are consistent with each other the way the real layers are: the attribute
+layers anchor on its segments, the traffic items follow its main roads, and so on. The same (tile, seed)
+always gives the same partition.
+
+The partitions are stand-ins for the decoded protobuf (Message): only the fields and the parts of the
+protobuf interface that hmctools uses are there (HasField, ByteSize, SerializeToString, DESCRIPTOR for enums).
+They are served as pickled blobs, with decode() as the schema decoder, so that fetching and decoding them
+costs something, like the real thing:
+
+    from hmctools import synthetic
+    layers = synthetic.partitions(23602975)         # layer id -> Message
+    blob = synthetic.encode(layers['topology-geometry'])
+    synthetic.SCHEMA.decode_blob(blob).segment[0].length
+
+Normally this is used through benchmark.LocalCatalog.synthetic().
+"""
+
+import collections
+import datetime
+import math
+import pickle
+import random
+
+import numpy as np
+
+from . import fakecatalog
+from . import offset
+from . import tiling
+
+
+GRID = 40  # nodes per row/column of a synthetic tile: GRID ** 2 nodes and 2 * GRID * (GRID - 1) segments
+MAIN_ROAD_EVERY = 4  # every fourth row and column is a main road (functional class 2/3, with traffic items)
+PATTERNS_PER_TILE = 24  # distinct traffic patterns per tile ; the anchors share them, like in the real layer
+
+# segment and node IDs are (tile id modulo ID_TILES) * ID_BLOCK + number within the tile, which is unique for
+# any region of less than 2048 tiles across and keeps the IDs below 2 ** 40 (see graph.KEY_BITS)
+ID_TILES = 2 ** 22
+ID_BLOCK = 2 ** 15
+
+BASE_TIME = datetime.datetime(2019, 8, 27, 0, 0, 0)  # start of the synthetic weather archive (UTC)
+BASE_TIMESTAMP = 1566907200  # 27 Aug 2019 12:00 UTC, created time of the synthetic traffic-flow
+WEATHER_FIRST_VERSION = 1000
+WEATHER_INTERVAL = datetime.timedelta(minutes=15)
+
+LAYERS = ['topology-geometry', 'road-attributes', 'navigation-attributes', 'advanced-navigation-attributes',
+          'traffic-patterns', 'traffic-flow']
+
+
+# enums: the position in the list is the number
+ORIENTATION = ['BOTH', 'FORWARD', 'BACKWARD', 'NEITHER']
+FUNCTIONAL_CLASS = ['FUNCTIONAL_CLASS_UNKNOWN', 'FUNCTIONAL_CLASS_1', 'FUNCTIONAL_CLASS_2', 'FUNCTIONAL_CLASS_3',
+                    'FUNCTIONAL_CLASS_4', 'FUNCTIONAL_CLASS_5']
+SPEED_CATEGORY = ['SPEED_CATEGORY_UNKNOWN', 'OVER_130_KPH', 'KPH_101_TO_130', 'KPH_91_TO_100', 'KPH_71_TO_90',
+                  'KPH_51_TO_70', 'KPH_31_TO_50', 'KPH_11_TO_30', 'UNDER_11_KPH']
+COUNTRY_CODE = ['COUNTRY_CODE_UNKNOWN', 'NLD', 'BEL', 'DEU']
+PRECIPITATION_TYPE = ['NONE', 'RAIN', 'SNOW', 'SLEET', 'HAIL']
+
+EnumValue = collections.namedtuple('EnumValue', 'name number')
+Field = collections.namedtuple('Field', 'name enum_type')
+Descriptor = collections.namedtuple('Descriptor', 'name fields_by_name')
+
+
+class EnumType:
+    def __init__(self, names):
+        self.values = [EnumValue(name, number) for number, name in enumerate(names)]
+        self.values_by_number = {q.number: q for q in self.values}
+        self.values_by_name = {q.name: q for q in self.values}
+
+
+# message type -> field -> enum names (None for fields that are not enums) ; only what hmctools looks at
+_FIELDS = {
+    'SegmentAnchor': {'oriented_segment_ref': None, 'attribute_orientation': ORIENTATION,
+                      'first_segment_start_offset': None, 'last_segment_end_offset': None},
+    'FunctionalClass': {'segment_anchor_index': None, 'functional_class': FUNCTIONAL_CLASS},
+    'SpeedCategory': {'segment_anchor_index': None, 'speed_category': SPEED_CATEGORY},
+    'TravelDirection': {'segment_anchor_index': None},
+    'SpeedLimit': {'segment_anchor_index': None, 'value': None},
+    'IsoCountryCode': {'segment_anchor_index': None, 'iso_country_code': None},
+    'CountryCode': {'official_country_code': COUNTRY_CODE},
+    'AccessibleBy': {'segment_anchor_index': None, 'applies_to': None},
+    'PrecipitationType': {'precipitation_type': PRECIPITATION_TYPE},
+}
+DESCRIPTORS = collections.defaultdict(lambda: Descriptor('Message', {}))
+DESCRIPTORS.update({name: Descriptor(name, {field: Field(field, EnumType(names) if names is not None else None)
+                                            for field, names in fields.items()})
+                    for name, fields in _FIELDS.items()})
+
+
+def _size(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, Message):
+        return value.ByteSize() + 2
+    if isinstance(value, list):
+        return sum(_size(q) for q in value)
+    if isinstance(value, (str, bytes)):
+        return len(value) + 2
+    return 5  # varints and floats
+
+
+class Message:
+    """
+    Stand-in for a decoded protobuf message: fields are attributes, repeated fields are lists,
+    and a field that is None is not set (HasField is False)
+    """
+
+    def __init__(self, type_name, **fields):
+        self._type = type_name
+        self.__dict__.update(fields)
+
+    @property
+    def DESCRIPTOR(self) -> Descriptor:
+        return DESCRIPTORS[self._type]
+
+    def _fields(self):
+        return sorted((name, value) for name, value in self.__dict__.items() if not name.startswith('_'))
+
+    def HasField(self, name) -> bool:
+        return getattr(self, name, None) is not None
+
+    def ByteSize(self) -> int:
+        """Roughly the size of the message in the protobuf wire format"""
+        return sum(_size(value) + 1 for _, value in self._fields())
+
+    def SerializeToString(self) -> bytes:
+        return pickle.dumps((self._type, self._fields()))
+
+    def __repr__(self):
+        return '%s(%s)' % (self._type, ', '.join('%s=%r' % q for q in self._fields()))
+
+
+def encode(message) -> bytes:
+    """The blob of a synthetic partition"""
+    return pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode(blob):
+    """Decode a blob made by encode() (the decoder of SCHEMA)"""
+    return pickle.loads(blob)
+
+
+SCHEMA = fakecatalog.FakeSchema(decode)
+
+
+def object_id(pid, number) -> int:
+    """Segment or node ID of the number-th segment or node of a synthetic tile"""
+    return (pid % ID_TILES) * ID_BLOCK + number
+
+
+def tile_bounds(pid):
+    """(south, west, size in degrees) of a tile"""
+    lats, lons = tiling.tile_centers([pid])
+    size = 360.0 / 2 ** tiling.tile_level(pid)
+    return float(lats[0]) - size / 2, float(lons[0]) - size / 2, size
+
+
+class _Network:
+    """The synthetic road network of one tile, from which all layers are derived"""
+
+    def __init__(self, pid, grid, seed):
+        self.pid = pid
+        self.grid = grid
+        self.rng = random.Random(seed * 1000003 + pid)
+        south, west, size = tile_bounds(pid)
+        step = size / grid
+        rng = self.rng
+
+        # node k = (row i, column j) with k = i * grid + j
+        self.nodes = [(south + (i + 0.5 + rng.uniform(-0.1, 0.1)) * step,
+                       west + (j + 0.5 + rng.uniform(-0.1, 0.1)) * step) for i in range(grid) for j in range(grid)]
+        self.node_segments = [[] for _ in self.nodes]
+
+        # segment: (sid, start node, end node, points, length, line, functional class, orientation, automobiles)
+        # line is ('row', i) or ('column', j) ; orientation is the travel direction (BOTH unless one way)
+        self.segments = []
+        lines = [('row', i, [(i * grid + j, i * grid + j + 1) for j in range(grid - 1)]) for i in range(grid)] + \
+                [('column', j, [(i * grid + j, (i + 1) * grid + j) for i in range(grid - 1)]) for j in range(grid)]
+        self.lines = {}  # line -> list of segment numbers, in driving direction FORWARD
+        for kind, index, pairs in lines:
+            main = index % MAIN_ROAD_EVERY == 0
+            self.lines[(kind, index)] = []
+            for start, end in pairs:
+                number = len(self.segments)
+                points = [self.nodes[start]]
+                for f in sorted(rng.uniform(0.1, 0.9) for _ in range(rng.randint(0, 3))):
+                    wobble = rng.uniform(-0.05, 0.05) * step
+                    lat = self.nodes[start][0] + f * (self.nodes[end][0] - self.nodes[start][0])
+                    lon = self.nodes[start][1] + f * (self.nodes[end][1] - self.nodes[start][1])
+                    points.append((lat + wobble, lon) if kind == 'row' else (lat, lon + wobble))
+                points.append(self.nodes[end])
+                fc = rng.choice([2, 3]) if main else rng.choice([4, 5, 5])
+                if not main and rng.random() < 0.15:
+                    orientation = rng.choice(['FORWARD', 'BACKWARD'])
+                else:
+                    orientation = 'BOTH'
+                self.segments.append((object_id(pid, number), start, end, points,
+                                      float(offset.get_lengths(points).sum()), (kind, index), fc, orientation,
+                                      rng.random() < 0.95))
+                self.node_segments[start].append(number)
+                self.node_segments[end].append(number)
+                self.lines[(kind, index)].append(number)
+
+    def main_lines(self):
+        return [line for line in sorted(self.lines) if line[1] % MAIN_ROAD_EVERY == 0]
+
+
+class _Anchors:
+    """The segment_anchor list of an attribute partition ; index() adds an anchor once and returns its position"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.messages = []
+        self._positions = {}
+
+    def index(self, sid, orientation, start=0.0, end=1.0) -> int:
+        key = (sid, orientation, start, end)
+        position = self._positions.get(key)
+        if position is None:
+            position = self._positions[key] = len(self.messages)
+            ref = Message('SegmentRef', partition_name=str(self.pid), identifier='here:cm:segment:%d' % sid)
+            self.messages.append(Message(
+                'SegmentAnchor', oriented_segment_ref=[Message('OrientedSegmentRef', segment_ref=ref, inverted=False)],
+                attribute_orientation=ORIENTATION.index(orientation),
+                first_segment_start_offset=Message('Offset', value=start) if start > 0 else None,
+                last_segment_end_offset=Message('Offset', value=end) if end < 1 else None))
+        return position
+
+
+def _grouped(type_name, field, pairs):
+    """One item per distinct value with the indices of all of its anchors, like the real attribute layers"""
+    items = collections.OrderedDict()
+    for value, anchor in pairs:
+        key = value.SerializeToString() if isinstance(value, Message) else value
+        if key not in items:
+            items[key] = (value, [])
+        items[key][1].append(anchor)
+    if field is None:
+        return [Message(type_name, segment_anchor_index=anchors) for _, anchors in items.values()]
+    return [Message(type_name, segment_anchor_index=anchors, **{field: value}) for value, anchors in items.values()]
+
+
+def _topology_geometry(net):
+    pid = net.pid
+
+    def ref(type_name, number, kind):
+        return Message(type_name, partition_name=str(pid), identifier='here:cm:%s:%d' % (kind, object_id(pid, number)))
+
+    segments = [Message('Segment', identifier='here:cm:segment:%d' % sid, length=length,
+                        start_node_ref=ref('NodeRef', start, 'node'), end_node_ref=ref('NodeRef', end, 'node'),
+                        geometry=Message('LineString', point=[Message('Point', latitude=lat, longitude=lon)
+                                                              for lat, lon in points]))
+                for sid, start, end, points, length, _, _, _, _ in net.segments]
+    nodes = [Message('Node', identifier='here:cm:node:%d' % object_id(pid, k),
+                     geometry=Message('Point', latitude=lat, longitude=lon),
+                     segment_ref=[ref('SegmentRef', q, 'segment') for q in net.node_segments[k]])
+             for k, (lat, lon) in enumerate(net.nodes)]
+    return Message('TopologyGeometryPartition', partition_name=str(pid), segment=segments, node=nodes)
+
+
+def _road_attributes(net):
+    anchors = _Anchors(net.pid)
+    everyone = Message('AppliesTo', automobiles=True, buses=True, taxis=True, trucks=True, pedestrians=True,
+                       bicycles=True)
+    no_cars = Message('AppliesTo', automobiles=False, buses=True, taxis=False, trucks=False, pedestrians=True,
+                      bicycles=True)
+    country = Message('CountryCode', official_country_code=COUNTRY_CODE.index('NLD'))
+    fc, cc, access = [], [], []
+    for sid, _, _, _, _, _, functional_class, _, automobiles in net.segments:
+        anchor = anchors.index(sid, 'BOTH')
+        fc.append((functional_class, anchor))
+        cc.append((country, anchor))
+        access.append((everyone if automobiles else no_cars, anchor))
+    return Message('RoadAttributesPartition', partition_name=str(net.pid), segment_anchor=anchors.messages,
+                   functional_class=_grouped('FunctionalClass', 'functional_class', fc),
+                   iso_country_code=_grouped('IsoCountryCode', 'iso_country_code', cc),
+                   accessible_by=_grouped('AccessibleBy', 'applies_to', access))
+
+
+SPEED_CATEGORY_OF_FC = {2: 'KPH_71_TO_90', 3: 'KPH_51_TO_70', 4: 'KPH_31_TO_50', 5: 'KPH_11_TO_30'}
+SPEED_LIMIT_OF_FC = {2: 80, 3: 50, 4: 50, 5: 30}
+
+
+def _directions(orientation):
+    return ['FORWARD', 'BACKWARD'] if orientation == 'BOTH' else [orientation]
+
+
+def _navigation_attributes(net):
+    anchors = _Anchors(net.pid)
+    direction, category = [], []
+    for sid, _, _, _, _, _, fc, orientation, _ in net.segments:
+        direction.append((None, anchors.index(sid, orientation)))
+        category.append((SPEED_CATEGORY.index(SPEED_CATEGORY_OF_FC[fc]), anchors.index(sid, 'BOTH')))
+    return Message('NavigationAttributesPartition', partition_name=str(net.pid), segment_anchor=anchors.messages,
+                   travel_direction=_grouped('TravelDirection', None, direction),
+                   speed_category=_grouped('SpeedCategory', 'speed_category', category))
+
+
+def _advanced_navigation_attributes(net):
+    anchors = _Anchors(net.pid)
+    limits = []
+    for sid, _, _, _, _, _, fc, orientation, _ in net.segments:
+        for d in _directions(orientation):
+            if fc <= 3:  # main roads get two speed limit intervals, so lookups have to pick one
+                limits.append((SPEED_LIMIT_OF_FC[fc] + 20, anchors.index(sid, d, 0.0, 0.5)))
+                limits.append((SPEED_LIMIT_OF_FC[fc], anchors.index(sid, d, 0.5, 1.0)))
+            else:
+                limits.append((SPEED_LIMIT_OF_FC[fc], anchors.index(sid, d)))
+    return Message('AdvancedNavigationAttributesPartition', partition_name=str(net.pid),
+                   segment_anchor=anchors.messages, speed_limit=_grouped('SpeedLimit', 'value', limits))
+
+
+def _daily_pattern(rng, free_flow, day):
+    # hourly steps, with a morning and evening rush on weekdays (day 1 = Sunday, 7 = Saturday)
+    steps = []
+    for hour in range(24):
+        dip = 0.0
+        if 2 <= day <= 6 and hour in (7, 8, 16, 17):
+            dip = rng.uniform(0.2, 0.5)
+        steps.append(Message('SpeedPattern', epoch=hour * 12, speed=max(5, int(free_flow * (1 - dip)))))
+    return Message('DailyPattern', day_of_week=day, speed_pattern=steps)
+
+
+def _traffic_patterns(net):
+    anchors = _Anchors(net.pid)
+    rng = net.rng
+    pattern_list = []
+    for k in range(PATTERNS_PER_TILE):
+        free_flow = SPEED_LIMIT_OF_FC[2 + k % 4]
+        pattern_list.append([_daily_pattern(rng, free_flow, day) for day in range(1, 8)])
+    used = collections.OrderedDict()  # pattern -> anchor indices
+    for sid, _, _, _, _, _, fc, orientation, _ in net.segments:
+        for d in _directions(orientation):
+            k = (fc - 2) + 4 * rng.randrange(PATTERNS_PER_TILE // 4)
+            used.setdefault(k, []).append(anchors.index(sid, d))
+    items = [Message('TrafficPattern', traffic_pattern=pattern_list[k], segment_anchor_index=positions)
+             for k, positions in used.items()]
+    return Message('TrafficPatternsPartition', partition_name=str(net.pid), segment_anchor=anchors.messages,
+                   traffic_pattern=items)
+
+
+def _traffic_flow(net, timestamp):
+    rng = net.rng
+    items = []
+    for line in net.main_lines():
+        numbers = net.lines[line]
+        for forward in [True, False]:
+            start = 0
+            while start < len(numbers):
+                chunk = numbers[start:start + rng.randint(2, 5)]
+                start += len(chunk)
+                sids = [net.segments[q][0] for q in (chunk if forward else reversed(chunk))]
+                free_flow = float(SPEED_LIMIT_OF_FC[net.segments[chunk[0]][6]])
+                flows = []
+                for so in [0.0] + sorted(round(rng.uniform(0.2, 0.8), 3) for _ in range(rng.randint(0, 2))):
+                    jam = round(rng.uniform(0, 10), 1)
+                    speed = Message('Speed', average_speed_kph=round(free_flow * (1 - jam / 12), 1),
+                                    free_flow_speed_kph=free_flow)
+                    flows.append(Message('FlowSegment', start_offset=so, jam_factor=jam, speed=speed))
+                ts = Message('TopologySegment', topology_segment_id=sids,
+                             start_offset=round(rng.uniform(0, 0.3), 3), end_offset=round(rng.uniform(0, 0.3), 3),
+                             is_first_segment_in_driving_direction=forward)
+                # as in the real schema, the confidence is a field of the Flow, not of its segments
+                flow = Message('Flow', segment=flows, confidence=round(rng.uniform(0.7, 1.0), 2))
+                items.append(Message('TrafficItem', id='%d-%d' % (net.pid, len(items)), created_timestamp=timestamp,
+                                     updated_timestamp=timestamp + rng.randint(0, 120), is_active=True,
+                                     topology_segment=ts, flow=flow))
+    return Message('TrafficFlowPartition', items=items)
+
+
+def partitions(pid, grid=GRID, seed=0, timestamp=BASE_TIMESTAMP) -> dict:
+    """All synthetic layers of one tile (an HMC partition id): dict layer id -> Message (see LAYERS)"""
+    net = _Network(pid, grid, seed)
+    return {'topology-geometry': _topology_geometry(net),
+            'road-attributes': _road_attributes(net),
+            'navigation-attributes': _navigation_attributes(net),
+            'advanced-navigation-attributes': _advanced_navigation_attributes(net),
+            'traffic-patterns': _traffic_patterns(net),
+            'traffic-flow': _traffic_flow(net, timestamp)}
+
+
+def weather_versions(count):
+    """(timestamp, version) of the first count versions of the synthetic weather archive"""
+    return [(BASE_TIME + k * WEATHER_INTERVAL, WEATHER_FIRST_VERSION + k) for k in range(count)]
+
+
+def weather_index(count) -> bytes:
+    """The timestamp-index blob of a synthetic weather archive with count versions"""
+    return '\n'.join('%s,%d' % (ts.strftime('%m/%d/%Y %H:%M:%S'), version)
+                     for ts, version in weather_versions(count)).encode()
+
+
+def weather_partition(tile8, version, seed=0):
+    """The archived-data partition of a level 8 tile: all of its 4096 level 14 tiles, about 5% without coverage"""
+    assert tiling.tile_level(tile8) == 8, 'weather_partition: not a level 8 tile'
+    rng = random.Random((seed * 1000003 + tile8) * 1000003 + version)
+    tiles = tiling.child_tile_ids([tile8], 14)
+    lats, lons = tiling.tile_centers(tiles)
+    hour = (version - WEATHER_FIRST_VERSION) * WEATHER_INTERVAL.total_seconds() / 3600.0
+    temperature = 15 + 5 * np.sin(np.radians(lats * 40)) + 4 * math.sin(2 * math.pi * (hour - 9) / 24)
+    timestamp = (BASE_TIME + (version - WEATHER_FIRST_VERSION) * WEATHER_INTERVAL).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def value(v):
+        return Message('Value', value=round(float(v), 2))
+
+    output = []
+    for tile, t, lon in zip(tiles.tolist(), temperature.tolist(), lons.tolist()):
+        rain = rng.random() < 0.2 + 0.1 * math.sin(lon)
+        output.append(Message(
+            'WeatherConditionTile', tile_id=tile, timestamp=timestamp,
+            air_temperature=value(t if rng.random() > 0.05 else -9999),
+            humidity=value(rng.uniform(50, 95)), iop=value(rng.uniform(0, 1)), visibility=value(rng.uniform(2, 30)),
+            precipitation_type=Message('PrecipitationType', precipitation_type=PRECIPITATION_TYPE.index(
+                'RAIN' if rain else 'NONE')),
+            wind_velocity=Message('Wind', value=round(rng.uniform(0, 15), 1), direction=rng.randrange(360)),
+            air_pressure=value(rng.uniform(990, 1030))))
+    return Message('WeatherPartition', partition_name=str(tile8), weather_condition_tile=output)
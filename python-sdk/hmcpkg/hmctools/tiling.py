@@ -0,0 +1,67 @@
+"""
+Vectorized HERE tile ids
+
+nagini.utils.tiling computes the tile of one coordinate at a time, which is fine for a handful of points
+but not for hundreds of thousands of probe points. These functions do the same thing on NumPy arrays.
+
+A HERE tile at level L is a square of 360/2^L degrees ; the tile id is the Morton code of the
+(column, row) of the tile (column bits in the even positions) with an extra bit 1 << 2L marking the level.
+"""
+
+import numpy as np
+
+
+def tile_ids_from_coordinates(latitudes, longitudes, level) -> np.ndarray:
+    """Return the level tile id (int64) of every (latitude, longitude) pair"""
+    size = 360.0 / 2 ** level
+    lats = np.asarray(latitudes, dtype=np.float64)
+    lons = np.asarray(longitudes, dtype=np.float64)
+    # longitude 180 and latitude 90 belong to the last column/row
+    x = np.clip(np.floor((lons + 180.0) / size).astype(np.int64), 0, 2 ** level - 1)
+    y = np.clip(np.floor((lats + 90.0) / size).astype(np.int64), 0, max(2 ** (level - 1) - 1, 0))
+
+    output = np.zeros(x.shape, dtype=np.int64)
+    for bit in range(level):
+        output |= ((x >> bit) & 1) << (2 * bit)
+        output |= ((y >> bit) & 1) << (2 * bit + 1)
+    return output | (1 << (2 * level))
+
+
+def tile_level(tile_id) -> int:
+    """Return the level of a tile id"""
+    return (int(tile_id).bit_length() - 1) // 2
+
+
+def parent_tile_ids(tile_ids, level):
+    """Return the tile id(s) at the (lower) level that contain the given tile id(s)"""
+    tile_ids = np.asarray(tile_ids, dtype=np.int64)
+    shift = 2 * (tile_level(tile_ids.flat[0]) - level) if tile_ids.size > 0 else 0
+    assert shift >= 0, 'parent_tile_ids: level is higher than the level of the tiles'
+    return tile_ids >> shift
+
+
+def child_tile_ids(tile_ids, level) -> np.ndarray:
+    """Return all of the tile ids at the (higher) level that are inside the given tile id(s), sorted"""
+    output = []
+    for tile_id in np.atleast_1d(np.asarray(tile_ids, dtype=np.int64)):
+        shift = 2 * (level - tile_level(tile_id))
+        assert shift >= 0, 'child_tile_ids: level is lower than the level of the tile'
+        output.append((int(tile_id) << shift) + np.arange(1 << shift, dtype=np.int64))
+    if not output:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(output))
+
+
+def tile_centers(tile_ids):
+    """Return the (latitudes, longitudes) of the centers of the given tile ids (which must share one level)"""
+    tile_ids = np.asarray(tile_ids, dtype=np.int64)
+    if tile_ids.size == 0:
+        return np.zeros(0), np.zeros(0)
+    level = tile_level(tile_ids.flat[0])
+    x = np.zeros(tile_ids.shape, dtype=np.int64)
+    y = np.zeros(tile_ids.shape, dtype=np.int64)
+    for bit in range(level):
+        x |= ((tile_ids >> (2 * bit)) & 1) << bit
+        y |= ((tile_ids >> (2 * bit + 1)) & 1) << bit
+    size = 360.0 / 2 ** level
+    return (y + 0.5) * size - 90.0, (x + 0.5) * size - 180.0
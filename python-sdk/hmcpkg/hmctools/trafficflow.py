@@ -0,0 +1,151 @@
+"""
+Columnar representation of the traffic-flow layer
+
+Each partition is decoded in one pass over the traffic items into flat NumPy arrays:
+    items (structured array, one row per traffic item)
+        created, updated, start_offset, end_offset, in_driving_direction, is_active
+    item_ids
+        the id of every traffic item (str)
+    segment_ptr, segment_ids
+        the topology segment ids of all items, concatenated ; the ids of item i are
+        segment_ids[segment_ptr[i]:segment_ptr[i + 1]] (CSR style)
+    flows (structured array, one row per flow segment of an item)
+        item, start_offset, end_offset, jam_factor, speed, free_flow_speed, confidence (of the flow of the item)
+        (end_offset is the start of the next flow segment of the item, or 1.0 ; NaN where a value is missing)
+
+This is a small fraction of the memory of the decoded protobuf, and questions about a whole tile become
+NumPy operations, e.g. the jam factor histogram or the segments per jam band of the traffic_jam notebook:
+
+    from hmctools.segment import LiveTrafficFlow
+    arrays = LiveTrafficFlow().get_arrays(23602975)
+    counts, edges = arrays.jam_histogram()
+    bands = arrays.segments_by_jam_band([0, 4, 6, 8, 10])     # list of arrays of segment ids, one per band
+"""
+
+import numpy as np
+
+
+ITEM_DTYPE = np.dtype([('created', np.int64), ('updated', np.int64), ('start_offset', np.float32),
+                       ('end_offset', np.float32), ('in_driving_direction', np.bool_), ('is_active', np.bool_)])
+FLOW_DTYPE = np.dtype([('item', np.int32), ('start_offset', np.float32), ('end_offset', np.float32),
+                       ('jam_factor', np.float32), ('speed', np.float32), ('free_flow_speed', np.float32),
+                       ('confidence', np.float32)])
+
+
+def _value(message, name):
+    """A numeric field of a protobuf message as float ; NaN if the message has no such field or it is not set"""
+    try:
+        if not message.HasField(name):
+            return np.nan
+    except ValueError:  # not a field of the message, or a proto3 scalar that has no presence
+        pass
+    value = getattr(message, name, None)
+    return float(value) if value is not None else np.nan
+
+
+class TrafficFlowArrays:
+    """
+    Traffic items and flow segments of one traffic-flow partition as NumPy arrays (see module docstring)
+    """
+
+    ARRAYS = ['items', 'segment_ptr', 'segment_ids', 'flows', 'item_ids']
+
+    def __init__(self, items, segment_ptr, segment_ids, flows, item_ids=None):
+        self.items = items
+        self.segment_ptr = segment_ptr
+        self.segment_ids = segment_ids
+        self.flows = flows
+        self.item_ids = item_ids if item_ids is not None else np.zeros(len(items), dtype='U1')
+
+    @classmethod
+    def from_parsed(cls, parsed):
+        """Build the arrays from a decoded traffic-flow partition (None gives empty arrays)"""
+        items = []
+        item_ids = []
+        counts = []
+        segment_ids = []
+        flows = []
+        for item_index, item in enumerate(parsed.items if parsed is not None else []):
+            ts = item.topology_segment
+            items.append((item.created_timestamp, item.updated_timestamp, ts.start_offset, ts.end_offset,
+                          ts.is_first_segment_in_driving_direction, item.is_active))
+            item_ids.append(item.id)
+            counts.append(len(ts.topology_segment_id))
+            segment_ids.extend(ts.topology_segment_id)
+
+            has_flow = item.HasField('flow')
+            flow_segments = list(item.flow.segment) if has_flow else []
+            # the confidence is one value for the whole flow of the item
+            confidence = _value(item.flow, 'confidence') if has_flow else np.nan
+            for i, seg in enumerate(flow_segments):
+                end = flow_segments[i + 1].start_offset if i + 1 < len(flow_segments) else 1.0
+                if seg.HasField('speed'):
+                    speed = _value(seg.speed, 'average_speed_kph')
+                    free_flow = _value(seg.speed, 'free_flow_speed_kph')
+                else:
+                    speed, free_flow = np.nan, np.nan
+                flows.append((item_index, seg.start_offset, end, _value(seg, 'jam_factor'), speed, free_flow,
+                              confidence))
+
+        segment_ptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=segment_ptr[1:])
+        return cls(np.array(items, dtype=ITEM_DTYPE), segment_ptr, np.array(segment_ids, dtype=np.int64),
+                   np.array(flows, dtype=FLOW_DTYPE), np.array(item_ids, dtype=str))
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def flow_ptr(self) -> np.ndarray:
+        """The flow rows of item i are flow_ptr[i]:flow_ptr[i + 1] (from_parsed adds them in item order)"""
+        counts = np.bincount(self.flows['item'], minlength=len(self.items)) if len(self.flows) else \
+            np.zeros(len(self.items), dtype=np.int64)
+        return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def item_segments(self, item) -> np.ndarray:
+        """The topology segment ids of one traffic item, in driving order"""
+        return self.segment_ids[self.segment_ptr[item]:self.segment_ptr[item + 1]]
+
+    def segment_items(self):
+        """
+        Return (item index, segment id) arrays with one entry for every segment of every item,
+        i.e. the CSR arrays expanded ; useful to join with other per-segment data
+        """
+        return np.repeat(np.arange(len(self.items)), np.diff(self.segment_ptr)), self.segment_ids
+
+    def segments_of_flows(self, rows):
+        """
+        Return (flow row, segment id) arrays with one entry for every segment of the item of every flow row
+        rows is an array of flow row indices or a boolean mask over the flows
+        """
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == np.bool_ else np.asarray(rows, dtype=np.int64)
+        items = self.flows['item'][rows]
+        counts = self.segment_ptr[items + 1] - self.segment_ptr[items]
+        first = np.repeat(self.segment_ptr[items] - np.cumsum(counts) + counts, counts)
+        return np.repeat(rows, counts), self.segment_ids[first + np.arange(counts.sum())]
+
+    def segments_with_jam(self, low, high) -> np.ndarray:
+        """The (unique) segment ids of the items that have a flow segment with low < jam_factor <= high"""
+        jam = self.flows['jam_factor']
+        return np.unique(self.segments_of_flows((jam > low) & (jam <= high))[1])
+
+    def segments_by_jam_band(self, edges):
+        """
+        Segment ids per jam band, in one pass: band i is edges[i] < jam_factor <= edges[i + 1]
+        Returns a list of len(edges) - 1 arrays of unique segment ids
+        """
+        edges = np.asarray(edges, dtype=np.float64)
+        band = np.searchsorted(edges, self.flows['jam_factor'], side='left') - 1
+        rows, sids = self.segments_of_flows(np.flatnonzero((band >= 0) & (band < len(edges) - 1)))
+        band = band[rows]
+        order = np.argsort(band, kind='stable')
+        bounds = np.searchsorted(band[order], np.arange(len(edges)))
+        return [np.unique(sids[order[bounds[i]:bounds[i + 1]]]) for i in range(len(edges) - 1)]
+
+    def jam_histogram(self, bins=10, value_range=(0.0, 10.0)):
+        """np.histogram of the jam factors of all flow segments (missing values are left out)"""
+        jam = self.flows['jam_factor']
+        return np.histogram(jam[~np.isnan(jam)], bins=bins, range=value_range)
@@ -0,0 +1,335 @@
+"""
+Streaming decoder for TrafficML 3.3 flow (the 'flow' layer of the nld-traffic catalog)
+
+This replaces the decode_traffic-v1 notebook code, which joined the blobs, gunzipped everything at once,
+wrote the text to disk and parsed it again into one big element tree. Here the blobs are decompressed chunk
+by chunk (a partition can be several gzip members, each a document of its own) and fed into an
+incremental XML parser, and every element is thrown away as soon as its record is out, so memory stays
+flat no matter how large the partition is.
+
+Every flow record is one row (per RW/FI/CF, and per SS if the CF has sub segments):
+
+    created, map_version, units,                    -- TRAFFICML_REALTIME
+    rws_type,                                       -- RWS TY (SHP or TMC)
+    li, rw_de, pbt,                                 -- RW (linear id, description, timestamp)
+    fi,                                             -- index of the FI in the RW
+    tmc_pc, tmc_de, tmc_qd, tmc_le,                 -- TMC location of the FI (if any)
+    cf_type, confidence, free_flow, jam_factor,     -- CF, TY is TR (through), HV (HOV) or RA (ramp)
+    speed, speed_uncapped,
+    ss, ss_length,                                  -- -1 and NaN for the CF itself, else the SS index and LE
+    shape                                           -- SHP text of the FI ("lat,lon lat,lon ..."), one per FI
+                                                       row ; None for the SS rows
+
+    from hmctools import trafficml
+    for record in trafficml.iter_records(blob): ...                 # dicts
+    df = trafficml.decode_blob(blob)                                # DataFrame
+    for pid, df in trafficml.decode_partitions([23602974, 23602975], version=0): ...
+    trafficml.decode_partitions(pids, out_dir='flow')               # <out_dir>/<pid>.parquet, on all cores
+
+decode_partitions fetches through the shared fetch engine and decodes every partition in its own process,
+since parsing XML is CPU bound and would otherwise be limited to one core by the GIL.
+"""
+
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+from . import fetch
+
+
+CATALOG_HRN = 'hrn:here:data::olp-amsterdam:nld-traffic'
+LAYER_ID = 'flow'
+
+COLUMNS = ['created', 'map_version', 'units', 'rws_type', 'li', 'rw_de', 'pbt', 'fi', 'tmc_pc', 'tmc_de',
+           'tmc_qd', 'tmc_le', 'cf_type', 'confidence', 'free_flow', 'jam_factor', 'speed', 'speed_uncapped',
+           'ss', 'ss_length', 'shape']
+NUMERIC = ['tmc_le', 'confidence', 'free_flow', 'jam_factor', 'speed', 'speed_uncapped', 'ss_length']
+CF_TYPES = {'TR': 'THRU', 'HV': 'HOV', 'RA': 'RAMP'}
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 1 << 16
+BATCH_SIZE = 50000
+
+
+def gunzip_members(chunks, chunk_size=CHUNK_SIZE):
+    """
+    Decompress an iterable of byte chunks that hold one or more gzip members back to back ; yields
+    (member number, decompressed bytes) in pieces of at most chunk_size bytes (XML compresses very well, so
+    one compressed chunk can be many megabytes of text). Data that does not start with the gzip magic is
+    passed on as is (as member 0).
+    """
+    decompressor = None
+    member = -1
+    head = b''  # the first bytes, until there are enough to tell whether it is gzip at all
+    plain = False
+    for chunk in chunks:
+        if member < 0 and not plain:
+            head += chunk
+            if len(head) < len(GZIP_MAGIC):
+                continue
+            chunk, head = head, b''
+            plain = not chunk.startswith(GZIP_MAGIC)
+        if plain:
+            yield 0, chunk
+            continue
+        while chunk:
+            if decompressor is None:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                member += 1
+            while True:
+                output = decompressor.decompress(chunk, chunk_size)
+                if output:
+                    yield member, output
+                chunk = decompressor.unconsumed_tail
+                # a full piece of output means there may be more waiting, even when all input is in
+                if decompressor.eof or (not chunk and len(output) < chunk_size):
+                    break
+            if decompressor.eof:
+                # end of a member: whatever is left over is the start of the next one
+                chunk = decompressor.unused_data
+                decompressor = None
+    if head:
+        yield 0, head
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError('gunzip_members: truncated gzip data')
+
+
+def _blob_chunks(blob, chunk_size=CHUNK_SIZE):
+    """Split bytes (or a list of blobs, e.g. the result of read_partitions) into chunks"""
+    if isinstance(blob, (bytes, bytearray, memoryview)):
+        blob = [blob]
+    for part in blob:
+        view = memoryview(part)
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+
+
+def _tag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _number(value):
+    return float(value) if value is not None else np.nan
+
+
+def iter_records(blob, chunk_size=CHUNK_SIZE):
+    """
+    Yield the flow records (dicts with COLUMNS) of a TrafficML blob: gzipped or plain bytes, a list of blobs,
+    or any iterable of byte chunks (e.g. a file opened in binary mode read in blocks)
+    """
+    chunks = _blob_chunks(blob, chunk_size) if isinstance(blob, (bytes, bytearray, memoryview, list)) else blob
+    parser = None
+    member = None
+    stack = []  # the open elements ; only their attributes are used, children are dropped when done
+    names = {}  # tag with namespace -> tag without
+    realtime, rws, rw, fi = {}, {}, {}, {}
+    fi_index = -1
+    shapes, tmc, flows = [], {}, []
+
+    for index, data in gunzip_members(chunks, chunk_size):
+        # every gzip member is a document of its own (e.g. the blobs of two partitions joined together)
+        if index != member:
+            if parser is not None:
+                parser.close()
+            parser = ET.XMLPullParser(events=('start', 'end'))
+            member = index
+            stack = []
+        parser.feed(data)
+        for event, element in parser.read_events():
+            tag = names.get(element.tag)
+            if tag is None:
+                tag = names[element.tag] = _tag(element)
+            if event == 'start':
+                stack.append(element)
+                if tag == 'TRAFFICML_REALTIME':
+                    realtime = element.attrib
+                elif tag == 'RWS':
+                    rws = element.attrib
+                elif tag == 'RW':
+                    rw = element.attrib
+                    fi_index = -1
+                elif tag == 'FI':
+                    fi_index += 1
+                    shapes, tmc, flows = [], {}, []
+                continue
+
+            stack.pop()
+            if tag == 'SHP':
+                shapes.append((element.text or '').strip())
+            elif tag == 'TMC':
+                tmc = element.attrib
+            elif tag == 'CF':
+                flows.append((element.attrib, [q.attrib for q in element.iter() if _tag(q) == 'SS']))
+            elif tag == 'FI':
+                base = {'created': realtime.get('CREATED_TIMESTAMP'), 'map_version': realtime.get('MAP_VERSION'),
+                        'units': realtime.get('UNITS'), 'rws_type': rws.get('TY'), 'li': rw.get('LI'),
+                        'rw_de': rw.get('DE'), 'pbt': rw.get('PBT'), 'fi': fi_index, 'tmc_pc': tmc.get('PC'),
+                        'tmc_de': tmc.get('DE'), 'tmc_qd': tmc.get('QD'), 'tmc_le': _number(tmc.get('LE'))}
+                shape = ' '.join(shapes) if shapes else None
+                for cf, sub_segments in flows:
+                    record = dict(base, cf_type=CF_TYPES.get(cf.get('TY'), cf.get('TY')),
+                                  confidence=_number(cf.get('CN')), free_flow=_number(cf.get('FF')),
+                                  jam_factor=_number(cf.get('JF')), speed=_number(cf.get('SP')),
+                                  speed_uncapped=_number(cf.get('SU')), ss=-1, ss_length=np.nan, shape=shape)
+                    yield record
+                    for i, ss in enumerate(sub_segments):
+                        yield dict(record, free_flow=_number(ss.get('FF', cf.get('FF'))),
+                                   jam_factor=_number(ss.get('JF')), speed=_number(ss.get('SP')),
+                                   speed_uncapped=_number(ss.get('SU')), ss=i, ss_length=_number(ss.get('LE')),
+                                   shape=None)
+            if tag in ['SHP', 'TMC', 'CF', 'FI', 'RW', 'RWS']:
+                # done with it: drop it from its parent, so the tree never holds more than the open elements
+                element.clear()
+                if stack and tag in ['FI', 'RW', 'RWS']:
+                    stack[-1].remove(element)
+    if parser is not None:
+        parser.close()
+
+
+def iter_batches(blob, batch_size=BATCH_SIZE):
+    """Decode a blob into DataFrames of at most batch_size records each (built column by column)"""
+    columns = {name: [] for name in COLUMNS}
+    count = 0
+    for record in iter_records(blob):
+        for name in COLUMNS:
+            columns[name].append(record[name])
+        count += 1
+        if count == batch_size:
+            yield _to_dataframe(columns)
+            columns = {name: [] for name in COLUMNS}
+            count = 0
+    if count > 0:
+        yield _to_dataframe(columns)
+
+
+def _to_dataframe(columns) -> pd.DataFrame:
+    df = pd.DataFrame(columns, columns=COLUMNS)
+    for name in NUMERIC:
+        df[name] = df[name].astype(np.float64)
+    df['fi'] = df['fi'].astype(np.int32)
+    df['ss'] = df['ss'].astype(np.int32)
+    return df
+
+
+def decode_blob(blob) -> pd.DataFrame:
+    """Decode a whole blob into one DataFrame with COLUMNS"""
+    batches = list(iter_batches(blob))
+    if not batches:
+        return _to_dataframe({name: [] for name in COLUMNS})
+    return pd.concat(batches, ignore_index=True)
+
+
+def parse_shape(shape) -> np.ndarray:
+    """Turn the shape column ("lat,lon lat,lon ...") into an (n, 2) array of lat/lon"""
+    if not shape:
+        return np.zeros((0, 2))
+    return np.array([q.split(',') for q in shape.split()], dtype=np.float64)
+
+
+def arrow_schema():
+    """The pyarrow schema of the files written by decode_partitions: pid and COLUMNS"""
+    import pyarrow as pa
+    types = dict({name: pa.float64() for name in NUMERIC}, fi=pa.int32(), ss=pa.int32())
+    return pa.schema([('pid', pa.int64())] + [(name, types.get(name, pa.string())) for name in COLUMNS])
+
+
+def _write_partition(pid, blob, path):
+    """Decode a partition batch by batch into a parquet file, so only one batch is ever in memory"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = arrow_schema()
+    # written to a temporary name and renamed, so a file that exists is complete
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    os.close(fd)
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for df in iter_batches(blob):
+                df.insert(0, 'pid', pid)
+                writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _decode_partition(pid, blob, out_dir):
+    """Work done in the worker processes: decode one partition into <out_dir>/<pid>.parquet"""
+    path = os.path.join(out_dir, str(pid) + '.parquet')
+    _write_partition(pid, blob, path)
+    return pid, path
+
+
+def flow_layer():
+    """The nagini flow layer, looked up on first use (worker processes never need it)"""
+    from .segment import get_layer  # nagini is only imported by the parent
+    return get_layer(CATALOG_HRN, LAYER_ID)
+
+
+def decode_partitions(pids, version=None, out_dir=None, processes=None, layer=None):
+    """
+    Fetch and decode flow partitions, one partition per process (processes defaults to the number of cores)
+
+    Without out_dir this is a generator of (pid, DataFrame), in the order the partitions finish.
+    With out_dir, every partition is written to <out_dir>/<pid>.parquet and the list of
+    (pid, path or the exception) is returned ; partitions that already have a file are skipped.
+    The workers stream their records into parquet files (this needs pyarrow) and only about two partitions
+    per process are fetched ahead (concurrently), so memory is bounded by the largest partitions.
+    """
+    if out_dir is None:
+        return _read_partitions(pids, version, processes, layer)
+    os.makedirs(out_dir, exist_ok=True)
+    pids = [q for q in pids if not os.path.exists(os.path.join(out_dir, str(q) + '.parquet'))]
+    output = []
+    for pid, result in _decode_partitions(pids, version, out_dir, processes, layer, keep_errors=True):
+        output.append((pid, result))
+    return output
+
+
+def _read_partitions(pids, version, processes, layer):
+    # the workers write to a scratch directory rather than pickling whole DataFrames back to us
+    with tempfile.TemporaryDirectory(prefix='hmctools-flow-') as scratch:
+        for pid, path in _decode_partitions(pids, version, scratch, processes, layer):
+            df = pd.read_parquet(path)
+            os.unlink(path)
+            yield pid, df
+
+
+def _decode_partitions(pids, version, out_dir, processes, layer, keep_errors=False):
+    layer = layer if layer is not None else flow_layer()
+    fetcher = fetch.get_fetcher()
+    processes = processes or os.cpu_count() or 1
+    pids = list(pids)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = {}
+        position = 0
+        while position < len(pids) or pending:
+            # keep the pool busy, but do not fetch everything at once ; the blobs that are needed to fill
+            # it up are fetched concurrently
+            window = pids[position:position + max(2 * processes - len(pending), 0)]
+            position += len(window)
+            blobs = fetcher.fetch_many(layer, window, version, layer_key=(CATALOG_HRN, LAYER_ID)) if window else {}
+            for pid in window:
+                blob = blobs[pid]
+                if isinstance(blob, fetch.FetchError):
+                    if not keep_errors:
+                        raise blob
+                    yield pid, blob
+                    continue
+                pending[pool.submit(_decode_partition, pid, blob, out_dir)] = pid
+                del blobs[pid]  # the worker has its own copy
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pid = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    if not keep_errors:
+                        raise
+                    yield pid, e
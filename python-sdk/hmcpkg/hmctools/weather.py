@@ -0,0 +1,297 @@
+import bisect
+import datetime
+from . import cache
+from . import metrics
+from . import tiling
+from .segment import CatalogAccess, get_catalog, get_layer, get_schema
+from nagini.utils.tiling import tile_id_from_coordinate, Point
+import numpy as np
+import pandas as pd
+
+
+class PerRegion(dict):
+    """dict of region (EU or NA) -> value that computes func(region) the first time a region is used"""
+
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+
+    def __missing__(self, region):
+        value = self[region] = self.func(region)
+        return value
+
+
+class WeatherAccess(CatalogAccess):
+    """
+    Base class for weather access
+    """
+    _CATALOG = {}
+    _CATALOG['NA'] = 'hrn:here:data:::live-weather-archive-na'
+    _CATALOG['EU'] = 'hrn:here:data:::live-weather-archive-eu'
+
+    # like the layer classes in segment.py, the catalogs are only looked up when first used
+    _catalog = PerRegion(lambda region: get_catalog(WeatherAccess._CATALOG[region]))
+
+    def _read_data(self,layer,schema,pid,version):
+        return super().read_data( layer,schema,pid,version)
+
+
+class WeatherTimestampReader(WeatherAccess):
+    """
+    Provide access to the Weather Archive Timestamp->Version index
+    For most use cases, user does not need to worry about this class -- just use WeatherReader
+    """
+    # key is EU or NA ; the index of a region is downloaded the first time it is used (see _load)
+    timestamp_version_list = {}
+    # the same index as two sorted lists, for bisect
+    timestamps = {}
+    versions = {}
+
+    def _load(self, region):
+        if region in self.timestamps:
+            return
+        timestamp_layer = WeatherAccess._catalog[region].layer_by_id('timestamp-index')
+        ts_data = timestamp_layer.read_partitions(['index'])
+
+        ts_blob = next(ts_data)
+        pairs = sorted(self.parse_pairs(q) for q in ts_blob.decode().splitlines())
+        self.timestamp_version_list[region] = pairs
+        self.versions[region] = [q[1] for q in pairs]
+        self.timestamps[region] = [q[0] for q in pairs]  # last: it is what _load checks
+
+    def earliest(self, region):
+        """Return the timestamp of the earlier version"""
+        self._load(region)
+        return self.timestamp_version_list[region][0][0].strftime('%m/%d/%Y %H:%M:%S')
+
+    def parse_pairs(self, q):
+        ts = datetime.datetime.strptime(q.split(',')[0], '%m/%d/%Y %H:%M:%S')
+        version = int(q.split(',')[1])
+        return (ts,version)
+
+    def find_version(self, ts0, region):
+        """Given the input timestamp (datetime), return the version closest in time (None if outside the archive)"""
+        self._load(region)
+        times = self.timestamps[region]
+        if len(times) == 0 or ts0 < times[0] or ts0 > times[-1]:
+            return None
+        i = bisect.bisect_left(times, ts0)
+        if times[i] == ts0:
+            return self.versions[region][i]
+        # times[i-1] < ts0 < times[i] ; on a tie take the later version, like the old linear search did
+        if ts0 - times[i-1] < times[i] - ts0:
+            return self.versions[region][i-1]
+        return self.versions[region][i]
+
+    def versions_between(self, start, end, region):
+        """Return the (timestamp, version) pairs of all versions from start to end (datetimes, inclusive)"""
+        self._load(region)
+        lo = bisect.bisect_left(self.timestamps[region], start)
+        hi = bisect.bisect_right(self.timestamps[region], end)
+        return self.timestamp_version_list[region][lo:hi]
+
+    def find_versions(self, timestamps, region) -> np.ndarray:
+        """
+        Vectorized find_version for an array of (naive) timestamps
+        Returns an int64 array of versions, with -1 for timestamps outside the archive
+        """
+        self._load(region)
+        times = np.array(self.timestamps[region], dtype='datetime64[ns]')
+        versions = np.array(self.versions[region], dtype=np.int64)
+        ts = np.asarray(pd.to_datetime(timestamps), dtype='datetime64[ns]').reshape(-1)
+        output = np.full(ts.shape, -1, dtype=np.int64)
+        if len(times) == 0:
+            return output
+
+        inside = (ts >= times[0]) & (ts <= times[-1])
+        hi = np.clip(np.searchsorted(times, ts, side='left'), 1, len(times) - 1) if len(times) > 1 else \
+            np.zeros(ts.shape, dtype=np.int64)
+        lo = np.maximum(hi - 1, 0)
+        # exact matches are at hi (or at lo for the very first timestamp), otherwise the closer one wins
+        take_lo = (ts - times[lo]) < (times[hi] - ts)
+        output[inside] = np.where(take_lo, versions[lo], versions[hi])[inside]
+        return output
+
+
+class WeatherReader(WeatherAccess):
+    """
+    Class to access archived weather data
+    For most use cases, this is the only class the user needs. The timestamp index is accessed behind the scenes
+    by this class.
+    """
+    _layer = PerRegion(lambda region: get_layer(WeatherAccess._CATALOG[region], 'archived-data'))
+    _schema = PerRegion(lambda region: get_schema(WeatherReader._layer[region], WeatherAccess._CATALOG[region],
+                                                  'archived-data'))
+    partition_cache = cache.get_cache('weather-archived-data')  # key is (version, tile8)
+
+    _timestamp_decoder = WeatherTimestampReader()  # cheap: it reads the index of a region when first asked
+
+    verbose = False
+
+    # the fields of a decoded level 14 tile, in the order they are stored
+    FIELDS = ['temperature', 'humidity', 'iop', 'visibility', 'precip_type', 'wind_speed', 'wind_direction',
+              'pressure', 'timestamp']
+    _RECORD_BYTES = 400  # rough size in memory of one decoded tile: dict entry, tuple and its values
+
+    def _get_weather(self, tile8, version, region):
+        """
+        Low-level fetch of weather data from catalog, taking Level 8 tile and version as input
+        Returns a dict of level 14 tile id (int) -> tuple of FIELDS (None where there is no coverage),
+        or None if there is no data for the tile
+        """
+        key = (version, tile8)
+
+        weather_data = self.partition_cache.get(key, cache.MISSING)
+        if weather_data is cache.MISSING:
+            if self.verbose:
+                print("Reading weather catalog tile,version",tile8,version)
+            with metrics.timed('fetch', 'weather-archived-data', tile8) as t:
+                weather_part = self._layer[region].read_partitions([tile8],version)
+                weather_blob = list(weather_part)
+                t.nbytes = sum(len(q) for q in weather_blob)
+            if len(weather_blob) > 0:
+                with metrics.timed('decode', 'weather-archived-data', tile8, len(weather_blob[0])):
+                    decoded = self._schema[region].decode_blob(weather_blob[0])
+                with metrics.timed('flatten', 'weather-archived-data', tile8):
+                    weather_data = self._index_tiles(decoded)
+                size = len(weather_data) * self._RECORD_BYTES
+            else:
+                weather_data = None
+                size = 0
+            #cache the results for subsequent lookups
+            self.partition_cache.put(key, weather_data, size)
+        return weather_data
+
+    def _index_tiles(self, weather_data):
+        """Decode every level 14 tile of a level 8 partition once, into a dict keyed by tile id"""
+        output = {}
+        for weather_tile in weather_data.weather_condition_tile:
+            if weather_tile.air_temperature.value < -5000:
+                output[int(weather_tile.tile_id)] = None  # no coverage
+                continue
+            output[int(weather_tile.tile_id)] = (weather_tile.air_temperature.value,
+                                                 weather_tile.humidity.value,
+                                                 weather_tile.iop.value,
+                                                 weather_tile.visibility.value,
+                                                 self.decode_precip(weather_tile.precipitation_type),
+                                                 weather_tile.wind_velocity.value,
+                                                 weather_tile.wind_velocity.direction,
+                                                 weather_tile.air_pressure.value,
+                                                 weather_tile.timestamp)
+        return output
+
+    def decode_precip(self, ptype):
+        """Decode the precip enum into a human-readable string"""
+        name = ptype.DESCRIPTOR.fields_by_name['precipitation_type'].enum_type.values_by_number[ptype.precipitation_type].name
+        return name[0]+name[1:].lower()  # decapitalize except the first letter
+
+    @staticmethod
+    def region_of(longitude):
+        """Quick determination of NA or Europe"""
+        if longitude < -37.0:  # North America
+            return 'NA'
+        return 'EU'
+
+    def get_weather(self, latitude, longitude, timestamp=None, version=None):
+        """
+        Fetch weather based on coordinate and either timestamp (datetime) or catalog version number
+        """
+        region = self.region_of(longitude)
+
+        if (version is None) and (timestamp is not None):
+            version = self._timestamp_decoder.find_version(timestamp,region)
+        elif (version is not None) and (timestamp is not None):
+            assert False, 'do not provide both a version and a timestamp!'
+
+        if version is None:  # this is our flag for "version not found...give up"
+            return None
+        # the level 8 tile is the level 14 tile without its last 6 levels
+        tile14 = int(tile_id_from_coordinate(Point(latitude=latitude, longitude=longitude), 14))
+        tile8 = tile14 >> 12
+
+        weather_data = self._get_weather(tile8, version, region)
+
+        if weather_data is None:
+            return None  # no coverage
+
+        if tile14 not in weather_data:
+            return {}
+        record = weather_data[tile14]
+        if record is None:
+            return None  # no coverage
+        return dict(zip(self.FIELDS, record))
+
+    def get_weather_many(self, latitudes, longitudes, timestamps=None, versions=None) -> pd.DataFrame:
+        """
+        Batch version of get_weather, for joining weather onto many points at once
+
+        Takes arrays of latitudes and longitudes, and either an array of timestamps (naive datetimes) or
+        versions (an array, or one version for every point).
+        The points are grouped by (region, version, level 8 tile) so that every partition is looked up once.
+        Returns a DataFrame with one row per point, in input order: latitude, longitude, version and FIELDS,
+        with NaN (None for the string columns) where there is no weather.
+        """
+        if (versions is None) == (timestamps is None):
+            raise ValueError('get_weather_many: provide either timestamps or versions')
+        latitudes = np.asarray(latitudes, dtype=np.float64).reshape(-1)
+        longitudes = np.asarray(longitudes, dtype=np.float64).reshape(-1)
+        n = len(latitudes)
+        is_na = longitudes < -37.0
+
+        if versions is None:
+            versions = np.full(n, -1, dtype=np.int64)
+            timestamps = pd.to_datetime(timestamps)
+            for region, mask in [('NA', is_na), ('EU', ~is_na)]:
+                if mask.any():
+                    versions[mask] = self._timestamp_decoder.find_versions(timestamps[mask], region)
+        else:
+            versions = np.broadcast_to(np.asarray(versions, dtype=np.int64), (n,)).copy()
+
+        tiles14 = tiling.tile_ids_from_coordinates(latitudes, longitudes, 14)
+        tiles8 = tiling.parent_tile_ids(tiles14, 8)
+
+        columns = {name: np.full(n, np.nan) for name in self.FIELDS}
+        for name in ['precip_type', 'timestamp']:
+            columns[name] = np.full(n, None, dtype=object)
+
+        # one group per partition, the rows of every group are handled together
+        groups = pd.DataFrame({'na': is_na, 'version': versions, 'tile8': tiles8})
+        for (na, version, tile8), rows in groups.groupby(['na', 'version', 'tile8']).indices.items():
+            if version < 0:  # outside the archive
+                continue
+            weather_data = self._get_weather(int(tile8), int(version), 'NA' if na else 'EU')
+            if weather_data is None:
+                continue
+            found = [(row, weather_data.get(int(tiles14[row]))) for row in rows]
+            found = [(row, record) for row, record in found if record is not None]
+            if not found:
+                continue
+            found_rows = np.array([q[0] for q in found])
+            for i, name in enumerate(self.FIELDS):
+                columns[name][found_rows] = [q[1][i] for q in found]
+
+        output = pd.DataFrame({'latitude': latitudes, 'longitude': longitudes,
+                               'version': np.where(versions >= 0, versions, np.nan)})
+        for name in self.FIELDS:
+            output[name] = columns[name]
+        return output
+
+
+def get_weather_for_tiles(tiles=None, start=datetime.datetime(2019,2,1,1,0,0), end=None, out_dir='weather', **kwargs):
+    """
+    Extract all of the weather for a set of tiles (default: weatherextract.DEFAULT_TILES) over a time range
+    (default: 3 days from start) to Parquet files in out_dir ; see WeatherExtractor in weatherextract.py
+    """
+    from .weatherextract import DEFAULT_TILES, extract_weather  # weatherextract imports this module
+
+    if tiles is None:
+        tiles = DEFAULT_TILES
+    if end is None:
+        end = start + datetime.timedelta(days=3)
+    return extract_weather(out_dir, tiles, start, end, **kwargs)
+
+
+if __name__=='__main__':
+    #wr = WeatherReader()
+    #print( wr.get_weather(38.914768, -76.989731,datetime.datetime(2019,7,4,13,0,0)) )
+    get_weather_for_tiles()
@@ -0,0 +1,160 @@
+"""
+Extract the archived weather of a set of tiles over a time range into columnar files
+
+    from hmctools.weatherextract import WeatherExtractor
+    extractor = WeatherExtractor('weather', tiles=[23618409, 23618408], start=datetime.datetime(2019, 2, 1),
+                                 end=datetime.datetime(2019, 2, 22))
+    written, failures = extractor.run()
+    df = pd.read_parquet('weather')
+
+The versions in the time range are found through the timestamp index. Every version is one unit of work:
+its level 8 partitions are fetched (through the shared fetch engine, so with retries and a bound on the
+requests in flight) and decoded, and the rows for the requested level 14 tiles are written to
+
+    <out_dir>/region=<EU|NA>/date=<YYYY-MM-DD>/<version>.parquet
+
+as soon as the version is done, so only the versions that are being worked on are ever in memory.
+Files are written to a temporary name and then renamed, so a file that exists is complete: running the
+same extraction again (e.g. after an interruption) skips those versions and only does the rest.
+"""
+
+import datetime
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from . import fetch
+from . import tiling
+from .weather import WeatherAccess, WeatherReader
+
+
+FORMATS = {'parquet': '.parquet', 'feather': '.arrow'}
+
+
+class WeatherExtractor:
+    """
+    Write the weather of a set of tiles (any level up to 14) for every version from start to end (datetimes)
+    """
+
+    def __init__(self, out_dir, tiles, start, end, max_workers=8, file_format='parquet', verbose=True):
+        if file_format not in FORMATS:
+            raise ValueError('WeatherExtractor: file_format must be one of ' + ', '.join(FORMATS))
+        self.out_dir = out_dir
+        self.start = start
+        self.end = end
+        self.max_workers = max_workers
+        self.file_format = file_format
+        self.verbose = verbose
+
+        # everything is done with level 14 tiles, grouped by the level 8 partition they are in
+        self.tiles14 = np.unique(np.concatenate([tiling.child_tile_ids([int(q)], 14) for q in tiles]))
+        self.latitudes, self.longitudes = tiling.tile_centers(self.tiles14)
+        self.tiles8 = tiling.parent_tile_ids(self.tiles14, 8)
+
+        self._reader = WeatherReader()
+
+    def _path(self, region, version_time, version):
+        return os.path.join(self.out_dir, 'region=' + region, 'date=' + version_time.strftime('%Y-%m-%d'),
+                            str(version) + FORMATS[self.file_format])
+
+    def jobs(self):
+        """Return all of the (region, version timestamp, version, rows of the tiles in the region) to extract"""
+        output = []
+        is_na = self.longitudes < -37.0
+        for region, mask in [('EU', ~is_na), ('NA', is_na)]:
+            if not mask.any():
+                continue
+            for version_time, version in self._reader._timestamp_decoder.versions_between(self.start, self.end,
+                                                                                          region):
+                output.append((region, version_time, version, np.flatnonzero(mask)))
+        return output
+
+    def _read_partition(self, region, tile8, version):
+        """Decoded weather of a level 8 partition, {} where the version has no data for it (no coverage)"""
+        layer = self._reader._layer[region]
+        try:
+            pblob = fetch.get_fetcher().fetch(layer, tile8, version,
+                                              layer_key=(WeatherAccess._CATALOG[region], 'archived-data'))
+        except fetch.PartitionNotFound:
+            return {}  # the rows are written with missing weather, as WeatherReader does
+        # not WeatherReader._get_weather, a backfill should not push everything else out of the cache
+        return self._reader._index_tiles(self._reader._schema[region].decode_blob(pblob))
+
+    def _extract(self, region, version_time, version, rows):
+        """Fetch, decode and write one version ; returns the path that was written"""
+        # go through the tiles per level 8 partition, so that only one partition is decoded at a time
+        order = rows[np.argsort(self.tiles8[rows], kind='stable')]
+        columns = {name: [] for name in WeatherReader.FIELDS}
+        tile8, weather_data = None, None
+        for row in order:
+            if self.tiles8[row] != tile8:
+                tile8 = self.tiles8[row]
+                weather_data = self._read_partition(region, int(tile8), version)
+            record = weather_data.get(int(self.tiles14[row]))
+            for i, name in enumerate(WeatherReader.FIELDS):
+                columns[name].append(record[i] if record is not None else None)
+
+        df = pd.DataFrame({'version': version, 'version_time': version_time, 'tile14': self.tiles14[order],
+                           'latitude': self.latitudes[order], 'longitude': self.longitudes[order]})
+        for name in WeatherReader.FIELDS:
+            df[name] = pd.to_numeric(columns[name]) if name not in ['precip_type', 'timestamp'] else columns[name]
+
+        path = self._path(region, version_time, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        os.close(fd)
+        try:
+            if self.file_format == 'parquet':
+                df.to_parquet(tmp_path, index=False)
+            else:
+                df.to_feather(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    def run(self):
+        """
+        Extract every version that has not been written yet
+        Returns the list of files written, and a DataFrame of failures (region, version, reason) ;
+        the failed versions are retried by the next run()
+        """
+        jobs = self.jobs()
+        todo = [q for q in jobs if not os.path.exists(self._path(q[0], q[1], q[2]))]
+        if self.verbose:
+            print('%d versions, %d already done, %d level 14 tiles' % (len(jobs), len(jobs) - len(todo),
+                                                                     len(self.tiles14)))
+
+        written = []
+        failures = {'region': [], 'version': [], 'reason': []}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._extract, *job): job for job in todo}
+            for i, future in enumerate(as_completed(futures)):
+                region, _, version, _ = futures[future]
+                try:
+                    written.append(future.result())
+                except Exception as e:
+                    failures['region'].append(region)
+                    failures['version'].append(version)
+                    failures['reason'].append('%s: %s' % (type(e).__name__, e))
+                if self.verbose and (i + 1) % 50 == 0:
+                    print('%d/%d versions, %d failed' % (i + 1, len(todo), len(failures['version'])))
+        return written, pd.DataFrame(failures)
+
+
+def extract_weather(out_dir, tiles, start, end, **kwargs):
+    """Shortcut for WeatherExtractor(out_dir, tiles, start, end, **kwargs).run()"""
+    return WeatherExtractor(out_dir, tiles, start, end, **kwargs).run()
+
+
+# the level 12 tiles (around Berlin) that get_weather_for_tiles has always extracted
+DEFAULT_TILES = [23618409, 23618408, 23618365, 23618359, 23618402, 23618403, 23618401, 23618400, 23618357]
+
+
+if __name__ == '__main__':
+    t0 = datetime.datetime(2019, 2, 1, 1, 0, 0)
+    extract_weather('weather', DEFAULT_TILES, t0, t0 + datetime.timedelta(days=3))
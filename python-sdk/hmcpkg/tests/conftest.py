@@ -0,0 +1,37 @@
+from types import SimpleNamespace as N
+
+import pytest
+
+
+def _id2int(identifier):
+    return int(identifier.split(':')[-1])
+
+
+def _ref(pid, sid):
+    return N(partition_name=str(pid), identifier='here:cm:segment:%d' % sid)
+
+
+def _segment(sid, start, end, points):
+    return N(identifier='here:cm:segment:%d' % sid, length=float(sid), start_node_ref=_ref(*start),
+             end_node_ref=_ref(*end), geometry=N(point=[N(latitude=a, longitude=b) for a, b in points]))
+
+
+def _node(nid, refs):
+    return N(identifier='here:cm:node:%d' % nid, segment_ref=[_ref(*q) for q in refs])
+
+
+@pytest.fixture
+def topology_partitions():
+    """Two decoded topology-geometry partitions as duck-typed protobufs: 1 has segments 5 and 3, 2 has 7"""
+    first = N(segment=[_segment(5, (1, 10), (1, 11), [(0, 0), (1, 1)]),
+                       _segment(3, (1, 11), (2, 20), [(2, 2), (3, 3), (4, 4)])],
+              node=[_node(11, [(1, 5), (1, 3)]), _node(10, [(1, 5)])])
+    second = N(segment=[_segment(7, (2, 20), (2, 21), [(9, 9), (8, 8)])],
+               node=[_node(20, [(1, 3), (2, 7)])])
+    return {1: first, 2: second}
+
+
+@pytest.fixture
+def id2int():
+    """segment.id2int without importing segment.py"""
+    return _id2int
@@ -0,0 +1,52 @@
+import numpy as np
+
+from hmctools.attributes import AttributeIntervals, IntervalIndex
+
+
+def intervals(rows, values):
+    """AttributeIntervals from (sid, orientation, start, end, code) rows in partition order"""
+    order = sorted(range(len(rows)), key=lambda i: rows[i][:3])
+    columns = [np.array([rows[i][k] for i in order]) for k in range(5)]
+    return AttributeIntervals(columns[0].astype(np.int64), columns[1].astype(np.int8), columns[2].astype(np.float64),
+                              columns[3].astype(np.float64), columns[4].astype(np.int16), values,
+                              ['BOTH', 'FORWARD', 'BACKWARD'], np.array(order))
+
+
+def test_first_anchor_in_partition_wins():
+    # a long anchor first in the partition, then a shorter one that starts later and overlaps it
+    fc = intervals([(7, 1, 0.0, 1.0, 0), (7, 1, 0.4, 0.6, 1)], [70, 50])
+    assert fc.value(7, 'FORWARD', 0.5) == 70
+    assert fc.value(7, 'FORWARD', 0.2) == 70
+    # the other way round
+    fc = intervals([(7, 1, 0.4, 0.6, 1), (7, 1, 0.0, 1.0, 0)], [70, 50])
+    assert fc.value(7, 'FORWARD', 0.5) == 50
+    assert fc.value(7, 'FORWARD', 0.8) == 70
+    assert fc.value(7, 'BACKWARD', 0.5) is None
+    assert fc.value(8, 'FORWARD', 0.5) is None
+
+
+def test_shared_boundary():
+    # an offset on the boundary of two anchors gets the value of the one that comes first in the partition
+    fc = intervals([(7, 0, 0.5, 1.0, 0), (7, 0, 0.0, 0.5, 1)], ['B', 'A'])
+    assert list(fc.values_at([7, 7, 7], 'ignore', [0.25, 0.5, 0.75])) == ['A', 'B', 'B']
+    fc = intervals([(7, 0, 0.0, 0.5, 0), (7, 0, 0.5, 1.0, 1)], ['A', 'B'])
+    assert list(fc.values_at([7, 7, 7], 'ignore', [0.25, 0.5, 0.75])) == ['A', 'A', 'B']
+
+
+def test_ignore_orientation_uses_partition_order():
+    fc = intervals([(7, 2, 0.0, 1.0, 1), (7, 1, 0.0, 1.0, 0)], ['F', 'B'])
+    assert fc.value(7, 'ignore', 0.5) == 'B'
+    assert fc.value(7, 'FORWARD', 0.5) == 'F'
+
+
+def test_half_open_travel_direction():
+    td = intervals([(7, 1, 0.0, 0.5, 0), (7, 2, 0.5, 1.0, 0)], [None])
+    assert list(td.orientations_at([7, 7, 7, 7], [0.0, 0.5, 0.7, 1.0])) == ['FORWARD', 'BACKWARD', 'BACKWARD',
+                                                                          'BACKWARD']
+
+
+def test_offset_resolution_for_large_segment_ids():
+    sid = 2 ** 40 + 3
+    index = IntervalIndex(np.array([sid, sid]), np.array([1, 1]), np.array([0.0, 0.5 + 1e-7]),
+                          np.array([0.5 + 1e-7, 1.0]))
+    assert list(index.find(np.array([sid, sid, sid]), 1, np.array([0.5, 0.5 + 1e-7, 0.5 + 2e-7]))) == [0, 0, 1]
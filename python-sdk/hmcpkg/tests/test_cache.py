@@ -0,0 +1,30 @@
+from hmctools.cache import LayerCache
+
+
+def test_eviction_callback_outside_the_lock():
+    evicted = []
+    other = LayerCache('other')
+
+    def on_evict(key, value):
+        assert not c._lock._is_owned()
+        evicted.append((key, value, key in other))
+
+    c = LayerCache('test', max_bytes=100, on_evict=on_evict)
+    other.put(1, 'a')
+    c.put(1, 'a', 60)
+    c.put(1, 'b', 60)  # replaced, not evicted
+    assert evicted == [] and c.nbytes == 60
+    c.put(2, 'c', 60)
+    assert evicted == [(1, 'b', True)]
+    c.invalidate()
+    assert evicted[1:] == [(2, 'c', False)] and c.nbytes == 0
+
+
+def test_contains_does_not_count():
+    c = LayerCache('test')
+    c.put(1, 'a')
+    c.put(2, 'b')
+    assert 1 in c and 3 not in c
+    assert c.stats()['hits'] == 0 and c.stats()['misses'] == 0
+    assert c.keys() == [1, 2]  # the lookup did not make 1 the most recently used
+    assert c.get(1) == 'a' and c.keys() == [2, 1]
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from hmctools import fetch
+from hmctools.fakecatalog import FakeLayer
+
+
+class CountingLayer(FakeLayer):
+    """FakeLayer that remembers the largest number of read_partitions calls running at the same time"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.active = 0
+        self.max_active = 0
+        self._active_lock = threading.Lock()
+
+    def read_partitions(self, partition_ids, version=None):
+        with self._active_lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return list(super().read_partitions(partition_ids, version))
+        finally:
+            with self._active_lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def fetcher():
+    f = fetch.PartitionFetcher(max_in_flight=2, max_tries=3, base_delay=0.001, max_delay=0.01)
+    yield f
+    f.close()
+
+
+def test_fetch(fetcher):
+    layer = FakeLayer({'23602975': b'blob', ('23602975', 7): b'version 7'})
+    assert fetcher.fetch(layer, 23602975) == b'blob'
+    assert fetcher.fetch(layer, 23602975, 7) == b'version 7'
+    assert fetcher.downloads == 2
+
+
+def test_single_flight(fetcher):
+    layer = FakeLayer({'23602975': b'blob'}, latency=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(fetcher.fetch(layer, 23602975, None, 'layer')))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [b'blob'] * 5
+    assert layer.calls == 1
+    assert fetcher.coalesced == 4
+
+    # once the download is done, the next request downloads again
+    fetcher.fetch(layer, 23602975, None, 'layer')
+    assert layer.calls == 2
+
+
+def test_retry_until_success(fetcher):
+    # with this seed the first two calls fail and the third succeeds
+    layer = FakeLayer({'23602975': b'blob'}, failure_rate=0.5, seed=10)
+    assert fetcher.fetch(layer, 23602975) == b'blob'
+    assert layer.failures == 2
+    assert fetcher.retries == 2
+
+
+def test_retry_gives_up(fetcher):
+    layer = FakeLayer({'23602975': b'blob'}, failure_rate=1.0)
+    with pytest.raises(fetch.FetchError):
+        fetcher.fetch(layer, 23602975)
+    assert layer.calls == fetcher.max_tries
+    assert fetcher.retries == fetcher.max_tries - 1
+
+
+def test_missing_partition(fetcher):
+    layer = FakeLayer({})
+    with pytest.raises(fetch.PartitionNotFound):
+        fetcher.fetch(layer, 23602975)
+    assert layer.calls == 1  # not retried
+    result = fetcher.fetch_many(FakeLayer({'1': b'one'}), [1, 2])
+    assert result[1] == b'one'
+    assert isinstance(result[2], fetch.PartitionNotFound)
+
+
+def test_backoff(monkeypatch):
+    f = fetch.PartitionFetcher(base_delay=0.5, max_delay=3.0)
+    try:
+        monkeypatch.setattr(fetch.random, 'uniform', lambda low, high: high)
+        assert [f._backoff(attempt) for attempt in range(5)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+        monkeypatch.setattr(fetch.random, 'uniform', lambda low, high: low)
+        assert f._backoff(4) == 0
+    finally:
+        f.close()
+
+
+def test_backoff_between_tries(monkeypatch):
+    f = fetch.PartitionFetcher(max_tries=3, base_delay=0.1, max_delay=1.0)
+    try:
+        monkeypatch.setattr(fetch.random, 'uniform', lambda low, high: high)
+        start = time.perf_counter()
+        with pytest.raises(fetch.FetchError):
+            f.fetch(FakeLayer({}, failure_rate=1.0), 23602975)
+        assert time.perf_counter() - start >= 0.1 + 0.2
+    finally:
+        f.close()
+
+
+def test_timeouts_stay_within_max_in_flight():
+    f = fetch.PartitionFetcher(max_in_flight=2, max_tries=3, base_delay=0.001, max_delay=0.001, timeout=0.02)
+    try:
+        layer = CountingLayer({str(q): b'blob' for q in range(6)}, latency=0.1)
+        result = f.fetch_many(layer, list(range(6)))
+        assert all(isinstance(q, fetch.FetchError) for q in result.values())
+        assert layer.max_active <= 2
+        # every slot is given back once the calls that timed out have returned
+        time.sleep(0.3)
+        assert f._semaphore._value == f.max_in_flight
+    finally:
+        f.close()
@@ -0,0 +1,97 @@
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('nagini')
+
+from hmctools import flowarchive  # noqa: E402
+from hmctools.trafficflow import FLOW_DTYPE, ITEM_DTYPE, TrafficFlowArrays  # noqa: E402
+
+NAN = np.nan
+T0 = datetime.datetime(2019, 8, 27, 10, 58)
+
+
+def _arrays(items):
+    """TrafficFlowArrays of a list of (id, segment ids, active, created, updated, [(start, jam, speed), ...])"""
+    rows, flows = [], []
+    for i, (item_id, sids, active, created, updated, flow) in enumerate(items):
+        rows.append((created, updated, 0.25, 0.75, True, active))
+        ends = [q[0] for q in flow[1:]] + [1.0]
+        flows.extend((i, start, end, jam, speed, NAN, 0.9) for (start, jam, speed), end in zip(flow, ends))
+    segment_ptr = np.concatenate([[0], np.cumsum([len(q[1]) for q in items])]).astype(np.int64)
+    return TrafficFlowArrays(np.array(rows, dtype=ITEM_DTYPE), segment_ptr,
+                             np.array([s for q in items for s in q[1]], dtype=np.int64),
+                             np.array(flows, dtype=FLOW_DTYPE), np.array([q[0] for q in items], dtype=str))
+
+
+def _assert_equal(arrays, expected):
+    for name in TrafficFlowArrays.ARRAYS:
+        actual, wanted = getattr(arrays, name), getattr(expected, name)
+        for field in (wanted.dtype.names or [None]):
+            np.testing.assert_array_equal(actual[field] if field else actual, wanted[field] if field else wanted,
+                                          err_msg='%s %s' % (name, field))
+
+
+FIRST = _arrays([('A', [11, 12], True, 100, 110, [(0.0, 2.0, 80.0), (0.5, 4.0, NAN)]),
+                 ('B', [21], True, 100, 100, [(0.0, 1.0, 90.0)]),
+                 ('C', [31, 32, 33], True, 90, 95, [])])
+# B is dropped, C comes first and is no longer active, A has a new jam factor and D is new
+SECOND = _arrays([('C', [31, 32, 33], False, 90, 130, []),
+                  ('A', [11, 12], True, 100, 130, [(0.0, 3.0, 80.0), (0.5, 4.0, NAN)]),
+                  ('D', [41, 40], True, 125, 125, [(0.0, NAN, 50.0)])])
+
+
+def test_delta_round_trip():
+    t1, t2 = 1000, 1060
+    columns = flowarchive.encode(FIRST, t1)
+    first = flowarchive.decode(flowarchive._unpack(flowarchive._pack(columns)), t1)
+    _assert_equal(first, FIRST)
+
+    delta = flowarchive.encode(SECOND, t2, FIRST)
+    assert delta['new'].tolist() == [False, False, True]
+    assert delta['flow_changed'].tolist() == [False, True, True]
+    assert delta['item_ids'].tolist() == ['D']
+    second = flowarchive.decode(flowarchive._unpack(flowarchive._pack(delta)), t2, first)
+    _assert_equal(second, SECOND)
+
+
+def test_new_file_every_hour(tmp_path):
+    archive = flowarchive.FlowArchive(str(tmp_path))
+    times = [T0, T0 + datetime.timedelta(minutes=2, seconds=30), T0 + datetime.timedelta(minutes=3)]
+    for t, arrays in zip(times, [FIRST, SECOND, FIRST]):
+        archive.append(23602975, t, arrays)
+
+    day = tmp_path / '23602975' / '2019-08-27'
+    assert sorted(os.listdir(day)) == ['10.flow', '11.flow']
+    kinds = [[q[0] for q in archive._headers(str(day / name))] for name in ['10.flow', '11.flow']]
+    assert kinds == [[flowarchive.KEY], [flowarchive.KEY, flowarchive.DELTA]]
+
+    snapshots = list(archive.read(23602975))
+    assert [q[0] for q in snapshots] == [flowarchive.as_epoch(q) for q in times]
+    for (_, arrays), expected in zip(snapshots, [FIRST, SECOND, FIRST]):
+        _assert_equal(arrays, expected)
+    timestamp, arrays = archive.snapshot(23602975, T0 + datetime.timedelta(minutes=2, seconds=45))
+    assert timestamp == flowarchive.as_epoch(times[1])
+    _assert_equal(arrays, SECOND)
+
+
+def test_truncated_last_record(tmp_path):
+    archive = flowarchive.FlowArchive(str(tmp_path))
+    archive.append(23602975, T0, FIRST)
+    archive.append(23602975, T0 + datetime.timedelta(seconds=60), SECOND)
+    path = archive.path(23602975, T0)
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as fh:
+        fh.truncate(size - 5)  # e.g. a crash in the middle of writing the second record
+
+    archive = flowarchive.FlowArchive(str(tmp_path))
+    assert archive.timestamps(23602975) == [flowarchive.as_epoch(T0)]
+    _assert_equal(archive.snapshot(23602975, T0 + datetime.timedelta(seconds=60))[1], FIRST)
+
+    # the next append replaces the cut off record
+    archive.append(23602975, T0 + datetime.timedelta(seconds=120), SECOND)
+    snapshots = list(archive.read(23602975))
+    assert [q[0] - snapshots[0][0] for q in snapshots] == [0, 120]
+    _assert_equal(snapshots[1][1], SECOND)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from hmctools.graph import RoadGraph
+
+
+@pytest.fixture
+def graphs(topology_partitions, id2int):
+    return [RoadGraph.from_parsed(pid, parsed, id2int) for pid, parsed in topology_partitions.items()]
+
+
+def test_from_parsed(graphs):
+    g = graphs[0]
+    assert list(g.segment_ids(1)) == [3, 5]
+    assert g.node(1, 3, 0) == (1, 11) and g.node(1, 3, 1) == (2, 20) and g.node(1, 4, 0) is None
+    assert g.shape(1, 3).tolist() == [[2, 2], [3, 3], [4, 4]]
+    assert g.connected_segments(1, 11) == [(1, 5), (1, 3)]
+    assert g.connected_segments(1, 12) is None
+    assert g.shared_node(1, 5, 3) == (1, 11)
+
+
+@pytest.mark.parametrize('order', [[0, 1], [1, 0]])
+def test_merge(graphs, order):
+    g = RoadGraph.merge([graphs[k] for k in order] + [None])
+    assert len(g) == 3
+    assert list(g.seg_pid) == [1, 1, 2] and list(g.seg_sid) == [3, 5, 7]
+    lengths = g.lengths([1, 1, 2, 2], [3, 5, 7, 3])
+    assert lengths[:3].tolist() == [3.0, 5.0, 7.0] and np.isnan(lengths[3])
+    assert g.shapes(2)[7].tolist() == [[9, 9], [8, 8]]
+    assert g.shape(1, 5).tolist() == [[0, 0], [1, 1]]
+    # adjacency across the partition boundary
+    assert g.connected_segments(2, 20) == [(1, 3), (2, 7)]
+    assert g.connected_segments(1, 10) == [(1, 5)]
+    assert g.shared_node(1, 3, 7) == (2, 20)
+    assert (2, 7) in g and (1, 7) not in g and (3, 7) not in g
+
+
+def test_merge_nothing():
+    with pytest.raises(ValueError):
+        RoadGraph.merge([None])
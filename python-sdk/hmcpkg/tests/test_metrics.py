@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from hmctools import metrics
+
+
+class Accessor:
+    pid = 23602975
+
+    @metrics.traced('accessor')
+    def outer(self):
+        return self.inner() + self.inner()
+
+    @metrics.traced('accessor')
+    def inner(self):
+        return 1
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_nested_accessors_count_once():
+    with metrics.profile() as prof:
+        assert Accessor().outer() == 2
+    stages = metrics.snapshot()['stages']['accessor']
+    assert list(stages) == ['outer']
+    assert stages['outer']['calls'] == 1
+    assert [q[2:] for q in prof.by_partition()] == [('outer', 23602975, 1)]
+
+    Accessor().inner()  # on its own it is the outermost call
+    assert metrics.snapshot()['stages']['accessor']['inner']['calls'] == 1
+
+
+def test_threads_are_merged():
+    def work():
+        for _ in range(1000):
+            metrics.record('decode', 'layer', 0.001, 10)
+            Accessor().outer()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stages = metrics.snapshot()['stages']
+    assert stages['decode']['layer']['calls'] == 4000
+    assert stages['decode']['layer']['bytes'] == 40000
+    assert stages['decode']['layer']['seconds'] == pytest.approx(4.0)
+    assert stages['accessor']['outer']['calls'] == 4000
+
+    metrics.reset()
+    assert metrics.snapshot()['stages'] == {}
+
+
+def test_tables_of_ended_threads_are_folded():
+    for _ in range(20):  # like prefetch_partitions, a new pool of threads every time
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda _: metrics.record('fetch', 'layer', 0.001, 1), range(8)))
+    assert metrics.snapshot()['stages']['fetch']['layer']['calls'] == 160
+    assert len(metrics._tables) <= 1  # only this thread is still alive
@@ -0,0 +1,34 @@
+import os
+
+from google.protobuf import descriptor_pb2
+
+from hmctools import partitionstore
+
+
+def test_stored_blob_decodes_with_protobuf(tmp_path):
+    store = partitionstore.PartitionStore(str(tmp_path))
+    message = descriptor_pb2.FileDescriptorProto(name='rib.proto', package='hmc')
+    store.put('hrn:here:data::olp-here:rib-2', 'topology-geometry', 5, 23602975, message.SerializeToString())
+
+    blob = store.get('hrn:here:data::olp-here:rib-2', 'topology-geometry', 5, 23602975)
+    parsed = descriptor_pb2.FileDescriptorProto()
+    parsed.ParseFromString(blob)
+    assert parsed == message
+
+
+def test_put_only_evicts_over_the_cap(tmp_path, monkeypatch):
+    store = partitionstore.PartitionStore(str(tmp_path), max_bytes=1000)
+    scans = []
+    scan = store._scan
+    monkeypatch.setattr(store, '_scan', lambda: scans.append(1) or scan())
+
+    for pid in range(9):
+        store.put('hrn', 'layer', 1, pid, bytes([pid]) * 100)
+        os.utime(store._ref_path(store.key('hrn', 'layer', 1, pid)), (1000 + pid, 1000 + pid))
+    assert len(scans) == 1  # the initial size
+    assert store.size() == 900
+
+    store.put('hrn', 'layer', 1, 9, b'x' * 300)
+    assert store.size() <= 1000
+    assert store.get('hrn', 'layer', 1, 0) is None
+    assert store.get('hrn', 'layer', 1, 9) == b'x' * 300
@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip('nagini')
+
+from hmctools import cache, partitionstore  # noqa: E402
+from hmctools.fakecatalog import FakeLayer, FakeSchema  # noqa: E402
+from hmctools.segment import TopologyGeometry, prefetch_partitions  # noqa: E402
+
+
+@pytest.fixture
+def compact(monkeypatch, topology_partitions):
+    layer = FakeLayer({str(pid): str(pid).encode() for pid in topology_partitions},
+                      schema=FakeSchema(lambda blob: topology_partitions[int(blob)]))
+    # not monkeypatch: looking up the old value would connect to OLP
+    saved = {name: TopologyGeometry.__dict__.get(name) for name in ['_layer', '_schema']}
+    TopologyGeometry._layer = layer
+    TopologyGeometry._schema = layer.schema
+    monkeypatch.setattr(TopologyGeometry, 'compact', True)
+    monkeypatch.setattr(partitionstore, '_default_store', None)
+    monkeypatch.setattr(partitionstore, '_default_store_configured', True)
+    cache.invalidate()
+    TopologyGeometry._pidlookup.clear()
+    yield layer
+    for name, value in saved.items():
+        if value is None:
+            delattr(TopologyGeometry, name)
+        else:
+            setattr(TopologyGeometry, name, value)
+    cache.invalidate()
+    TopologyGeometry._pidlookup.clear()
+
+
+def test_compact_mode_keeps_only_the_graph(compact):
+    tg = TopologyGeometry()
+    assert tg.get_segment_length(1, 3) == 3.0
+    assert [q.sid for q in tg.get_connected_segments(2, 20)] == [3, 7]
+    assert tg.get_partition_for_adjacent_segment(1, 3, 7) == 2
+    assert sorted(tg._pidlookup.items()) == [(3, 1), (5, 1), (7, 2)]
+    assert len(TopologyGeometry._data) == 0 and len(TopologyGeometry._graphs) == 2
+
+    calls = compact.calls
+    prefetch_partitions([1, 2], layers=[TopologyGeometry._layer_id], neighbours=False)
+    assert compact.calls == calls  # the graphs are cached, so nothing is fetched again
+    assert len(TopologyGeometry._data) == 0
+
+    TopologyGeometry._graphs.invalidate(1)
+    assert sorted(tg._pidlookup.items()) == [(7, 2)]
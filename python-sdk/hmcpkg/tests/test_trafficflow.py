@@ -0,0 +1,58 @@
+import numpy as np
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+from hmctools.trafficflow import TrafficFlowArrays
+
+
+def _traffic_flow_classes():
+    """The parts of com.here.traffic.realtime.v1 that TrafficFlowArrays reads, as proto2 message classes"""
+    F = descriptor_pb2.FieldDescriptorProto
+    messages = {
+        'Speed': [('average_speed_kph', F.TYPE_DOUBLE), ('free_flow_speed_kph', F.TYPE_DOUBLE)],
+        'Segment': [('speed', 'Speed'), ('jam_factor', F.TYPE_DOUBLE), ('start_offset', F.TYPE_DOUBLE)],
+        'Flow': [('segment', 'Segment', True), ('confidence', F.TYPE_DOUBLE)],
+        'TopologySegmentReference': [('topology_segment_id', F.TYPE_INT32, True),
+                                     ('is_first_segment_in_driving_direction', F.TYPE_BOOL),
+                                     ('start_offset', F.TYPE_DOUBLE), ('end_offset', F.TYPE_DOUBLE)],
+        'TrafficItem': [('id', F.TYPE_STRING), ('created_timestamp', F.TYPE_INT64),
+                        ('updated_timestamp', F.TYPE_INT64), ('is_active', F.TYPE_BOOL),
+                        ('topology_segment', 'TopologySegmentReference'), ('flow', 'Flow')],
+        'TrafficFlowPartition': [('items', 'TrafficItem', True)],
+    }
+    proto = descriptor_pb2.FileDescriptorProto(name='test_traffic_flow.proto', package='test', syntax='proto2')
+    for name, fields in messages.items():
+        message = proto.message_type.add(name=name)
+        for number, (field, kind, *repeated) in enumerate(fields, 1):
+            label = F.LABEL_REPEATED if repeated else F.LABEL_OPTIONAL
+            if isinstance(kind, str):
+                message.field.add(name=field, number=number, label=label, type=F.TYPE_MESSAGE,
+                                  type_name='.test.' + kind)
+            else:
+                message.field.add(name=field, number=number, label=label, type=kind)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto)
+    return {name: message_factory.GetMessageClass(pool.FindMessageTypeByName('test.' + name)) for name in messages}
+
+
+def test_confidence_of_the_flow_and_missing_values():
+    classes = _traffic_flow_classes()
+    partition = classes['TrafficFlowPartition']()
+    item = partition.items.add(id='E1', created_timestamp=10, is_active=True)
+    item.topology_segment.topology_segment_id.extend([5, 6])
+    item.flow.confidence = 0.99
+    item.flow.segment.add().speed.average_speed_kph = 100.0  # no free flow speed and no jam factor
+    item.flow.segment.add(start_offset=0.5, jam_factor=0.0)  # no speed at all
+    partition.items.add(id='E2')  # no flow
+
+    arrays = TrafficFlowArrays.from_parsed(partition)
+    assert list(arrays.item_ids) == ['E1', 'E2']
+    assert list(arrays.items['is_active']) == [True, False]
+    flows = arrays.flows
+    assert list(flows['item']) == [0, 0]
+    assert list(flows['end_offset']) == [0.5, 1.0]
+    assert np.allclose(flows['confidence'], 0.99)
+    assert flows['speed'][0] == 100.0 and np.isnan(flows['speed'][1])
+    assert np.isnan(flows['free_flow_speed']).all()
+    assert np.isnan(flows['jam_factor'][0]) and flows['jam_factor'][1] == 0.0  # set to 0 is not missing
+    assert list(arrays.flow_ptr()) == [0, 2, 2]
+